@@ -2,13 +2,19 @@ from __future__ import division, print_function
 import sys
 import csv
 import os.path
+import warnings
+import multiprocessing
 import numpy as np
 import scipy.linalg
-import rospy
-import cisstRobotPython as crp
-import matplotlib.pyplot as plt
-from cisstNumericalPython import nmrRegistrationRigid
+import scipy.optimize
 from copy import copy
+from kinematics import load_rob
+from plane_statistics import PlaneStatistics
+from profiler import (profiled, profile_task, profile_tasks,
+                      merge_task, PROFILER)
+from registration import register_rigid
+from session import (load_session, JOINT_COLUMNS, POSITION_COLUMNS,
+                     TRACKER_COLUMNS)
 
 
 ROB_FILE = ("/home/chaitu/catkin_ws/src/cisst-saw/"
@@ -20,39 +26,33 @@ SEARCH_THRESH = 1.4
 MIN_RESIDUAL_DIFF = 0.008
 
 
-def show_tracker_point_cloud(data_file):
+def get_pyplot():
+    """
+    Imports matplotlib.pyplot the first time a graph is shown, so the
+    analysis runs without matplotlib or a display. Without a display, the
+    Agg backend is used and graphs aren't shown
+    """
+    import matplotlib
+    if (sys.platform.startswith("linux") and not os.environ.get("DISPLAY")
+            and not os.environ.get("MPLBACKEND")):
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+@profiled("plotting")
+def show_tracker_point_cloud(folder):
     """
     Plots graph of tracker point cloud/arm position point cloud
     in addition to the transforming the tracker point cloud onto
     the arm position point cloud
     """
-    coords = np.array([])
-    tracker_coords = np.array([])
-
-    with open(data_file, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        for row in reader:
-            coord = np.array([
-                float(row["arm_position_x"]),
-                float(row["arm_position_y"]),
-                float(row["arm_position_z"])
-            ])
-            coords = np.append(coords, coord)
-
-            tracker_coord = np.array([
-                float(row["tracker_position_x"]),
-                float(row["tracker_position_y"]),
-                float(row["tracker_position_z"]),
-            ])
-            tracker_coords = np.append(tracker_coords, tracker_coord)
-
-    coords = coords.reshape(-1, 3)
-    tracker_coords = tracker_coords.reshape(-1, 3)
-
-    transf, error = nmrRegistrationRigid(coords, tracker_coords)
-    rot_matrix = transf.Rotation()
-    translation = transf.Translation()
+    plt = get_pyplot()
+    tracker = load_session(folder).tracker
+    coords = tracker.get(*POSITION_COLUMNS)
+    tracker_coords = tracker.get(*TRACKER_COLUMNS)
+
+    (rot_matrix, translation), error = register_rigid(coords, tracker_coords)
     tracker_coords = (tracker_coords - translation).dot(rot_matrix)
     print("Rigid Registration Error: {}".format(error))
 
@@ -76,23 +76,13 @@ def show_tracker_point_cloud(data_file):
     plt.show()
 
 
-def show_palpation_point_cloud(data_file):
+@profiled("plotting")
+def show_palpation_point_cloud(folder):
     """Plots the palpation point cloud
-    from the csv file data_file"""
-
-    coords = np.array([])
-
-    with open(data_file, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            coord = np.array([
-                float(row["arm_position_x"]),
-                float(row["arm_position_y"]),
-                float(row["arm_position_z"])
-            ])
-            coords = np.append(coords, coord)
+    from the plane.csv file in `folder`"""
+    plt = get_pyplot()
 
-    coords = coords.reshape(-1, 3)
+    coords = load_session(folder).plane.get(*POSITION_COLUMNS)
 
     X, Y = np.meshgrid(
         np.arange(
@@ -123,6 +113,7 @@ def show_palpation_point_cloud(data_file):
     plt.show()
 
 
+@profiled("plane fit")
 def get_best_fit_plane(pts):
     """
     Gets the plane of best fit for `pts` along with the error
@@ -133,24 +124,34 @@ def get_best_fit_plane(pts):
     A = np.c_[pts[:, 0], pts[:, 1], np.ones(pts.shape[0])]
     (a, b, c), _, _, _ = scipy.linalg.lstsq(A, pts[:, 2])    # coefficients
 
-    errors = np.array([])
-
     direction = np.array([a, b, -1])
     normal = direction / np.linalg.norm(direction)
 
-    projections = np.array([])
+    # Distance of each point from the plane
+    errors = (pts - np.array([0, 0, c])).dot(normal)
+
+    return (a, b, c), np.sqrt(np.mean(errors ** 2))
+
+
+@profiled("plane fit")
+def get_best_fit_planes(pts):
+    """
+    Gets the planes of best fit for a stack of point clouds
+    along with their errors
+    :param np.ndarray pts The point clouds of shape (K, N, 3)
+    :returns tuple of (coefficients, errors) of shapes (K, 3) and (K,)
+    """
+    A = np.concatenate([pts[..., :2], np.ones(pts.shape[:-1] + (1,))],
+                       axis=-1)
+    # coefficients
+    coefs = np.matmul(np.linalg.pinv(A), pts[..., 2:])[..., 0]
 
-    for pt in pts:
-        dist = np.dot(normal, pt - np.array([0, 0, c]))
-        projection = pt - dist * normal
-        projections = np.append(projections, projection)
-        projections = projections.reshape(-1, 3)
-        errors = np.append(errors, dist)
-        # If this value is close to 0, then the distances are accurate
-        # print(A * projection[0] + B * projection[1] + c - projection[2])
+    # Distance of each point from its plane
+    residuals = np.matmul(A, coefs[..., np.newaxis])[..., 0] - pts[..., 2]
+    norms = np.sqrt(coefs[:, 0] ** 2 + coefs[:, 1] ** 2 + 1)
+    errors = np.sqrt(np.mean(residuals ** 2, axis=-1)) / norms
 
-    return (a, b, c), np.sqrt(sum([error ** 2 for error in errors]) /
-                              len(errors))
+    return coefs, errors
 
 
 def get_poly_min(pts, deg=2):
@@ -178,113 +179,195 @@ def get_min_value(pts):
     return min_x, min_y
 
 
-def get_offset_v_error(offset_v_error_filename, data_folders, tracker=False,
-                       show_graph=False):
-
-    rob = crp.robManipulator()
-    rob.LoadRobot(ROB_FILE)
-
-    joint_set = np.array([])
+def get_fk_clouds(rob, joint_set, offsets, linear=True):
+    """
+    Gets the forward kinematics point cloud of `joint_set` at every offset
+    :param kinematics.Manipulator rob The robot to run forward kinematics on
+    :param numpy.ndarray joint_set Joint positions of shape (points, 6)
+    :param numpy.ndarray offsets Offsets to joint 2 in tenths of a millimeter
+    :param bool linear Use the linearity of the prismatic joint 2 to run
+        forward kinematics once per point instead of once per point per offset
+    :returns Point clouds of shape (offsets, points, 3)
+    """
+    offsets = np.asarray(offsets, dtype=np.float64) / 10000
+    if linear:
+        positions, axes = rob.position_and_axis(joint_set, 2)
+        return (positions[np.newaxis]
+                + offsets[:, np.newaxis, np.newaxis] * axes[np.newaxis])
+    data = np.repeat(joint_set[np.newaxis], len(offsets), axis=0)
+    # Change 2nd joint by `offset`
+    data[:, :, 2] += offsets[:, np.newaxis]
+    return rob.positions(data)
+
+
+def get_offset_data(data_folders, tracker=False):
+    """
+    Gets the joint sets (and tracker point clouds if `tracker` is set)
+    of every folder in `data_folders`
+    :returns tuple of (joint_sets, tracker_coord_set)
+    """
     joint_sets = []
-    coords = np.array([])
-    coord_set = []
-
-    if tracker:
-        tracker_coords = np.array([])
-        tracker_coord_set = []
+    tracker_coord_set = []
 
     # Accepts n number of data_folders
-
-    # Loop through data_folders and put joint sets into `joint_sets` variable
-    # and coord set into `coord_set` variable
     for data_folder in data_folders:
+        session = load_session(data_folder)
         if tracker:
-            data_file = os.path.join(data_folder, "tracker_point_cloud.csv")
+            table = session.tracker
+            tracker_coord_set.append(table.get(*TRACKER_COLUMNS))
         else:
-            data_file = os.path.join(data_folder, "plane.csv")
-
-        with open(data_file) as infile:
-            reader = csv.DictReader(infile)
-            for row in reader:
-                joints = np.array([
-                    float(row["joint_{}_position".format(joint_num)])
-                    for joint_num in range(6)
-                ])
-                joint_set = np.append(joint_set, joints)
-                coord = np.array([
-                    float(row["arm_position_x"]),
-                    float(row["arm_position_y"]),
-                    float(row["arm_position_z"])
-                ])
-                coords = np.append(coords, coord)
-                if tracker:
-                    tracker_coord = np.array([
-                        float(row["tracker_position_x"]),
-                        float(row["tracker_position_y"]),
-                        float(row["tracker_position_z"])
-                    ])
-                    tracker_coords = np.append(tracker_coords, tracker_coord)
-
-        coords = coords.reshape(-1, 3)
-        coord_set.append(coords)
-
-        joint_set = joint_set.reshape(-1, 6)
-        joint_sets.append(joint_set)
+            table = session.plane
+        joint_sets.append(table.get(*JOINT_COLUMNS))
+
+    return joint_sets, tracker_coord_set
 
-        if tracker:
-            tracker_coords = tracker_coords.reshape(-1, 3)
-            tracker_coord_set.append(tracker_coords)
 
+@profiled("offset errors")
+def get_offset_errors(rob, joint_sets, tracker_coord_set, offsets,
+                      tracker=False, linear=True):
+    """
+    Gets the sum of the errors of all sets at each offset
+    :param numpy.ndarray offsets Offsets to joint 2 in tenths of a millimeter
+    :returns numpy.ndarray of errors, one for each offset
+    """
+    offsets = np.atleast_1d(offsets)
+    PROFILER.count("offsets evaluated", len(offsets))
+
+    # Run forward kinematics on every offset of every file at once
+    # Array of (offsets, points, 3) for each file
+    fk_clouds = [
+        get_fk_clouds(rob, joint_set, offsets, linear)
+        for joint_set in joint_sets
+    ]
+
+    errors = np.zeros(len(offsets))
+
+    # Get sum of errors of all files
+    if tracker:
+        # Use rigid registration of every offset at once
+        # if tracker is used
+        for fk_pts, coords_tracker in zip(fk_clouds, tracker_coord_set):
+            errors += register_rigid(fk_pts, coords_tracker)[1]
+    else:
+        # Use plane of best fit of every offset at once
+        # if palpation is used
+        for fk_pts in fk_clouds:
+            errors += get_best_fit_planes(fk_pts)[1]  # Returns equations, errs
+
+    return errors
+
+
+def get_linear_error_fn(kinematics_set, tracker_coord_set=None,
+                        tracker=False):
+    """
+    Gets a function that takes an array of offsets in tenths of a millimeter
+    and returns the sum of the errors of all sets at each offset, using the
+    linearity of joint 2
+    :param list kinematics_set Tuples of (positions, axes) for each set,
+        as returned by `kinematics.Manipulator.position_and_axis`
+    """
+    if tracker:
+        @profiled("offset errors")
+        def error_fn(offsets):
+            offsets = np.atleast_1d(offsets) / 10000
+            PROFILER.count("offsets evaluated", len(offsets))
+            errors = np.zeros(len(offsets))
+            for (positions, axes), coords_tracker in zip(kinematics_set,
+                                                         tracker_coord_set):
+                fk_pts = (positions[np.newaxis]
+                          + offsets[:, np.newaxis, np.newaxis]
+                          * axes[np.newaxis])
+                errors += register_rigid(fk_pts, coords_tracker)[1]
+            return errors
+
+        return error_fn
+
+    # Plane statistics give the error at any offset in O(1)
+    stats = []
+    for positions, axes in kinematics_set:
+        stat = PlaneStatistics()
+        stat.add(positions, axes)
+        stats.append(stat)
+
+    @profiled("offset errors")
+    def error_fn(offsets):
+        offsets = np.atleast_1d(offsets) / 10000
+        PROFILER.count("offsets evaluated", len(offsets))
+        return sum(stat.fit(offsets)[1] for stat in stats)
+
+    return error_fn
+
+
+def get_offset_error_fn(rob, data_folders, tracker=False, linear=True):
+    """
+    Gets a function that takes an array of offsets in tenths of a millimeter
+    and returns the sum of the errors of all folders at each offset
+    """
+    joint_sets, tracker_coord_set = get_offset_data(data_folders, tracker)
+
+    if linear:
+        kinematics_set = [
+            rob.position_and_axis(joint_set, 2)
+            for joint_set in joint_sets
+        ]
+        return get_linear_error_fn(kinematics_set, tracker_coord_set, tracker)
+
+    def error_fn(offsets):
+        return get_offset_errors(rob, joint_sets, tracker_coord_set, offsets,
+                                 tracker, linear)
+
+    return error_fn
+
+
+@profiled("sweep offsets")
+def sweep_offsets(error_fn, step=1):
+    """
+    Evaluates `error_fn` at every offset from -2cm to 2cm
+    :param float step Distance between offsets in tenths of a millimeter
+    :returns numpy.ndarray of [[offset0, error0], [offset1, error1], ...]
+    """
+    # -2cm to 2cm
+    # In tenths of a millimeter
+    offsets = np.arange(-200, 200, step)
+    return np.c_[offsets, error_fn(offsets)]
+
+
+def write_offset_v_error(offset_v_error_filename, offset_v_error):
     with open(offset_v_error_filename, 'w') as outfile:
         fk_plot = csv.DictWriter(outfile, fieldnames=["offset", "error"])
         fk_plot.writeheader()
-        offset_v_error = np.array([])
-
-        # -2cm to 2cm
-        # In tenths of a millimeter
-        for num, offset in enumerate(range(-200, 200, 1)):
-            fk_pt_set = []
-            # Go through each file's `joint_set` and `coords`
-            for joint_set, coords in zip(joint_sets, coord_set):
-                data = joint_set.copy()
-                fk_pts = np.array([])
-                for q in data:
-                    # Change 2nd joint by `offset` tenths of a millimeter
-                    q[2] += offset / 10000
-                    # Run forward kinematics on each point and get result
-                    fk_pts = np.append(fk_pts, rob.ForwardKinematics(q)[:3, 3])
-                fk_pts = fk_pts.reshape((-1, 3))
-                fk_pt_set.append(fk_pts)
-
-            # Get sum of errors of all files
-            if tracker:
-                # Use rigid registration if tracker is used
-                error = sum([
-                    # Get error of rigid registration
-                    nmrRegistrationRigid(coords_fk, coords_tracker)[1]
-                    for coords_fk, coords_tracker in zip(fk_pt_set,
-                                                         tracker_coord_set)
-                ])
-            else:
-                # import pudb; pudb.set_trace()  # XXX BREAKPOINT
-                # Use plane of best fit if palpation is used
-                error = sum([
-                    get_best_fit_plane(coords_fk)[1]  # Returns equation, err
-                    for coords_fk in fk_pt_set
-                ])
-
-            # Add new points
-            offset_v_error = np.append(offset_v_error,
-                                       np.array([offset, error]))
-
+        for offset, error in offset_v_error:
             # Write plots in tenths of millimeters
             fk_plot.writerow({"offset": offset, "error": error})
 
-    offset_v_error = offset_v_error.reshape(-1, 2)
+
+@profiled("plotting")
+def show_offset_v_error(offset_v_error):
+    plt = get_pyplot()
+    plt.plot(offset_v_error[:, 0], offset_v_error[:, 1])
+    plt.show()
+
+
+def get_offset_v_error(offset_v_error_filename, data_folders, tracker=False,
+                       show_graph=False, linear=True, step=1):
+    """
+    Gets the error of the plane of best fit (or of the rigid registration
+    if `tracker` is set) for offsets of joint 2 from -2cm to 2cm
+    :param str offset_v_error_filename File to write the errors to,
+        or None to not write them
+    :param float step Distance between offsets in tenths of a millimeter
+    :param bool linear See `get_fk_clouds`
+    """
+
+    rob = load_rob(ROB_FILE)
+    error_fn = get_offset_error_fn(rob, data_folders, tracker, linear)
+    offset_v_error = sweep_offsets(error_fn, step)
+
+    if offset_v_error_filename is not None:
+        write_offset_v_error(offset_v_error_filename, offset_v_error)
 
     if show_graph:
-        plt.plot(offset_v_error[:, 0], offset_v_error[:, 1])
-        plt.show()
+        show_offset_v_error(offset_v_error)
 
     # Convert from tenths of a millimeter to meters
     # offset_v_error[:, 0] /= 10000
@@ -292,10 +375,83 @@ def get_offset_v_error(offset_v_error_filename, data_folders, tracker=False,
     return offset_v_error
 
 
-def analyze_palpations(folder, show_palpations=False):
+@profiled("search offset")
+def minimize_offset(error_fn, tolerance=0.01, bounds=(-200, 200), ncoarse=21,
+                    max_expansions=4):
+    """
+    Finds the offset with the minimum error without sweeping every
+    offset: the minimum is bracketed on a coarse grid over `bounds`, which
+    is widened while the minimum sits on its edge, then refined with Brent's
+    method
+    :param float tolerance Tolerance of the offset in tenths of a millimeter
+    :param tuple bounds Initial range to search in tenths of a millimeter
+    :param int ncoarse Number of offsets in the coarse grid
+    :param int max_expansions Maximum number of times to widen `bounds`
+    :returns tuple of (offset, error)
+    """
+    low, high = bounds
+    for _ in range(max_expansions + 1):
+        offsets = np.linspace(low, high, ncoarse)
+        errors = error_fn(offsets)
+        min_idx = np.argmin(errors)
+        width = high - low
+        if min_idx == 0:
+            low -= width
+        elif min_idx == ncoarse - 1:
+            high += width
+        else:
+            break
+    else:
+        print("Minimum is at the edge of the search range {} to {}"
+              .format(offsets[0], offsets[-1]))
+        return offsets[min_idx], errors[min_idx]
+
+    result = scipy.optimize.minimize_scalar(
+        lambda offset: error_fn(offset)[0],
+        bounds=(offsets[min_idx - 1], offsets[min_idx + 1]),
+        method="bounded",
+        options={"xatol": tolerance}
+    )
+    return result.x, result.fun
+
+
+def search_offset(data_folders, tracker=False, linear=True, **kwargs):
+    """
+    Searches for the offset with the minimum error of `data_folders`
+    with `minimize_offset`, which takes the keyword arguments `kwargs`
+    :returns tuple of (offset, error)
+    """
+    rob = load_rob(ROB_FILE)
+    error_fn = get_offset_error_fn(rob, data_folders, tracker, linear)
+    return minimize_offset(error_fn, **kwargs)
+
+
+def read_palpation(folder, palpation_file):
+    """
+    Reads a palpation in the format
+    [[x0, y0, z0, wrench0, joint_0_0, ...], [x1, y1, z1, wrench1, ...], ...]
+    """
+    return load_session(folder).table(palpation_file).get(
+        *(POSITION_COLUMNS + ["wrench"] + JOINT_COLUMNS)
+    )
+
+
+def analyze_palpation_file(args):
+    """
+    Reads and analyzes the palpation `palpation_file` in `folder`, where
+    `args` is the tuple (folder, palpation_file) so that it can be passed
+    to `multiprocessing.Pool.map`
+    """
+    folder, palpation_file = args
+    return analyze_palpation(read_palpation(folder, palpation_file))
+
+
+@profiled("analyze palpations")
+def analyze_palpations(folder, show_palpations=False, jobs=1):
     """
     Analyze set of palpations with the option
     to show graph of palpations
+    :param int jobs Number of processes to analyze the palpations with
     """
     data = []
 
@@ -303,87 +459,86 @@ def analyze_palpations(folder, show_palpations=False):
         print("There must be a folder at {}".format(folder))
         sys.exit(1)
 
+    session = load_session(folder)
+
     # Ignore non-palpation files, e. g. offset_v_error.csv or plane.csv
-    palpation_files = sorted(np.array([
-        f
-        for f in os.listdir(folder)
-        if f.startswith("palpation")
-    ]))
+    palpation_files = session.palpation_files
+
+    # Palpations are independent, so analyze them in parallel
+    # `map` returns the results in the order of `palpation_files`
+    palpation_args = [(folder, f) for f in palpation_files]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = [
+                merge_task(output) for output in pool.map(
+                    profile_task,
+                    profile_tasks(analyze_palpation_file, palpation_args)
+                )
+            ]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [analyze_palpation_file(arg) for arg in palpation_args]
+
+    for palpation_file, (pos, joints) in zip(palpation_files, results):
+        if pos is None:
+            warnings.warn("Didn't get enough data in {}; "
+                          "disregarding point and continuing to next"
+                          .format(palpation_file), RuntimeWarning)
+            continue
+
+        data_dict = {
+            "arm_position_x": pos[0],
+            "arm_position_y": pos[1],
+            "arm_position_z": pos[2],
+        }
+
+        for joint_num, joint_pos in enumerate(joints):
+            data_dict.update({
+                "joint_{}_position".format(joint_num): joint_pos
+            })
+
+        data.append(copy(data_dict))
+
+    if show_palpations:
+        show_palpation_grid(folder)
 
-    dim = int(len(palpation_files) ** (1/2))
+    # Output contents of `data` to csv
+    with open(os.path.join(folder, "plane.csv"), 'w') as outfile:
+        csvfile = csv.DictWriter(outfile, fieldnames=data[0].keys())
+        csvfile.writeheader()
+        csvfile.writerows(data)
 
-    palpation_files = palpation_files.reshape(dim, dim)
+
+@profiled("plotting")
+def show_palpation_grid(folder):
+    """Plots every palpation in `folder`, one row of the grid at a time"""
+    plt = get_pyplot()
+    palpation_files = load_session(folder).palpation_files
+    dim = int(len(palpation_files) ** (1/2))
 
     # Generate m x n grid of plots of palpations
-    palpation_files.sort()
+    palpation_grid = np.array(palpation_files).reshape(dim, dim)
 
     row_len = (dim + 1) // 2
 
-    for row_idx, row in enumerate(palpation_files):
-
-        if show_palpations:
-            fig, ax = plt.subplots(2, row_len)
+    for row in palpation_grid:
+        fig, ax = plt.subplots(2, row_len)
 
         for col_idx, palpation_file in enumerate(row):
+            # Subplot row and column
+            sp_row = col_idx // row_len
+            sp_col = col_idx % row_len
 
-            with open(os.path.join(folder, palpation_file)) as infile:
-                reader = csv.DictReader(infile)
-                pos_v_wrench = []
-                for row in reader:
-                    joints = [
-                        float(row["joint_{}_position".format(i)])
-                        for i in range(6)
-                    ]
-
-                    pos_v_wrench.append((
-                        [
-                            float(row["arm_position_x"]),
-                            float(row["arm_position_y"]),
-                            float(row["arm_position_z"]),
-                            float(row["wrench"])
-                        ]
-                        + joints
-                    ))
-
-                if show_palpations:
-                    # Subplot row and column
-                    sp_row = col_idx // row_len
-                    sp_col = col_idx % row_len
-
-                    pos, joints = analyze_palpation(pos_v_wrench,
-                                                    ax=ax[sp_row, sp_col])
-
-                pos, joints = analyze_palpation(pos_v_wrench,
-                                                ax=None)
-
-                if pos is None:
-                    rospy.logwarn("Didn't get enough data;"
-                                  "disregarding point and continuing to next")
-                    continue
-
-                data_dict = {
-                    "arm_position_x": pos[0],
-                    "arm_position_y": pos[1],
-                    "arm_position_z": pos[2],
-                }
-
-                for joint_num, joint_pos in enumerate(joints):
-                    data_dict.update({
-                        "joint_{}_position".format(joint_num): joint_pos
-                    })
-
-                data.append(copy(data_dict))
-
-        if show_palpations:
-            plt.show()
+            analyze_palpation(read_palpation(folder, palpation_file),
+                              ax=ax[sp_row, sp_col])
 
-    # Output contents of `data` to csv
-    with open(os.path.join(folder, "plane.csv"), 'w') as outfile:
-        csvfile = csv.DictWriter(outfile, fieldnames=data[0].keys())
-        csvfile.writeheader()
-        csvfile.writerows(data)
+        plt.show()
 
 
+@profiled("palpation segmentation")
 def analyze_palpation(pos_v_wrench, ax=None):
     """
     Analyze palpation with the option to show graph
@@ -417,7 +572,7 @@ def analyze_palpation(pos_v_wrench, ax=None):
     data_contact = np.array(data_contact)
 
     if len(data_moving) == 0 or len(data_contact) == 0:
-        return None
+        return None, None
     # Generate line of best fit for period during contact
     contact_eqn = np.polyfit(data_contact[:, 0], data_contact[:, 1], 1)
 
@@ -520,6 +675,7 @@ def analyze_palpation_threshold(
     # Plot z vs wrench onto a window, image, or both
     if show_graph:
         # Plot z vs wrench
+        plt = get_pyplot()
         plt.plot(pos_v_wrench[:, 2], pos_v_wrench[:, 3], '-', color="red")
 
         # Plot point at threshold
@@ -0,0 +1,122 @@
+from __future__ import division, print_function
+import time
+import collections
+import numpy as np
+import rospy
+from geometry_msgs.msg import PoseStamped, WrenchStamped
+from sensor_msgs.msg import JointState
+from ring_buffer import StateRingBuffer
+
+
+# State of the arm at one time, or at several times if the fields are
+# stacked. Orientations are quaternions in the order x, y, z, w
+ArmState = collections.namedtuple(
+    "ArmState", ["time", "position", "orientation", "wrench", "joints"]
+)
+
+
+class ArmStateRecorder(object):
+    """
+    Subscribes to the state topics of a dVRK arm and keeps their samples in
+    ring buffers, so recording code can get the position, wrench and joints
+    at the same time without polling each of them
+    """
+
+    NJOINTS = 6
+
+    def __init__(self, arm_name, size=10000):
+        """
+        :param str arm_name Name of the arm, e. g. PSM1
+        :param int size Number of samples kept for each topic
+        """
+        namespace = "/dvrk/{}/".format(arm_name)
+        # x, y, z, qx, qy, qz, qw
+        self.pose = StateRingBuffer(7, size)
+        # fx, fy, fz, tx, ty, tz
+        self.wrench = StateRingBuffer(6, size)
+        self.joints = StateRingBuffer(self.NJOINTS, size)
+        self.subscribers = [
+            rospy.Subscriber(namespace + "position_cartesian_current",
+                             PoseStamped, self.pose_callback),
+            rospy.Subscriber(namespace + "wrench_body_current",
+                             WrenchStamped, self.wrench_callback),
+            rospy.Subscriber(namespace + "state_joint_current",
+                             JointState, self.joints_callback),
+        ]
+
+    @staticmethod
+    def stamp(msg):
+        # Some versions of the dVRK don't fill in the header
+        return msg.header.stamp.to_sec() or rospy.get_time()
+
+    def pose_callback(self, msg):
+        p, q = msg.pose.position, msg.pose.orientation
+        self.pose.append(self.stamp(msg), [p.x, p.y, p.z, q.x, q.y, q.z, q.w])
+
+    def wrench_callback(self, msg):
+        f, t = msg.wrench.force, msg.wrench.torque
+        self.wrench.append(self.stamp(msg), [f.x, f.y, f.z, t.x, t.y, t.z])
+
+    def joints_callback(self, msg):
+        self.joints.append(self.stamp(msg), msg.position[:self.NJOINTS])
+
+    @property
+    def buffers(self):
+        return [self.pose, self.wrench, self.joints]
+
+    def latest_time(self):
+        """Gets the newest time that every topic has a sample for,
+        or None if a topic has no samples yet"""
+        latest = [buf.latest() for buf in self.buffers]
+        if any(sample is None for sample in latest):
+            return None
+        return min(sample[0] for sample in latest)
+
+    def state_at(self, times):
+        """
+        Gets the state of the arm at `times`, interpolating each topic
+        between its samples
+        :rtype ArmState
+        """
+        pose = self.pose.interpolate(times)
+        orientation = pose[..., 3:]
+        orientation = (orientation
+                       / np.linalg.norm(orientation, axis=-1)[..., np.newaxis])
+        return ArmState(times, pose[..., :3], orientation,
+                        self.wrench.interpolate(times),
+                        self.joints.interpolate(times))
+
+    def snapshot(self, after=None, timeout=1.0):
+        """
+        Gets the state of the arm at the newest time that every topic
+        has a sample for
+        :param float after Wait until every topic has a sample newer than
+            this time in seconds
+        :param float timeout Maximum time to wait in seconds
+        :rtype ArmState
+        :raises RuntimeError if no samples arrive in time
+        """
+        deadline = time.time() + timeout
+        while True:
+            latest = self.latest_time()
+            if latest is not None and (after is None or latest > after):
+                return self.state_at(latest)
+            if time.time() > deadline or rospy.is_shutdown():
+                raise RuntimeError("No arm state received in {}s"
+                                   .format(timeout))
+            time.sleep(0.001)
+
+    def window(self, start, end=None):
+        """
+        Gets the state of the arm at every joint sample between
+        `start` and `end`
+        :param float end End of the window in seconds, or None for the
+            newest sample
+        :rtype ArmState with fields stacked along the first axis
+        """
+        times, _ = self.joints.window(start, end)
+        return self.state_at(times)
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.unregister()
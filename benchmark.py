@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import timeit
+import shutil
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 doesn't have tracemalloc, so peak memory isn't measured
+    tracemalloc = None
+import analyze
+from analyze import (analyze_palpation, analyze_palpations,
+                     get_best_fit_plane, get_offset_error_fn,
+                     get_offset_v_error, read_palpation)
+from kinematics import load_rob
+from session import (find_sessions, load_session, read_table, Session,
+                     JOINT_COLUMNS, POSITION_COLUMNS)
+
+
+# Results of earlier runs, kept out of the repository with the other
+# cached files
+HISTORY_FILE = os.path.join(".cache", "benchmark_history.json")
+
+# A benchmark regresses when it is more than REGRESSION_THRESHOLD slower, or
+# uses that much more memory, than its best result in the last
+# HISTORY_WINDOW runs
+REGRESSION_THRESHOLD = 0.2
+HISTORY_WINDOW = 5
+
+# Maximum relative difference from the errors in offset_v_error.csv
+ERROR_RTOL = 1e-3
+# Maximum difference from the contact points in plane.csv,
+# in meters for the positions and radians or meters for the joints
+PLANE_ATOL = 1e-6
+
+PALPATION_COLUMNS = POSITION_COLUMNS + ["wrench"] + JOINT_COLUMNS
+
+
+class Sessions(object):
+    """
+    The sessions under a data folder, sorted by what can be run on them.
+    Files in formats that can't be read anymore, e. g. a plane.csv of
+    arrays or an offset_v_error.csv without a header written by an early
+    version, are left out
+    """
+
+    def __init__(self, data_root):
+        self.folders = find_sessions(data_root)
+        self.csv_files = []
+        self.unreadable = []
+        # Sessions with palpations in the current format
+        self.palpations = []
+        self.planes = []
+        self.offset_v_errors = []
+        for folder in self.folders:
+            session = load_session(folder)
+            readable = set()
+            for name in sorted(os.listdir(folder)):
+                if not name.endswith(".csv"):
+                    continue
+                try:
+                    session.table(name)
+                except ValueError:
+                    self.unreadable.append(os.path.join(folder, name))
+                    continue
+                readable.add(name)
+                self.csv_files.append(os.path.join(folder, name))
+            files = session.palpation_files
+            if (files and readable.issuperset(files)
+                    and session.table(files[0]).has(*PALPATION_COLUMNS)):
+                self.palpations.append(folder)
+            if ("plane.csv" in readable and session.plane.has(
+                    *(POSITION_COLUMNS + JOINT_COLUMNS))):
+                self.planes.append(folder)
+            # The curve is computed from plane.csv or the tracker
+            # point cloud
+            if ("offset_v_error.csv" in readable
+                    and session.table("offset_v_error.csv").has("offset",
+                                                                "error")
+                    and (session.is_tracker or folder in self.planes)):
+                self.offset_v_errors.append(folder)
+
+
+def get_benchmarks(sessions, scratch):
+    """
+    Gets the functions to time, each running one stage of the analysis
+    on every session it applies to
+    :param Sessions sessions
+    :param str scratch Folder to copy sessions to, since
+        `analyze_palpations` writes plane.csv
+    :returns list of tuples of (name, function)
+    """
+    palpations = [
+        read_palpation(folder, name)
+        for folder in sessions.palpations
+        for name in load_session(folder).palpation_files
+    ]
+    planes = [
+        load_session(folder).plane.get(*POSITION_COLUMNS)
+        for folder in sessions.planes
+    ]
+    copies = []
+    for folder in sessions.palpations:
+        copy = os.path.join(scratch, os.path.basename(folder))
+        shutil.copytree(folder, copy)
+        copies.append(copy)
+
+    def read_tables():
+        for filename in sessions.csv_files:
+            read_table(filename)
+
+    def load_tables():
+        # A new Session doesn't reuse the tables read before
+        sessions_read = {}
+        for filename in sessions.csv_files:
+            folder, name = os.path.split(filename)
+            if folder not in sessions_read:
+                sessions_read[folder] = Session(folder)
+            sessions_read[folder].table(name)
+
+    def run_analyze_palpation():
+        for pos_v_wrench in palpations:
+            analyze_palpation(pos_v_wrench)
+
+    def run_analyze_palpations():
+        for folder in copies:
+            analyze_palpations(folder)
+
+    def run_get_best_fit_plane():
+        for pts in planes:
+            get_best_fit_plane(pts)
+
+    def run_get_offset_v_error():
+        for folder in sessions.offset_v_errors:
+            get_offset_v_error(None, [folder],
+                               tracker=load_session(folder).is_tracker)
+
+    return [
+        ("read_table", read_tables),
+        ("Session.table", load_tables),
+        ("analyze_palpation", run_analyze_palpation),
+        ("analyze_palpations", run_analyze_palpations),
+        ("get_best_fit_plane", run_get_best_fit_plane),
+        ("get_offset_v_error", run_get_offset_v_error),
+    ]
+
+
+def measure(fn, repeat=3):
+    """
+    Times `fn` and measures its peak memory
+    :returns dict of the best time of `repeat` runs in seconds, and the peak
+        memory allocated by a separate run in bytes, or None without
+        tracemalloc
+    """
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+
+    peak_memory = None
+    if tracemalloc is not None:
+        # Tracing slows down allocations, so it isn't timed
+        tracemalloc.start()
+        try:
+            fn()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"time": min(times), "peak_memory": peak_memory}
+
+
+def check_offset_v_error(rob, folder, linear=True):
+    """
+    Recomputes the errors at the offsets in offset_v_error.csv
+    :returns the maximum difference from the stored errors,
+        relative to the stored errors
+    """
+    session = load_session(folder)
+    stored = session.table("offset_v_error.csv").get("offset", "error")
+    offsets = stored[:, 0]
+    if np.max(np.abs(offsets)) <= 20:
+        # Early versions swept from -2cm to 2cm in millimeters
+        offsets = offsets * 10
+    error_fn = get_offset_error_fn(rob, [folder], session.is_tracker, linear)
+    errors = error_fn(offsets)
+    return np.max(np.abs(errors - stored[:, 1]) / np.abs(stored[:, 1]))
+
+
+def check_plane(folder):
+    """
+    Recomputes the contact points of the palpations in plane.csv
+    :returns the maximum difference from the stored positions and joints,
+        or infinity if the number of contact points differs
+    """
+    session = load_session(folder)
+    stored = session.plane.get(*(POSITION_COLUMNS + JOINT_COLUMNS))
+    contacts = []
+    for name in session.palpation_files:
+        pos, joints = analyze_palpation(read_palpation(folder, name))
+        if pos is not None:
+            contacts.append(np.r_[pos, joints])
+    if len(contacts) != len(stored):
+        return np.inf
+    # The rows of plane.csv aren't always in the order of the palpations
+    diffs = np.abs(np.array(contacts)[:, np.newaxis] - stored[np.newaxis])
+    return diffs.max(axis=-1).min(axis=1).max()
+
+
+def check_conformance(rob, sessions):
+    """
+    Checks that the analysis reproduces the offset_v_error.csv (with the
+    linear and full forward kinematics sweeps) and plane.csv stored in
+    every session
+    :returns dict of the name of each check to a tuple of
+        (difference, whether it is within the tolerance)
+    """
+    checks = {}
+    for folder in sessions.offset_v_errors:
+        name = os.path.basename(folder)
+        for linear, engine in [(True, "linear"), (False, "fk-sweep")]:
+            diff = check_offset_v_error(rob, folder, linear)
+            checks["offset_v_error/{}/{}".format(engine, name)] = (
+                diff, bool(diff <= ERROR_RTOL)
+            )
+    for folder in sessions.planes:
+        if folder in sessions.palpations:
+            diff = check_plane(folder)
+            checks["plane/{}".format(os.path.basename(folder))] = (
+                diff, bool(diff <= PLANE_ATOL)
+            )
+    return checks
+
+
+def find_regressions(history, results, conformance):
+    """
+    Compares a run to the earlier runs in `history`
+    :param dict results Measurements of each benchmark
+    :param dict conformance Whether each conformance check passed
+    :returns list of messages, one for each regression
+    """
+    regressions = []
+    recent = history[-HISTORY_WINDOW:]
+    for name, result in sorted(results.items()):
+        for key in ["time", "peak_memory"]:
+            previous = [
+                run["results"][name][key]
+                for run in recent
+                if name in run["results"]
+                and run["results"][name][key] is not None
+            ]
+            if result[key] is None or not previous:
+                continue
+            best = min(previous)
+            if result[key] > best * (1 + REGRESSION_THRESHOLD):
+                regressions.append("{} {}: {:.4g} (best {:.4g})"
+                                   .format(name, key, result[key], best))
+    # The offset sweeps must always reproduce offset_v_error.csv, but
+    # checks of plane.csv that already failed, e. g. on a plane.csv written
+    # by an earlier version of the analysis, only regress if they passed
+    # before
+    passed = history[-1]["conformance"] if history else {}
+    for name, ok in sorted(conformance.items()):
+        if ok:
+            continue
+        if name.startswith("offset_v_error/"):
+            regressions.append("{} doesn't conform".format(name))
+        elif passed.get(name):
+            regressions.append("{} no longer conforms".format(name))
+    return regressions
+
+
+def get_commit():
+    """Gets the current git commit, or None outside of a repository"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=devnull
+            ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_memory(nbytes):
+    if nbytes is None:
+        return "-"
+    return "{:.1f}MB".format(nbytes / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analysis and check it against the "
+        "results stored in each session"
+    )
+    parser.add_argument(
+        "data_root",
+        help="folder to search for sessions in",
+        nargs='?',
+        default="data"
+    )
+    parser.add_argument(
+        "--history",
+        help="json file of the results of earlier runs",
+        default=HISTORY_FILE
+    )
+    parser.add_argument(
+        "--repeat",
+        help="number of times to run each benchmark",
+        default=3,
+        type=int
+    )
+    parser.add_argument(
+        "--rob-file",
+        help="kinematics to analyze with, instead of ROB_FILE"
+    )
+    parser.add_argument(
+        "--no-save",
+        help="don't add the results to the history",
+        default=False,
+        action="store_true"
+    )
+    args = parser.parse_args()
+
+    if args.rob_file is not None:
+        analyze.ROB_FILE = args.rob_file
+    rob = load_rob(analyze.ROB_FILE)
+
+    sessions = Sessions(args.data_root)
+    print("Found {} sessions in {}".format(len(sessions.folders),
+                                            args.data_root))
+    if sessions.unreadable:
+        print("Skipping {} files in old formats".format(
+            len(sessions.unreadable)
+        ))
+
+    results = {}
+    scratch = tempfile.mkdtemp()
+    try:
+        for name, fn in get_benchmarks(sessions, scratch):
+            results[name] = measure(fn, args.repeat)
+            print("{:<20} {:>10.4f}s {:>10}".format(
+                name, results[name]["time"],
+                format_memory(results[name]["peak_memory"])
+            ))
+    finally:
+        shutil.rmtree(scratch)
+
+    checks = check_conformance(rob, sessions)
+    failed = sorted(name for name, (_, ok) in checks.items() if not ok)
+    print("{} of {} conformance checks passed"
+          .format(len(checks) - len(failed), len(checks)))
+    for name in failed:
+        print("{}: differs by {:.4g}".format(name, checks[name][0]))
+    conformance = {name: ok for name, (_, ok) in checks.items()}
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as infile:
+            history = json.load(infile)
+    regressions = find_regressions(history, results, conformance)
+    for regression in regressions:
+        print("Regression: {}".format(regression))
+
+    if not args.no_save:
+        history.append({
+            "date": time.strftime("%Y-%m-%d_%H-%M-%S"),
+            "commit": get_commit(),
+            "python": sys.version.split()[0],
+            "results": results,
+            "conformance": conformance,
+        })
+        folder = os.path.dirname(args.history)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(args.history, 'w') as outfile:
+            json.dump(history, outfile, indent=2, sort_keys=True)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
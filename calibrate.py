@@ -2,14 +2,19 @@
 
 from __future__ import print_function, division
 import sys
+import csv
 import os.path
 from copy import copy
 import time
 import argparse
+import multiprocessing
 import xml.etree.ElementTree as ET
-import rospy
-from analyze import (get_offset_v_error, get_min_value, analyze_palpations,
+from analyze import (show_offset_v_error, show_palpation_grid,
                      show_tracker_point_cloud, show_palpation_point_cloud)
+from pipeline import analyze_session, analyze_sessions
+from profiler import PROFILER, profile_task, profile_tasks, merge_task
+from session import find_sessions, has_current_format
+from trajectory import estimate_duration, order_joint_set
 
 
 def parse_info(filename):
@@ -33,110 +38,308 @@ def parse_info(filename):
             raise IOError(2, "No such file or directory", filename)
 
 
+def format_duration(duration):
+    return "{}m {}s".format(int(duration) // 60, int(duration % 60))
+
+
+def record_tracker(recording, args):
+    """Records the tracker poses of a `TrackerRecording`"""
+    joint_set = list(recording.gen_wide_joint_positions())
+    if args.tracker_volume is not None:
+        tracker_bounds = (args.tracker_volume[:3], args.tracker_volume[3:])
+    else:
+        tracker_bounds = None
+    joint_set = recording.prescreen(joint_set, args.tracker_reference,
+                                    tracker_bounds)
+    start = recording.arm.get_current_joint_position()
+    duration = estimate_duration(joint_set, start)
+    if not args.no_reorder:
+        print("Estimated time moving in the generated order: {}"
+              .format(format_duration(duration)))
+        joint_set, duration = order_joint_set(joint_set, start)
+    print("Estimated time moving between the {} poses: {}"
+          .format(len(joint_set), format_duration(duration)))
+    print("Starting recording")
+    recording.sleep(0.5)
+    if args.continuous:
+        recording.record_continuous(joint_set, verbose=args.verbose)
+    else:
+        recording.record_joints(joint_set, verbose=args.verbose)
+    recording.output_to_csv()
+    recording.output_info()
+
+
+def record_plane(recording, pts, args):
+    """Palpates the grid of a `PlaneRecording` between the corners `pts`"""
+    goal = copy(pts[2])
+    goal.p[2] += 0.10
+    recording.arm.move(goal)
+    goal = copy(pts[0])
+    recording.arm.home()
+    goal.p[2] += 0.090
+    recording.arm.move(goal)
+    goal.p[2] -= 0.085
+    recording.arm.move(goal)
+    recording.record_points(pts, args.samples,
+                            verbose=args.verbose, live=args.live,
+                            continuous=args.continuous,
+                            predict=not args.no_prediction)
+    recording.output_info()
+
+
 def parse_record(args):
     for i in range(args.number):
         if args.tracker is not None:
             from tracker_recording import TrackerRecording
-            recording = TrackerRecording(args.arm, args.tracker)
-            joint_set = list(recording.gen_wide_joint_positions())
-            print("Starting recording")
-            time.sleep(0.5)
-            recording.record_joints(joint_set, verbose=args.verbose)
-            recording.output_to_csv()
-            recording.output_info()
+            recording = TrackerRecording(
+                args.arm, args.tracker,
+                settle_tolerance=args.settle_tolerance / 1000
+            )
+            record_tracker(recording, args)
             print("run `./calibrate.py analyze {}`\n"
                 "    to analyze the recorded data points."
                 .format(recording.folder))
         else:
+            import rospy
             from plane_recording import PlaneRecording
 
             if not args.single_palpation:
                 # Full plane palpation
-                recording = PlaneRecording(args.arm)
+                recording = PlaneRecording(
+                    args.arm, sample_spacing=args.sample_spacing / 1000
+                )
                 pts = recording.get_corners()
-                goal = copy(pts[2])
-                goal.p[2] += 0.10
-                recording.arm.move(goal)
-                goal = copy(pts[0])
-                recording.arm.home()
-                goal.p[2] += 0.090
-                recording.arm.move(goal)
-                goal.p[2] -= 0.085
-                recording.arm.move(goal)
-                recording.record_points(pts, args.samples, verbose=args.verbose)
+                record_plane(recording, pts, args)
                 print(("Run `./calibrate.py analyze {}`\n"
                     "to analyze the recorded data points")
                     .format(recording.folder))
-                recording.output_info()
             else:
                 # Single palpation
-                recording = PlaneRecording(args.arm)
+                recording = PlaneRecording(
+                    args.arm, sample_spacing=args.sample_spacing / 1000
+                )
                 print(("Position the arm at the point you want to palpate at,"
                     "then press enter."),
                     end=' ')
-                sys.stdin.readline()
+                with PROFILER.stage("waiting for input"):
+                    sys.stdin.readline()
                 goal = recording.arm.get_current_position()
                 goal.p[2] += 0.05
                 recording.arm.move(goal)
                 goal.p[2] -= 0.045
                 recording.arm.move(goal)
                 palp_fn = os.path.join(recording.folder, "single_palpation.csv")
-                pos_v_wrench = recording.palpate(palp_fn)
+                if args.continuous:
+                    pos_v_wrench = recording.palpate_continuous(palp_fn)
+                else:
+                    pos_v_wrench = recording.palpate(palp_fn)
                 if not pos_v_wrench:
                     rospy.logerr("Didn't reach surface; closing program")
                     sys.exit(1)
                 arm_position_z = recording.analyze_palpation(pos_v_wrench,
                                                             show_graph=True)
                 print("Using {}".format(arm_position_z))
+    return recording.folder
+
+
+def parse_simulate(args):
+    import PyKDL
+    import analyze
+    from kinematics import load_rob
+    from simulation import (SimulatedClock, SimulatedArmState, SimulatedArm,
+                            SimulatedSurface, SimulatedMarker)
+    if args.rob_file is not None:
+        # Also used by the recordings and the analysis
+        analyze.ROB_FILE = args.rob_file
+    rob = load_rob(analyze.ROB_FILE)
+    clock = SimulatedClock()
+    state = SimulatedArmState(clock)
+    # Convert from millimeters to meters
+    offset = args.offset / 1000
+
+    if args.kind == "tracker":
+        from tracker_recording import TrackerRecording
+        arm = SimulatedArm(rob, clock, state, offset=offset)
+        marker = SimulatedMarker.from_session(args.replay_folder, arm, clock)
+        recording = TrackerRecording(
+            "SIM", None, marker=marker,
+            settle_tolerance=args.settle_tolerance / 1000, arm=arm,
+            state=state, clock=clock
+        )
+        record_tracker(recording, args)
+    else:
+        from plane_recording import PlaneRecording
+        surface = SimulatedSurface.from_session(args.replay_folder)
+        arm = SimulatedArm(rob, clock, state, surface, offset)
+        recording = PlaneRecording(
+            "SIM", sample_spacing=args.sample_spacing / 1000, arm=arm,
+            state=state, clock=clock
+        )
+        # Palpate the area of the replayed palpations
+        low, high = surface.bounds()
+        corners = [(low[0], low[1]), (high[0], low[1]), (high[0], high[1])]
+        pts = [
+            PyKDL.Frame(recording.ROT_MATRIX,
+                        PyKDL.Vector(x, y, surface.height(x, y)))
+            for x, y in corners
+        ]
+        record_plane(recording, pts, args)
+
+    print("Simulated {} of recording in {:.2f}s with {} moves"
+          .format(format_duration(clock.now()), clock.wall_time, arm.nmoves))
+    print("run `./calibrate.py analyze {}`\n"
+          "    to analyze the simulated data points."
+          .format(recording.folder))
+    return recording.folder
+
+
+def parse_pack(args):
+    from session import pack_session
+    for folder in args.data_folder:
+        index = pack_session(folder)
+        print("Packed {} tables in {}".format(len(index), folder))
+
+
+def parse_telemetry(args):
+    from telemetry import (read_telemetry, summarize, print_summary,
+                           TELEMETRY_FILE)
+    for folder in args.data_folder:
+        filename = os.path.join(folder, TELEMETRY_FILE)
+        if not os.path.exists(filename):
+            print("Error: {} has no telemetry".format(folder))
+            continue
+        print(folder)
+        names, records = read_telemetry(filename)
+        print_summary(summarize(names, records),
+                      histograms=not args.no_histograms)
+
+
+SUMMARY_FIELDS = ["folder", "tracker", "points", "offset", "error", "time",
+                  "status"]
+
+
+def analyze_session_safely(kwargs):
+    """
+    Runs `analyze_session` with the keyword arguments `kwargs`,
+    returning the error as the status instead of raising it
+    """
+    start_time = time.time()
+    try:
+        result = analyze_session(**kwargs)
+        result["status"] = "ok"
+    except Exception as e:
+        result = {
+            "folder": kwargs["folder"],
+            "time": time.time() - start_time,
+            "status": "{}: {}".format(type(e).__name__, e),
+        }
+    return result
+
+
+def parse_analyze_all(args):
+    folders = find_sessions(args.data_root)
+    print("Found {} sessions in {}".format(len(folders), args.data_root))
+    old_folders = [folder for folder in folders
+                   if not has_current_format(folder)]
+    if old_folders:
+        print("Skipping {} sessions in old formats".format(len(old_folders)))
+        folders = [folder for folder in folders
+                   if folder not in old_folders]
+
+    session_args = [
+        {
+            "folder": folder,
+            "linear": not args.fk_sweep,
+            "step": args.offset_step,
+            "search": args.search,
+            "tolerance": args.tolerance,
+            "reanalyze_palpations": args.reanalyze_palpations,
+            "write_offset_v_error": args.write_offset_v_error,
+            "use_cache": not args.no_cache,
+        }
+        for folder in folders
+    ]
+
+    start_time = time.time()
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        with open(args.output, 'w') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            # Results are written in the order of `folders`
+            # as soon as they are ready
+            with PROFILER.stage("analyze sessions"):
+                outputs = pool.imap(
+                    profile_task,
+                    profile_tasks(analyze_session_safely, session_args)
+                )
+                for output in outputs:
+                    result = merge_task(output)
+                    writer.writerow(result)
+                    if result["status"] == "ok":
+                        print("{folder}: {offset:.4f}mm (error {error:.6g}, "
+                              "{time:.2f}s)".format(**result))
+                    else:
+                        print("{folder}: {status}".format(**result))
+    finally:
+        pool.close()
+        pool.join()
+
+    print("Analyzed {} sessions in {:.2f}s; wrote summary to {}"
+          .format(len(folders), time.time() - start_time, args.output))
+    return args.data_root
 
 
 def parse_analyze(args):
-    # For now only uses one set of data
-    folder = os.path.dirname(args.data_folder[0])
+    folders = [os.path.normpath(folder) for folder in args.data_folder]
 
-    info = parse_info(os.path.join(folder, "info.txt"))
+    # The config file of the first session is written to
+    info = parse_info(os.path.join(folders[0], "info.txt"))
 
-    if info["tracker"] == "True":
-        is_tracker = True
-    elif info["tracker"] == "False":
-        is_tracker = False
+    view_offset_error = args.view_offset_error or args.view_all
 
-    if is_tracker:
+    pipeline_args = {
+        "linear": not args.fk_sweep,
+        "step": args.offset_step,
+        "jobs": args.jobs,
+        "use_cache": not args.no_cache,
+    }
+    report, offset_v_error = analyze_sessions(
+        folders, search=args.search, tolerance=args.tolerance,
+        **pipeline_args
+    )
+
+    if report["tracker"]:
         print("Using external tracker calibration...")
-        if args.view_point_cloud or args.view_all:
-            show_tracker_point_cloud(os.path.join(
-                folder,
-                "tracker_point_cloud.csv"
-            ))
     else:
         print("Using calibration sans external sensors...")
-        analyze_palpations(
-            folder, show_palpations=args.view_palpations or args.view_all
-        )
-        if args.view_point_cloud or args.view_all:
-            show_palpation_point_cloud(os.path.join(
-                folder,
-                "plane.csv"
-            ))
-
-    offset_v_error_filename = os.path.join(folder, "offset_v_error.csv")
+    print("Analyzed {} sessions ({} reused from the cache)"
+          .format(report["sessions"], report["sessions"] - report["computed"]))
 
-    offset_v_error = get_offset_v_error(
-        offset_v_error_filename,
-        args.data_folder, is_tracker,
-        args.view_offset_error or args.view_all
-    )
+    for folder in folders:
+        if report["tracker"]:
+            if args.view_point_cloud or args.view_all:
+                show_tracker_point_cloud(folder)
+        else:
+            if args.view_palpations or args.view_all:
+                show_palpation_grid(folder)
+            if args.view_point_cloud or args.view_all:
+                show_palpation_point_cloud(folder)
 
-    # Get offset correction in tenths of millimeter
-    # by getting x value of the abs. minimum of the graph
-    offset_correction = get_min_value(offset_v_error)[0]
+    if view_offset_error:
+        if offset_v_error is None:
+            # Searching doesn't evaluate every offset,
+            # so sweep to get the full graph
+            offset_v_error = analyze_sessions(folders, **pipeline_args)[1]
+        show_offset_v_error(offset_v_error)
 
-    # Convert correction from tenths of millimeter to milimeter
-    offset_correction /= 10
+    # Offset correction in millimeters
+    offset_correction = report["offset"]
 
     print("Offset correction: {}mm".format(offset_correction))
     print("Write to config file? (y/N) ", end=' ')
-    write_to_file_input = sys.stdin.readline().strip().lower()
+    with PROFILER.stage("waiting for input"):
+        write_to_file_input = sys.stdin.readline().strip().lower()
 
     if write_to_file_input == 'y':
         if os.path.exists(info["Config File"]):
@@ -163,6 +366,7 @@ def parse_analyze(args):
         else:
             print("Error: File does not exist")
             sys.exit(1)
+    return folders[0]
 
 
 if __name__ == "__main__":
@@ -171,6 +375,12 @@ if __name__ == "__main__":
         "-v", "--verbose",
         help="make output verbose", action="store_true"
     )
+    parser.add_argument(
+        "--profile",
+        help="time the stages of the command, print a summary and write "
+        "the profile to the session folder",
+        action="store_true"
+    )
 
     subparser = parser.add_subparsers(title="subcommands")
 
@@ -193,7 +403,7 @@ if __name__ == "__main__":
         const="/ndi/fiducials"
     )
     parser_record.add_argument(
-        "-n", "--samples",
+        "--samples",
         help="number of samples per row "
         "(10 is recommended to get higher quality data)",
         default=10,
@@ -205,6 +415,61 @@ if __name__ == "__main__":
         action="store_true",
         default=False
     )
+    parser_record.add_argument(
+        "--live",
+        help="print the estimate of the offset after every palpation",
+        action="store_true",
+        default=False
+    )
+    parser_record.add_argument(
+        "--continuous",
+        help="record while moving at a constant speed instead of stopping "
+        "at every point",
+        action="store_true",
+        default=False
+    )
+    parser_record.add_argument(
+        "--no-prediction",
+        help="search for the surface from above at every palpation instead "
+        "of starting near the height predicted from earlier palpations",
+        action="store_true",
+        default=False
+    )
+    parser_record.add_argument(
+        "--no-reorder",
+        help="move through the tracker poses in the order they are "
+        "generated instead of the order with the shortest estimated time",
+        action="store_true",
+        default=False
+    )
+    parser_record.add_argument(
+        "--tracker-reference",
+        help="earlier tracker session to predict where the marker will be "
+        "in tracker coordinates"
+    )
+    parser_record.add_argument(
+        "--tracker-volume",
+        help="measurement volume of the tracker in tracker coordinates, "
+        "with --tracker-reference",
+        nargs=6,
+        type=float,
+        metavar=("XMIN", "YMIN", "ZMIN", "XMAX", "YMAX", "ZMAX")
+    )
+    parser_record.add_argument(
+        "--sample-spacing",
+        help="distance in millimeters of the descent of a continuous "
+        "palpation that its samples are averaged over. Below 0.05mm, "
+        "contact points are often not found in noisy wrenches",
+        default=0.05,
+        type=float
+    )
+    parser_record.add_argument(
+        "--settle-tolerance",
+        help="distance in millimeters that the mean tracker position may "
+        "move by once a pose is settled",
+        default=0.5,
+        type=float
+    )
     parser_record.add_argument(
         "-n", "--number",
         help="run n number of times",
@@ -218,7 +483,7 @@ if __name__ == "__main__":
     )
     parser_analyze.add_argument(
         "data_folder",
-        help="folder to read from",
+        help="folders to read from",
         nargs='+'
     )
     parser_analyze.add_argument(
@@ -245,9 +510,227 @@ if __name__ == "__main__":
         default=False,
         action="store_true"
     )
+    parser_analyze.add_argument(
+        "--offset-step",
+        help="distance between offsets in the sweep "
+        "in tenths of a millimeter",
+        default=1,
+        type=float
+    )
+    parser_analyze.add_argument(
+        "--fk-sweep",
+        help="run forward kinematics at every offset "
+        "instead of once per point",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze.add_argument(
+        "--search",
+        help="search for the offset with the minimum error "
+        "instead of sweeping every offset",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze.add_argument(
+        "--tolerance",
+        help="tolerance of the offset search in tenths of a millimeter",
+        default=0.01,
+        type=float
+    )
+    parser_analyze.add_argument(
+        "-j", "--jobs",
+        help="number of processes to analyze the palpations with",
+        default=1,
+        type=int
+    )
+    parser_analyze.add_argument(
+        "--no-cache",
+        help="recompute every stage instead of reusing cached results",
+        default=False,
+        action="store_true"
+    )
 
     parser_analyze.set_defaults(func=parse_analyze)
 
+    parser_analyze_all = subparser.add_parser(
+        "analyze-all",
+        help="analyze every session in a folder without prompting"
+    )
+    parser_analyze_all.add_argument(
+        "data_root",
+        help="folder to search for sessions in",
+        nargs='?',
+        default="data"
+    )
+    parser_analyze_all.add_argument(
+        "-o", "--output",
+        help="csv file to write the summary to",
+        default="summary.csv"
+    )
+    parser_analyze_all.add_argument(
+        "-j", "--jobs",
+        help="number of sessions to analyze at once",
+        default=multiprocessing.cpu_count(),
+        type=int
+    )
+    parser_analyze_all.add_argument(
+        "--offset-step",
+        help="distance between offsets in the sweep "
+        "in tenths of a millimeter",
+        default=1,
+        type=float
+    )
+    parser_analyze_all.add_argument(
+        "--fk-sweep",
+        help="run forward kinematics at every offset "
+        "instead of once per point",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze_all.add_argument(
+        "--search",
+        help="search for the offset with the minimum error "
+        "instead of sweeping every offset",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze_all.add_argument(
+        "--tolerance",
+        help="tolerance of the offset search in tenths of a millimeter",
+        default=0.01,
+        type=float
+    )
+    parser_analyze_all.add_argument(
+        "--reanalyze-palpations",
+        help="rewrite plane.csv from the palpations even if it exists",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze_all.add_argument(
+        "--write-offset-v-error",
+        help="write the errors of the sweep to offset_v_error.csv "
+        "in each session",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze_all.add_argument(
+        "--no-cache",
+        help="recompute every stage instead of reusing cached results",
+        default=False,
+        action="store_true"
+    )
+    parser_analyze_all.set_defaults(func=parse_analyze_all)
+
+    parser_simulate = subparser.add_parser(
+        "simulate",
+        help="record from a simulated arm that replays an earlier session"
+    )
+    parser_simulate.add_argument(
+        "kind",
+        help="kind of recording to simulate",
+        choices=["plane", "tracker"]
+    )
+    parser_simulate.add_argument(
+        "replay_folder",
+        help="session whose palpations or tracker registration to replay"
+    )
+    parser_simulate.add_argument(
+        "--offset",
+        help="error of the offset of joint 2 of the simulated arm "
+        "in millimeters",
+        default=0,
+        type=float
+    )
+    parser_simulate.add_argument(
+        "--rob-file",
+        help="kinematics of the simulated arm and of the analysis, "
+        "instead of ROB_FILE"
+    )
+    parser_simulate.add_argument(
+        "--samples",
+        help="number of samples per row",
+        default=10,
+        type=int,
+    )
+    parser_simulate.add_argument(
+        "--live",
+        help="print the estimate of the offset after every palpation",
+        action="store_true",
+        default=False
+    )
+    parser_simulate.add_argument(
+        "--continuous",
+        help="record while moving at a constant speed instead of stopping "
+        "at every point",
+        action="store_true",
+        default=False
+    )
+    parser_simulate.add_argument(
+        "--no-prediction",
+        help="search for the surface from above at every palpation",
+        action="store_true",
+        default=False
+    )
+    parser_simulate.add_argument(
+        "--no-reorder",
+        help="move through the tracker poses in the order they are generated",
+        action="store_true",
+        default=False
+    )
+    parser_simulate.add_argument(
+        "--sample-spacing",
+        help="distance in millimeters of the descent of a continuous "
+        "palpation that its samples are averaged over. Below 0.05mm, "
+        "contact points are often not found in noisy wrenches",
+        default=0.05,
+        type=float
+    )
+    parser_simulate.add_argument(
+        "--settle-tolerance",
+        help="distance in millimeters that the mean tracker position may "
+        "move by once a pose is settled",
+        default=0.5,
+        type=float
+    )
+    parser_simulate.set_defaults(func=parse_simulate, tracker_reference=None,
+                                 tracker_volume=None)
+
+    parser_pack = subparser.add_parser(
+        "pack",
+        help="convert the csv files of sessions into memory-mapped arrays"
+    )
+    parser_pack.add_argument(
+        "data_folder",
+        help="folders to pack",
+        nargs='+'
+    )
+    parser_pack.set_defaults(func=parse_pack)
+
+    parser_telemetry = subparser.add_parser(
+        "telemetry",
+        help="summarize where the time of recorded sessions went"
+    )
+    parser_telemetry.add_argument(
+        "data_folder",
+        help="folders of the sessions to summarize",
+        nargs='+'
+    )
+    parser_telemetry.add_argument(
+        "--no-histograms",
+        help="don't print the latency histograms of the arm",
+        action="store_true",
+        default=False
+    )
+    parser_telemetry.set_defaults(func=parse_telemetry)
+
     args = parser.parse_args()
 
-    args.func(args)
+    if args.profile:
+        PROFILER.start()
+    folder = args.func(args)
+    if args.profile:
+        PROFILER.stop()
+        PROFILER.print_summary()
+        # Commands without a session folder write to the current folder
+        filename = PROFILER.write(folder or ".", " ".join(sys.argv))
+        print("Wrote profile to {}".format(filename))
@@ -1,5 +1,109 @@
+import os
+import csv
+import sys
+import shutil
+import argparse
+import tempfile
+import warnings
+import subprocess
 import unittest
 import numpy as np
+import analyze
+import calibrate
+import pipeline
+from analyze import (analyze_palpations, get_best_fit_plane,
+                     get_best_fit_planes, minimize_offset)
+from benchmark import find_regressions
+from kinematics import load_rob
+from offset_estimator import OffsetEstimator
+from plane_statistics import PlaneStatistics
+from profiler import (Profiler, PROFILER, profile_task, profile_tasks,
+                      merge_task)
+from registration import find_latency, register_rigid
+from ring_buffer import StateRingBuffer
+from screening import screen_joint_set, solve_orientation
+from session import (find_sessions, has_current_format, load_session,
+                     pack_session, read_table, JOINT_COLUMNS,
+                     POSITION_COLUMNS, TRACKER_COLUMNS)
+from telemetry import (TelemetryLog, TelemetryObject, read_telemetry,
+                       summarize)
+from trajectory import (estimate_duration, interpolate_joint_set,
+                        order_joint_set, JOINT_SPEEDS)
+
+# Modified DH chain of the PSM in the cisst .rob format
+PSM_ROB = """6
+modified  1.5708 0.0000 0.0 0.0000 revolute  active  1.5708 -1.5 1.5 1
+modified -1.5708 0.0000 0.0 0.0000 revolute  active -1.5708 -0.9 0.9 1
+modified  1.5708 0.0000 0.0 0.0000 prismatic active -0.4318  0.0 0.24 1
+modified  0.0000 0.0000 0.0 0.4162 revolute  active  0.0000 -4.5 4.5 1
+modified -1.5708 0.0000 0.0 0.0000 revolute  active -1.5708 -3.0 3.0 1
+modified -1.5708 0.0091 0.0 0.0000 revolute  active -1.5708 -3.0 3.0 1
+"""
+
+
+def has_modules(*names):
+    """Whether the modules `names` can be imported"""
+    try:
+        for name in names:
+            __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+# Recording needs ROS and the dVRK python packages
+HAVE_DVRK = has_modules("rospy", "PyKDL", "dvrk")
+
+
+def dh_modified(alpha, a, theta, d):
+    rot_x = np.eye(4)
+    rot_x[1:3, 1:3] = [[np.cos(alpha), -np.sin(alpha)],
+                       [np.sin(alpha), np.cos(alpha)]]
+    trans_x = np.eye(4)
+    trans_x[0, 3] = a
+    rot_z = np.eye(4)
+    rot_z[0:2, 0:2] = [[np.cos(theta), -np.sin(theta)],
+                       [np.sin(theta), np.cos(theta)]]
+    trans_z = np.eye(4)
+    trans_z[2, 3] = d
+    return rot_x.dot(trans_x).dot(rot_z).dot(trans_z)
+
+
+def load_psm():
+    with tempfile.NamedTemporaryFile('w', suffix=".rob",
+                                     delete=False) as robfile:
+        robfile.write(PSM_ROB)
+    try:
+        return load_rob(robfile.name)
+    finally:
+        os.remove(robfile.name)
+
+
+def plane_joints(rob, offset, npoints=25, seed=0):
+    """
+    Gets joint positions whose tool tips lie on the plane z = -0.15 when
+    joint 2 is moved by `offset` in tenths of a millimeter
+    """
+    rng = np.random.RandomState(seed)
+    joints = np.zeros((npoints, 6))
+    joints[:, :2] = rng.uniform(-0.4, 0.4, (npoints, 2))
+    joints[:, 2] = 0.15
+    joints[:, 3:] = rng.uniform(-0.3, 0.3, (npoints, 3))
+    positions, axes = rob.position_and_axis(joints, 2)
+    joints[:, 2] += (-0.15 - positions[:, 2]) / axes[:, 2] - offset / 10000
+    return joints
+
+
+def write_plane_session(folder, rob, offset, seed=0):
+    """Writes the plane.csv of a palpation session with the offset
+    `offset` in tenths of a millimeter"""
+    joints = plane_joints(rob, offset, seed=seed)
+    with open(os.path.join(folder, "plane.csv"), 'w') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(POSITION_COLUMNS + JOINT_COLUMNS)
+        for row in np.c_[rob.positions(joints), joints]:
+            writer.writerow(row)
+
 
 class TestRecording(unittest.TestCase):
 
@@ -17,3 +121,835 @@ class TestRecording(unittest.TestCase):
             B * projection[1] +
             C - projection[2], 0
         )
+
+
+class TestKinematics(unittest.TestCase):
+
+    def test_forward_kinematics(self):
+        rob = load_psm()
+        rng = np.random.RandomState(0)
+        q = rng.uniform(-0.5, 0.5, (4, 5, 6))
+        q[..., 2] = rng.uniform(0.05, 0.2, (4, 5))
+
+        frames = rob.forward_kinematics(q)
+        self.assertEqual(frames.shape, (4, 5, 4, 4))
+
+        for idx in np.ndindex(4, 5):
+            expected = np.eye(4)
+            for i in range(6):
+                theta, d = rob.theta[i], rob.d[i]
+                if i == 2:
+                    d += q[idx][i] + rob.offsets[i]
+                else:
+                    theta += q[idx][i] + rob.offsets[i]
+                expected = expected.dot(
+                    dh_modified(rob.alpha[i], rob.a[i], theta, d)
+                )
+            np.testing.assert_allclose(frames[idx], expected, atol=1e-12)
+
+    def test_insertion_axis(self):
+        rob = load_psm()
+        rng = np.random.RandomState(1)
+        q = rng.uniform(-0.5, 0.5, (20, 6))
+        q[:, 2] = rng.uniform(0.05, 0.2, 20)
+
+        positions, axes = rob.position_and_axis(q, 2)
+        np.testing.assert_allclose(np.linalg.norm(axes, axis=1), 1)
+        for offset in (-0.02, 0.005, 0.013):
+            shifted = q.copy()
+            shifted[:, 2] += offset
+            np.testing.assert_allclose(
+                rob.positions(shifted), positions + offset * axes, atol=1e-12
+            )
+
+
+class TestAnalyze(unittest.TestCase):
+
+    def test_minimize_offset(self):
+        evaluated = []
+
+        def error_fn(offsets):
+            offsets = np.atleast_1d(offsets)
+            evaluated.append(len(offsets))
+            return 0.5 + (offsets - 37.3) ** 2
+
+        offset, error = minimize_offset(error_fn, tolerance=0.01)
+        self.assertAlmostEqual(offset, 37.3, delta=0.01)
+        self.assertAlmostEqual(error, 0.5, places=4)
+        # Far fewer evaluations than sweeping every offset
+        self.assertLess(sum(evaluated), 100)
+
+    def test_minimize_offset_outside_bounds(self):
+        def error_fn(offsets):
+            return (np.atleast_1d(offsets) + 512.6) ** 2
+
+        # The bounds are widened until they bracket the minimum
+        offset, _ = minimize_offset(error_fn, bounds=(-200, 200))
+        self.assertAlmostEqual(offset, -512.6, delta=0.01)
+        # Unless the minimum is farther than `max_expansions` allow
+        offset, _ = minimize_offset(error_fn, bounds=(-20, 20),
+                                    max_expansions=2)
+        self.assertEqual(offset, -140)
+
+    def test_best_fit_planes(self):
+        rng = np.random.RandomState(4)
+        pts = rng.uniform(-0.1, 0.1, (6, 30, 3))
+        # Tilted planes with noise
+        pts[..., 2] = (rng.uniform(-1, 1, (6, 1)) * pts[..., 0]
+                       + rng.uniform(-1, 1, (6, 1)) * pts[..., 1]
+                       - 0.15 + rng.normal(0, 0.001, (6, 30)))
+        coefs, errors = get_best_fit_planes(pts)
+        self.assertEqual(coefs.shape, (6, 3))
+        self.assertEqual(errors.shape, (6,))
+        for cloud, coef, error in zip(pts, coefs, errors):
+            expected_coef, expected_error = get_best_fit_plane(cloud)
+            np.testing.assert_allclose(coef, expected_coef, atol=1e-12)
+            self.assertAlmostEqual(error, expected_error, places=12)
+
+
+    def test_analyze_palpations_jobs(self):
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "data", "PSM1_2019-07-26_11-48-56")
+        folder = tempfile.mkdtemp()
+        try:
+            for name in load_session(source).palpation_files[:6]:
+                shutil.copy(os.path.join(source, name), folder)
+            # A palpation that never touches the surface
+            table = read_table(os.path.join(folder, "palpation_0_0.csv"))
+            table["wrench"][:] = 0
+            np.savetxt(os.path.join(folder, "palpation_1_0.csv"), table.data,
+                       delimiter=",", header=",".join(table.columns),
+                       comments="")
+
+            planes = []
+            for jobs in [1, 2]:
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    analyze_palpations(folder, jobs=jobs)
+                self.assertEqual(len(caught), 1)
+                self.assertIn("palpation_1_0.csv", str(caught[0].message))
+                plane = read_table(os.path.join(folder, "plane.csv"))
+                planes.append(plane.get(*(POSITION_COLUMNS + JOINT_COLUMNS)))
+            self.assertEqual(len(planes[0]), 6)
+            # In the order of the palpations
+            np.testing.assert_array_equal(planes[0], planes[1])
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestPlaneStatistics(unittest.TestCase):
+
+    def test_fit_at_offsets(self):
+        rng = np.random.RandomState(2)
+        positions = rng.uniform(-0.05, 0.05, (30, 3))
+        positions[:, 2] = (0.1 * positions[:, 0] - 0.2 * positions[:, 1]
+                           - 0.15 + rng.normal(0, 1e-4, 30))
+        axes = rng.normal(0, 0.1, (30, 3))
+        axes[:, 2] = -1
+        axes /= np.linalg.norm(axes, axis=1)[:, np.newaxis]
+
+        stats = PlaneStatistics()
+        # Add points in chunks like a streaming reader would
+        for chunk in np.array_split(np.arange(30), 4):
+            stats.add(positions[chunk], axes[chunk])
+
+        offsets = np.array([-0.02, 0, 0.0137])
+        coefs, errors = stats.fit(offsets)
+        for coef, error, offset in zip(coefs, errors, offsets):
+            pts = positions + offset * axes
+            A = np.c_[pts[:, :2], np.ones(len(pts))]
+            expected = np.linalg.lstsq(A, pts[:, 2], rcond=None)[0]
+            normal = np.array([expected[0], expected[1], -1])
+            normal /= np.linalg.norm(normal)
+            dists = (pts - [0, 0, expected[2]]).dot(normal)
+            np.testing.assert_allclose(coef, expected, atol=1e-9)
+            self.assertAlmostEqual(error, np.sqrt(np.mean(dists ** 2)))
+
+
+class TestOffsetEstimator(unittest.TestCase):
+
+    def test_estimate(self):
+        rob = load_psm()
+        joints = plane_joints(rob, 30)
+        estimator = OffsetEstimator(rob)
+        estimator.add(joints[:OffsetEstimator.MIN_POINTS - 1])
+        self.assertIsNone(estimator.estimate())
+        for q in joints[OffsetEstimator.MIN_POINTS - 1:]:
+            estimator.add(q)
+        offset, error, std = estimator.estimate()
+        self.assertAlmostEqual(offset, 30, delta=0.01)
+        self.assertLess(error, 1e-7)
+        self.assertLess(std, 0.01)
+
+    def test_variance(self):
+        # The standard deviation matches the spread of the estimates over
+        # sessions with noisy contact points
+        rob = load_psm()
+        offsets = []
+        stds = []
+        for seed in range(40):
+            joints = plane_joints(rob, 30, seed=seed)
+            rng = np.random.RandomState(100 + seed)
+            joints[:, 2] += rng.normal(0, 0.0002, len(joints))
+            estimator = OffsetEstimator(rob)
+            estimator.add(joints)
+            offset, _, std = estimator.estimate()
+            offsets.append(offset)
+            stds.append(std)
+        self.assertLess(abs(np.mean(offsets) - 30),
+                        3 * np.std(offsets) / np.sqrt(len(offsets)))
+        self.assertTrue(0.7 < np.std(offsets) / np.mean(stds) < 1.4)
+
+
+class TestRegistration(unittest.TestCase):
+
+    def test_register_stack(self):
+        rng = np.random.RandomState(3)
+        model = rng.uniform(-0.1, 0.1, (40, 3))
+        data = np.empty((3, 40, 3))
+        rotations = np.empty((3, 3, 3))
+        translations = rng.uniform(-1, 1, (3, 3))
+        for k in range(3):
+            # Random proper rotation
+            q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+            rotations[k] = q * np.sign(np.linalg.det(q))
+            data[k] = (model - translations[k]).dot(rotations[k])
+        data[2] += rng.normal(0, 1e-3, (40, 3))
+
+        (R, t), errors = register_rigid(data, model)
+        np.testing.assert_allclose(R[:2], rotations[:2], atol=1e-9)
+        np.testing.assert_allclose(t[:2], translations[:2], atol=1e-9)
+        np.testing.assert_allclose(errors[:2], 0, atol=1e-9)
+        self.assertGreater(errors[2], 0)
+
+        (R, t), error = register_rigid(data[2], model)
+        transformed = data[2].dot(R.T) + t
+        self.assertAlmostEqual(
+            error, np.sqrt(np.mean(np.sum((transformed - model) ** 2, axis=1)))
+        )
+        self.assertAlmostEqual(error, errors[2])
+
+    def test_find_latency(self):
+        times = np.linspace(0, 2, 2001)
+        path = np.c_[np.sin(3 * times), np.cos(2 * times), times ** 2] / 10
+        # The model stream shows the data 30ms late, shifted and rotated
+        model_times = times[::25]
+        q, r = np.linalg.qr(np.random.RandomState(5).normal(size=(3, 3)))
+        rotation = q * np.sign(np.linalg.det(q))
+        delayed = np.c_[np.sin(3 * (model_times - 0.03)),
+                        np.cos(2 * (model_times - 0.03)),
+                        (model_times - 0.03) ** 2] / 10
+        model = delayed.dot(rotation.T) + [0.1, 0.2, 0.3]
+
+        latency, errors = find_latency(times, path, model_times, model,
+                                       np.arange(-0.1, 0.101, 0.002))
+        self.assertAlmostEqual(latency, 0.03)
+        self.assertLess(errors.min(), 1e-5)
+
+
+class TestSession(unittest.TestCase):
+
+    def test_column_aliases(self):
+        with tempfile.NamedTemporaryFile('w', suffix=".csv",
+                                         delete=False) as csvfile:
+            csvfile.write("polaris_position_y,arm_position_x,"
+                          "polaris_position_x,polaris_position_z\n"
+                          "1,2,3,4\n5,6,7,8\n")
+        try:
+            table = read_table(csvfile.name)
+        finally:
+            os.remove(csvfile.name)
+        np.testing.assert_array_equal(table.get(*TRACKER_COLUMNS),
+                                      [[3, 1, 4], [7, 5, 8]])
+        np.testing.assert_array_equal(table["arm_position_x"], [2, 6])
+
+    def test_pack_session(self):
+        folder = tempfile.mkdtemp()
+        try:
+            write_plane_session(folder, load_psm(), 30)
+            rng = np.random.RandomState(6)
+            columns = POSITION_COLUMNS + ["wrench"] + JOINT_COLUMNS
+            for col in range(3):
+                name = "palpation_0_{}.csv".format(col)
+                with open(os.path.join(folder, name), 'w') as outfile:
+                    writer = csv.writer(outfile)
+                    writer.writerow(columns)
+                    writer.writerows(rng.uniform(-1, 1, (10 + col,
+                                                         len(columns))))
+            names = ["palpation_0_0.csv", "palpation_0_1.csv",
+                     "palpation_0_2.csv", "plane.csv"]
+            index = pack_session(folder)
+            self.assertEqual(sorted(index), names)
+
+            session = load_session(folder)
+            for name in names:
+                table = session.table(name)
+                self.assertIsInstance(table.data, np.memmap)
+                expected = read_table(os.path.join(folder, name))
+                self.assertEqual(table.columns, expected.columns)
+                np.testing.assert_array_equal(table.data, expected.data)
+
+            # Packed tables are read without their csv files
+            os.remove(os.path.join(folder, "plane.csv"))
+            self.assertTrue(session.exists("plane.csv"))
+            self.assertIsInstance(session.plane.data, np.memmap)
+            # A csv file that changed is read instead of its packed copy
+            with open(os.path.join(folder, "palpation_0_0.csv"),
+                      'w') as outfile:
+                outfile.write(",".join(columns) + "\n")
+                outfile.write(",".join(["0"] * len(columns)) + "\n")
+            table = session.table("palpation_0_0.csv")
+            self.assertNotIsInstance(table.data, np.memmap)
+            self.assertEqual(len(table), 1)
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestStateRingBuffer(unittest.TestCase):
+
+    def test_wraparound_and_interpolation(self):
+        buf = StateRingBuffer(2, size=4)
+        for i in range(6):
+            buf.append(i * 0.1, [i, 10 * i])
+        times, values = buf.samples()
+        # Only the newest 4 samples are kept, from oldest to newest
+        np.testing.assert_allclose(times, [0.2, 0.3, 0.4, 0.5])
+        np.testing.assert_allclose(values[:, 0], [2, 3, 4, 5])
+        np.testing.assert_allclose(buf.interpolate(0.35), [3.5, 35])
+        np.testing.assert_allclose(buf.interpolate([0, 0.45, 1])[:, 0],
+                                   [2, 4.5, 5])
+        np.testing.assert_allclose(buf.window(0.25, 0.45)[1][:, 0], [3, 4])
+
+
+class TestScreening(unittest.TestCase):
+
+    def test_screen_joint_set(self):
+        rob = load_psm()
+        # Tool pointing down
+        rotation = np.diag([1., -1, -1])
+        joint_set = np.array([
+            [0.1, 0.3, 0.15, 0, 0, 0],
+            [-0.7, -0.7, 0.15, 0, 0, 0],
+            [0.1, 0.3, 0.30, 0, 0, 0],
+        ])
+
+        solved, errors = solve_orientation(rob, joint_set, rotation)
+        np.testing.assert_allclose(errors, 0, atol=1e-6)
+        np.testing.assert_allclose(solved[:, :3], joint_set[:, :3])
+
+        # Limit the wrist so the second pose can't point down
+        rob.q_min[4:], rob.q_max[4:] = -1.4, 1.4
+        bounds = ([-1, -1, -0.2], [1, 1, -0.05])
+        rejected = screen_joint_set(rob, joint_set, rotation,
+                                    tracker_transform=(np.eye(3), 0),
+                                    tracker_bounds=bounds)
+        np.testing.assert_array_equal(rejected["joint limits"],
+                                      [False, False, True])
+        np.testing.assert_array_equal(rejected["orientation"],
+                                      [False, True, False])
+        np.testing.assert_array_equal(rejected["tracker volume"],
+                                      [False, False, True])
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def test_order_joint_set(self):
+        rng = np.random.RandomState(7)
+        joint_set = list(rng.uniform(-1, 1, (60, 6)))
+        start = np.zeros(6)
+        ordered, duration = order_joint_set(joint_set, start)
+        # Every pose is visited once
+        self.assertEqual(sorted(map(tuple, ordered)),
+                         sorted(map(tuple, joint_set)))
+        self.assertAlmostEqual(duration, estimate_duration(ordered, start))
+        self.assertLess(duration, estimate_duration(joint_set, start) / 2)
+
+        # Poses on a line are visited in order
+        line = [np.array([x, 0, 0, 0, 0, 0]) for x in [3, 1, 4, 2, 0]]
+        ordered, duration = order_joint_set(line, start)
+        self.assertEqual([q[0] for q in ordered], [0, 1, 2, 3, 4])
+        self.assertAlmostEqual(duration, 4 / 0.8)
+
+    def test_interpolate_joint_set(self):
+        rng = np.random.RandomState(8)
+        joint_set = rng.uniform(-1, 1, (5, 3))
+        start = np.zeros(3)
+        times, points, arrivals = interpolate_joint_set(joint_set, start,
+                                                        rate=20)
+        self.assertAlmostEqual(arrivals[-1],
+                               estimate_duration(joint_set, start))
+        self.assertLessEqual(np.max(np.diff(times)), 1 / 20 + 1e-12)
+        np.testing.assert_allclose(points[0], start)
+        # The path goes through every pose
+        np.testing.assert_allclose(
+            points[np.searchsorted(times, arrivals)], joint_set
+        )
+        # No joint is faster than its maximum speed
+        speeds = (np.abs(np.diff(points, axis=0))
+                  / np.diff(times)[:, np.newaxis])
+        self.assertTrue(np.all(speeds <= JOINT_SPEEDS[:3] + 1e-9))
+
+
+def square_in_stage(x):
+    with PROFILER.stage("square"):
+        PROFILER.count("squares")
+        return x * x
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_nested_stages(self):
+        profiler = Profiler()
+        with profiler.stage("ignored"):
+            pass
+        profiler.start()
+        for _ in range(3):
+            with profiler.stage("outer"):
+                with profiler.stage("inner"):
+                    profiler.count("events", 2)
+        profiler.stop()
+
+        self.assertEqual(sorted(profiler.stages),
+                         [("outer",), ("outer", "inner")])
+        rows = {row[0]: row for row in profiler.summary()}
+        self.assertEqual(rows["outer"][1], 3)
+        outer_total = profiler.stages[("outer",)][1]
+        inner_total = profiler.stages[("outer", "inner")][1]
+        # Self time of the outer stage excludes the inner stage
+        self.assertAlmostEqual(rows["outer"][3], outer_total - inner_total)
+        self.assertLessEqual(outer_total, profiler.duration)
+        self.assertEqual(profiler.counters["events"], 6)
+
+        folder = tempfile.mkdtemp()
+        try:
+            filename = profiler.write(folder)
+            with open(os.path.splitext(filename)[0] + ".folded") as infile:
+                stacks = [line.rsplit(" ", 1)[0] for line in infile]
+            self.assertEqual(stacks, ["outer", "outer;inner"])
+        finally:
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+            os.rmdir(folder)
+
+    def test_workers(self):
+        import multiprocessing
+        PROFILER.reset()
+        PROFILER.start()
+        pool = multiprocessing.Pool(2)
+        try:
+            with PROFILER.stage("wait"):
+                results = [merge_task(output) for output in pool.map(
+                    profile_task, profile_tasks(square_in_stage, range(5))
+                )]
+        finally:
+            pool.close()
+            pool.join()
+            PROFILER.stop()
+        self.assertEqual(results, [0, 1, 4, 9, 16])
+        self.assertEqual(PROFILER.stages[("wait", "square")][0], 5)
+        self.assertEqual(PROFILER.counters["squares"], 5)
+        PROFILER.reset()
+
+
+class TestTelemetry(unittest.TestCase):
+
+    class Clock(object):
+        """Clock that only advances when told to"""
+
+        def __init__(self):
+            self.time = 100.0
+
+        def now(self):
+            return self.time
+
+        def sleep(self, duration):
+            self.time += duration
+
+    def test_round_trip(self):
+        clock = self.Clock()
+        folder = tempfile.mkdtemp()
+        filename = os.path.join(folder, "telemetry.bin")
+        try:
+            log = TelemetryLog(filename, clock)
+            arm = TelemetryObject(clock, log, {"sleep": "move"})
+            for _ in range(2):
+                with log.span("palpation"):
+                    arm.sleep(0.5)
+                    with log.span("sleep"):
+                        clock.sleep(1)
+            log.close()
+            # An interrupted session ends with a partial record
+            with open(filename, 'ab') as outfile:
+                outfile.write(b"\x00" * 7)
+
+            names, records = read_telemetry(filename)
+            self.assertEqual(len(records), 6)
+            summary = summarize(names, records)
+        finally:
+            os.remove(filename)
+            os.rmdir(folder)
+
+        self.assertAlmostEqual(summary["duration"], 3)
+        self.assertAlmostEqual(summary["categories"]["motion"], 1)
+        self.assertAlmostEqual(summary["categories"]["sleep"], 2)
+        np.testing.assert_allclose(summary["palpations"], [1.5, 1.5])
+        self.assertEqual(len(summary["poses"]), 0)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_find_regressions(self):
+        results = {"analyze": {"time": 1.0, "peak_memory": None}}
+        conformance = {"offset_v_error/linear/a": False,
+                       "plane/a": False, "plane/b": False}
+        # Without a history, only offset_v_error.csv checks fail
+        self.assertEqual(find_regressions([], results, conformance),
+                         ["offset_v_error/linear/a doesn't conform"])
+
+        history = [{
+            "results": {"analyze": {"time": 0.5, "peak_memory": None}},
+            "conformance": {"offset_v_error/linear/a": True,
+                            "plane/a": True, "plane/b": False},
+        }]
+        self.assertEqual(find_regressions(history, results, conformance), [
+            "analyze time: 1 (best 0.5)",
+            "offset_v_error/linear/a doesn't conform",
+            "plane/a no longer conforms",
+        ])
+
+
+class TestAnalysisImports(unittest.TestCase):
+
+    def test_no_robot_or_plotting_imports(self):
+        # A separate interpreter, since other tests may import these modules
+        loaded = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, analyze, pipeline; "
+            "print(' '.join(name for name in ['rospy', 'PyKDL', 'dvrk', "
+            "'matplotlib'] if name in sys.modules))"
+        ], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(loaded.decode().strip(), "")
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.rob_file = os.path.join(self.folder, "psm.rob")
+        with open(self.rob_file, 'w') as robfile:
+            robfile.write(PSM_ROB)
+        self.rob_file, analyze.ROB_FILE = analyze.ROB_FILE, self.rob_file
+        self.sessions = []
+        for num, offset in enumerate([30, 50]):
+            session = os.path.join(self.folder, "PSM1_{}".format(num))
+            os.mkdir(session)
+            write_plane_session(session, load_psm(), offset, seed=num)
+            self.sessions.append(session)
+
+    def tearDown(self):
+        analyze.ROB_FILE = self.rob_file
+        shutil.rmtree(self.folder)
+
+    def test_cache(self):
+        session = self.sessions[0]
+        cache_folder = os.path.join(session, pipeline.CACHE_FOLDER)
+
+        def sweep_files():
+            return [name for name in os.listdir(cache_folder)
+                    if name.startswith("sweep-")]
+
+        cached = []
+        for step in [1, 2, 3, 1, 2]:
+            run = pipeline.Pipeline(session, step=step)
+            report = run.run()[0]
+            self.assertLessEqual(abs(report["offset"] - 3), step / 10)
+            cached.append(run.cached_stages)
+        self.assertEqual(cached[0], [])
+        self.assertEqual(cached[1:3], [["contacts", "kinematics"]] * 2)
+        self.assertEqual(cached[3:], [["contacts", "kinematics", "sweep"]] * 2)
+        self.assertEqual(len(sweep_files()), 3)
+
+        # Only the most recent CACHE_SIZE outputs are kept
+        for step in [4, 5]:
+            pipeline.Pipeline(session, step=step).run()
+        self.assertEqual(len(sweep_files()), pipeline.CACHE_SIZE)
+        run = pipeline.Pipeline(session, step=2)
+        run.run()
+        self.assertIn("sweep", run.cached_stages)
+
+    def test_analyze_sessions(self):
+        curves = [pipeline.Pipeline(session).run()[1]["offset_v_error"]
+                  for session in self.sessions]
+        report, offset_v_error = pipeline.analyze_sessions(self.sessions)
+        # The curve of the sessions is the sum of their curves
+        np.testing.assert_allclose(offset_v_error[:, 0], curves[0][:, 0])
+        np.testing.assert_allclose(offset_v_error[:, 1],
+                                   curves[0][:, 1] + curves[1][:, 1])
+        min_idx = np.argmin(offset_v_error[:, 1])
+        self.assertEqual(report["sessions"], 2)
+        self.assertEqual(report["computed"], 0)
+        self.assertAlmostEqual(report["offset"],
+                               offset_v_error[min_idx, 0] / 10)
+        # Between the offsets of the sessions, 3mm and 5mm
+        self.assertTrue(3 <= report["offset"] <= 5)
+
+        report, offset_v_error = pipeline.analyze_sessions(
+            self.sessions, search=True, use_cache=False
+        )
+        self.assertIsNone(offset_v_error)
+        self.assertEqual(report["computed"], 2)
+        self.assertAlmostEqual(report["offset"],
+                               curves[0][min_idx, 0] / 10, delta=0.1)
+
+
+    def add_old_sessions(self):
+        """Adds a session in the format of early versions and a folder
+        without a session
+        :returns the folder of the old session"""
+        old = os.path.join(self.folder, "PSM3_old")
+        os.mkdir(old)
+        with open(os.path.join(old, "palpation_0_0.csv"), 'w') as csvfile:
+            csvfile.write("arm_position_z,wrench\n-0.1,0.1\n-0.2,2.6\n")
+        os.mkdir(os.path.join(self.folder, "notes"))
+        with open(os.path.join(self.folder, "notes", "notes.txt"), 'w'):
+            pass
+        return old
+
+    def test_find_sessions(self):
+        old = self.add_old_sessions()
+        # Cached stages aren't sessions
+        pipeline.analyze_session(self.sessions[0])
+        self.assertEqual(find_sessions(self.folder), self.sessions + [old])
+        self.assertTrue(has_current_format(self.sessions[0]))
+        self.assertFalse(has_current_format(old))
+
+    def test_analyze_all(self):
+        self.add_old_sessions()
+        output = os.path.join(self.folder, "summary.csv")
+        args = argparse.Namespace(
+            data_root=self.folder, output=output, jobs=2, fk_sweep=False,
+            offset_step=1, search=False, tolerance=0.01,
+            reanalyze_palpations=False, write_offset_v_error=False,
+            no_cache=False
+        )
+        calibrate.parse_analyze_all(args)
+        with open(output) as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        self.assertEqual([row["folder"] for row in rows], self.sessions)
+        self.assertEqual([row["status"] for row in rows], ["ok", "ok"])
+        self.assertAlmostEqual(float(rows[0]["offset"]), 3, delta=0.1)
+        self.assertAlmostEqual(float(rows[1]["offset"]), 5, delta=0.1)
+
+
+@unittest.skipUnless(HAVE_DVRK, "needs the dVRK packages")
+class TestPlaneRecording(unittest.TestCase):
+
+    def setUp(self):
+        from plane_recording import PlaneRecording
+        # Only the contact points of the recording are used
+        self.recording = PlaneRecording.__new__(PlaneRecording)
+        self.recording.contacts = PlaneStatistics()
+        self.recording.contact_rows = set()
+        self.recording.last_contact = None
+
+    def add_contact(self, row, pos):
+        self.recording.contacts.add(np.array([pos]))
+        self.recording.contact_rows.add(row)
+        self.recording.last_contact = np.array(pos)
+
+    def test_expected_height(self):
+        self.assertIsNone(self.recording.expected_height(0, 0))
+        self.add_contact(0, [0, 0, -0.1])
+        self.add_contact(0, [0.01, 0, -0.1])
+        # A single row predicts the height of the last contact point
+        self.assertAlmostEqual(self.recording.expected_height(0, 1), -0.1)
+
+        self.add_contact(1, [0, 0.01, -0.09])
+        # Plane through the points, z = -0.1 + y
+        self.assertAlmostEqual(self.recording.expected_height(0.02, 0.02),
+                               -0.08)
+
+    def test_expected_height_degenerate(self):
+        # Two rows with one point each
+        self.add_contact(0, [0, 0, -0.1])
+        self.add_contact(1, [0, 0.01, -0.11])
+        self.assertAlmostEqual(self.recording.expected_height(0, 0.02), -0.11)
+        # Points on a line
+        self.add_contact(2, [0, 0.02, -0.12])
+        self.assertAlmostEqual(self.recording.expected_height(0, 0.03), -0.12)
+
+
+@unittest.skipUnless(HAVE_DVRK, "needs the dVRK packages")
+class TestSimulation(unittest.TestCase):
+
+    DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "data")
+    REPLAY_FOLDER = os.path.join(DATA_FOLDER, "PSM1_2019-07-26_14-35-12")
+    PLANE_FOLDER = os.path.join(DATA_FOLDER, "PSM1_2019-07-26_11-48-56")
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        # Recordings are written to data/ in the current folder
+        os.chdir(self.folder)
+        os.mkdir("data")
+        self.rob_file = os.path.join(self.folder, "psm.rob")
+        with open(self.rob_file, 'w') as robfile:
+            robfile.write(PSM_ROB)
+        self.rob_file, analyze.ROB_FILE = analyze.ROB_FILE, self.rob_file
+
+    def tearDown(self):
+        analyze.ROB_FILE = self.rob_file
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def simulate_args(self, kind, replay_folder, **kwargs):
+        """Gets the arguments of `calibrate.py simulate` with its defaults"""
+        args = dict(
+            kind=kind, replay_folder=replay_folder, offset=0, rob_file=None,
+            samples=10, verbose=False, live=False, continuous=False,
+            no_prediction=False, no_reorder=False, sample_spacing=0.05,
+            settle_tolerance=0.5, tracker_reference=None, tracker_volume=None
+        )
+        args.update(kwargs)
+        return argparse.Namespace(**args)
+
+    def record_tracker(self, continuous):
+        """Simulates a tracker recording of an arm with an offset of 1mm
+        :returns tuple of (recording, offset found in millimeters)"""
+        from simulation import SimulatedClock, SimulatedArmState
+        from simulation import SimulatedArm, SimulatedMarker
+        from tracker_recording import TrackerRecording
+        clock = SimulatedClock()
+        state = SimulatedArmState(clock)
+        arm = SimulatedArm(load_psm(), clock, state, offset=0.001)
+        marker = SimulatedMarker.from_session(self.REPLAY_FOLDER, arm, clock)
+        recording = TrackerRecording("SIM", None, marker=marker, arm=arm,
+                                     state=state, clock=clock)
+        joint_set = recording.prescreen(
+            list(recording.gen_wide_joint_positions(nsamples=4))
+        )
+        if continuous:
+            recording.record_continuous(joint_set)
+        else:
+            recording.record_joints(joint_set)
+        recording.output_to_csv()
+        report = pipeline.analyze_session(recording.folder)
+        return recording, report["offset"]
+
+    def test_tracker(self):
+        recording, offset = self.record_tracker(continuous=False)
+        self.assertGreater(len(recording.data), 50)
+        # Simulated poses settle on their mean marker positions
+        settle_times = [point["settle_time"] for point in recording.data]
+        self.assertLess(np.median(settle_times),
+                        recording.SETTLE_DWELL)
+        self.assertAlmostEqual(offset, 1, delta=0.2)
+
+    def test_plane(self):
+        """Simulates a plane recording of an arm with an offset of 2mm,
+        with the kinematics only given by --rob-file"""
+        rob_file, analyze.ROB_FILE = analyze.ROB_FILE, "missing.rob"
+        args = self.simulate_args("plane", self.PLANE_FOLDER, offset=2,
+                                  rob_file=rob_file, samples=4, live=True)
+        folder = calibrate.parse_simulate(args)
+        self.assertEqual(analyze.ROB_FILE, rob_file)
+        info = calibrate.parse_info(os.path.join(folder, "info.txt"))
+        self.assertIn("Live Offset", info)
+        report = pipeline.analyze_session(folder)
+        self.assertEqual(report["points"], 16)
+        self.assertAlmostEqual(report["offset"], 2, delta=0.3)
+
+    def test_single_palpation_surface(self):
+        from simulation import SimulatedSurface
+        session = load_session(self.PLANE_FOLDER)
+        name = session.palpation_files[0]
+        shutil.copy(os.path.join(self.PLANE_FOLDER, name),
+                    os.path.join("data", "single_palpation.csv"))
+        surface = SimulatedSurface.from_session("data")
+        # Level at the contact point
+        self.assertEqual(len(surface.profiles), 1)
+        contact = surface.profiles[0].contact
+        self.assertAlmostEqual(surface.height(0, 0), contact[2])
+        self.assertAlmostEqual(surface.height(1, 1), contact[2])
+        low, high = surface.bounds()
+        np.testing.assert_allclose(high - low, 2 * surface.SINGLE_MARGIN)
+
+        # Single palpations of old sessions have no positions
+        with self.assertRaises(ValueError):
+            SimulatedSurface.from_session(
+                os.path.join(self.DATA_FOLDER, "PSM3_2019-07-10_12-10-32")
+            )
+
+    def record_level_surface(self):
+        """Gets a plane recording of a level surface 5mm below the arm,
+        with noisy wrenches
+        :returns tuple of (recording, simulated arm, height of the
+            surface)"""
+        from simulation import SimulatedClock, SimulatedArmState
+        from simulation import SimulatedArm, SimulatedSurface, WrenchProfile
+        from plane_recording import PlaneRecording
+        clock = SimulatedClock()
+        state = SimulatedArmState(clock)
+        # 4000 N/m in contact, like the recorded palpations
+        profile = WrenchProfile(np.array([-0.01, 0, 0.01]),
+                                np.array([0, 0, 40.0]))
+        surface = SimulatedSurface(np.zeros(3), [profile], [[0, 0]])
+        arm = SimulatedArm(load_psm(), clock, state, surface)
+        recording = PlaneRecording("SIM", arm=arm, state=state, clock=clock)
+        height = arm.get_current_position().p[2] - 0.005
+        surface.coefs[2] = height
+        return recording, arm, height
+
+    def test_palpate_predicted(self):
+        recording, arm, height = self.record_level_surface()
+        recording.contacts = PlaneStatistics()
+        recording.contact_rows = set()
+        nmoves = []
+
+        def palpate(expected_z):
+            start = arm.nmoves
+            palpation_file = os.path.join(
+                recording.folder, "palpation_0_{}.csv".format(len(nmoves))
+            )
+            pos_v_wrench = recording.palpate(palpation_file, expected_z)
+            nmoves.append(arm.nmoves - start)
+            pos, _ = recording.find_contact(pos_v_wrench)
+            self.assertAlmostEqual(pos[2], height, delta=0.0001)
+            return pos
+
+        pos = palpate(None)
+        recording.contacts.add(np.array([pos]))
+        recording.contact_rows.add(0)
+        recording.last_contact = pos
+        # From 2mm above the last contact point
+        palpate(recording.expected_height(pos[0], pos[1]))
+        for dx in [-0.01, 0.01]:
+            recording.contacts.add(np.array([[pos[0] + dx, pos[1] + 0.01,
+                                              height]]))
+        recording.contact_rows.add(1)
+        # From 1mm above the plane of the contact points
+        palpate(recording.expected_height(pos[0], pos[1]))
+        # Skipping the coarse search and more of the fine search
+        self.assertLess(nmoves[1], nmoves[0])
+        self.assertLess(nmoves[2], nmoves[1] - 5)
+
+    def test_palpate_continuous(self):
+        """Palpates a level surface with noisy wrenches"""
+        recording, _, height = self.record_level_surface()
+
+        for i in range(3):
+            palpation_file = os.path.join(recording.folder,
+                                          "palpation_0_{}.csv".format(i))
+            pos_v_wrench = recording.palpate_continuous(palpation_file)
+            self.assertTrue(pos_v_wrench)
+            pos, _ = recording.find_contact(pos_v_wrench)
+            self.assertIsNotNone(pos)
+            self.assertAlmostEqual(pos[2], height, delta=0.00005)
+
+    def test_tracker_continuous(self):
+        recording, offset = self.record_tracker(continuous=True)
+        self.assertGreater(len(recording.data), 200)
+        self.assertAlmostEqual(recording.info["Tracker Latency"], 0.03,
+                               delta=0.01)
+        self.assertAlmostEqual(offset, 1, delta=0.2)
@@ -0,0 +1,185 @@
+from __future__ import division, print_function
+import numpy as np
+from profiler import profiled, PROFILER
+
+
+REVOLUTE = 0
+PRISMATIC = 1
+
+# Joint type names used in cisst .rob files
+JOINT_TYPES = {
+    "revolute": REVOLUTE,
+    "hinge": REVOLUTE,
+    "prismatic": PRISMATIC,
+    "slider": PRISMATIC,
+}
+
+
+class Manipulator(object):
+    """
+    Pure NumPy forward kinematics for a serial DH chain
+
+    Mirrors `cisstRobotPython.robManipulator` for the kinematic part of a
+    .rob file, but evaluates whole stacks of joint vectors at once
+    """
+
+    def __init__(self, conventions, alpha, a, theta, d, types, offsets,
+                 q_min=None, q_max=None):
+        self.conventions = list(conventions)
+        self.alpha = np.asarray(alpha, dtype=np.float64)
+        self.a = np.asarray(a, dtype=np.float64)
+        self.theta = np.asarray(theta, dtype=np.float64)
+        self.d = np.asarray(d, dtype=np.float64)
+        self.types = np.asarray(types, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.float64)
+        nlinks = len(self.conventions)
+        if q_min is None:
+            q_min = np.full(nlinks, -np.inf)
+        if q_max is None:
+            q_max = np.full(nlinks, np.inf)
+        self.q_min = np.asarray(q_min, dtype=np.float64)
+        self.q_max = np.asarray(q_max, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.conventions)
+
+    @profiled("forward kinematics")
+    def link_transforms(self, q):
+        """
+        Gets the transform of every link for a stack of joint vectors
+        :param numpy.ndarray q Joint positions of shape (..., njoints)
+        :returns Link transforms of shape (..., nlinks, 4, 4), where `nlinks`
+            is the smaller of the number of links and `njoints`
+        """
+        q = np.asarray(q, dtype=np.float64)
+        PROFILER.count("forward kinematics poses", q.size // q.shape[-1])
+        n = min(len(self), q.shape[-1])
+        q = q[..., :n]
+
+        revolute = self.types[:n] == REVOLUTE
+        theta = self.theta[:n] + np.where(revolute, q + self.offsets[:n], 0)
+        d = self.d[:n] + np.where(revolute, 0, q + self.offsets[:n])
+        alpha = np.broadcast_to(self.alpha[:n], theta.shape)
+        a = np.broadcast_to(self.a[:n], theta.shape)
+
+        ct, st = np.cos(theta), np.sin(theta)
+        ca, sa = np.cos(alpha), np.sin(alpha)
+
+        T = np.zeros(theta.shape + (4, 4))
+        T[..., 3, 3] = 1
+        for i, convention in enumerate(self.conventions[:n]):
+            Ti = T[..., i, :, :]
+            if convention == "modified":
+                # Rx(alpha) Tx(a) Rz(theta) Tz(d)
+                Ti[..., 0, 0] = ct[..., i]
+                Ti[..., 0, 1] = -st[..., i]
+                Ti[..., 0, 3] = a[..., i]
+                Ti[..., 1, 0] = st[..., i] * ca[..., i]
+                Ti[..., 1, 1] = ct[..., i] * ca[..., i]
+                Ti[..., 1, 2] = -sa[..., i]
+                Ti[..., 1, 3] = -sa[..., i] * d[..., i]
+                Ti[..., 2, 0] = st[..., i] * sa[..., i]
+                Ti[..., 2, 1] = ct[..., i] * sa[..., i]
+                Ti[..., 2, 2] = ca[..., i]
+                Ti[..., 2, 3] = ca[..., i] * d[..., i]
+            else:
+                # Rz(theta) Tz(d) Tx(a) Rx(alpha)
+                Ti[..., 0, 0] = ct[..., i]
+                Ti[..., 0, 1] = -st[..., i] * ca[..., i]
+                Ti[..., 0, 2] = st[..., i] * sa[..., i]
+                Ti[..., 0, 3] = a[..., i] * ct[..., i]
+                Ti[..., 1, 0] = st[..., i]
+                Ti[..., 1, 1] = ct[..., i] * ca[..., i]
+                Ti[..., 1, 2] = -ct[..., i] * sa[..., i]
+                Ti[..., 1, 3] = a[..., i] * st[..., i]
+                Ti[..., 2, 1] = sa[..., i]
+                Ti[..., 2, 2] = ca[..., i]
+                Ti[..., 2, 3] = d[..., i]
+        return T
+
+    def forward_kinematics(self, q):
+        """
+        Batched equivalent of `robManipulator.ForwardKinematics`
+        :param numpy.ndarray q Joint positions of shape (..., njoints)
+        :returns Homogeneous transforms of shape (..., 4, 4)
+        """
+        T = self.link_transforms(q)
+        frame = T[..., 0, :, :]
+        for i in range(1, T.shape[-3]):
+            frame = np.matmul(frame, T[..., i, :, :])
+        return frame
+
+    def positions(self, q):
+        """
+        Gets only the tool tip positions for a stack of joint vectors
+        :param numpy.ndarray q Joint positions of shape (..., njoints)
+        :returns Positions of shape (..., 3)
+        """
+        return self.forward_kinematics(q)[..., :3, 3]
+
+    def position_and_axis(self, q, joint=2):
+        """
+        Gets the tool tip positions along with the axis of the prismatic
+        joint `joint`, so that changing q[joint] by `offset` moves the tool
+        tip to `position + offset * axis`
+        :param numpy.ndarray q Joint positions of shape (..., njoints)
+        :param int joint The prismatic joint
+        :returns tuple of positions and unit axes, both of shape (..., 3)
+        """
+        if self.types[joint] != PRISMATIC:
+            raise ValueError("Joint {} is not prismatic".format(joint))
+        T = self.link_transforms(q)
+        # The modified convention moves along z of the joint's own frame,
+        # the standard convention along z of the previous frame
+        if self.conventions[joint] == "modified":
+            axis_link = joint + 1
+        else:
+            axis_link = joint
+
+        frame = np.broadcast_to(np.eye(4), T.shape[:-3] + (4, 4))
+        for i in range(T.shape[-3]):
+            if i == axis_link:
+                axis = frame[..., :3, 2]
+            frame = np.matmul(frame, T[..., i, :, :])
+        if axis_link == T.shape[-3]:
+            axis = frame[..., :3, 2]
+        return frame[..., :3, 3], axis
+
+
+def load_rob(filename):
+    """
+    Loads the DH chain from a cisst .rob file
+    :param str filename The .rob file to read
+    :rtype Manipulator
+    """
+    with open(filename) as robfile:
+        lines = [
+            line.split("#")[0].split()
+            for line in robfile
+        ]
+    lines = [line for line in lines if line]
+
+    nlinks = int(lines[0][0])
+    if len(lines) < nlinks + 1:
+        raise ValueError("{} has fewer than {} links".format(filename, nlinks))
+
+    params = {key: [] for key in ("conventions", "alpha", "a", "theta", "d",
+                                  "types", "offsets", "q_min", "q_max")}
+
+    # Each link is in the format
+    # convention alpha a theta d type mode offset min max ftmax ...
+    for line in lines[1:nlinks + 1]:
+        convention = line[0].lower()
+        if convention not in ("standard", "modified"):
+            raise ValueError("Unsupported DH convention: {}".format(line[0]))
+        params["conventions"].append(convention)
+        params["alpha"].append(float(line[1]))
+        params["a"].append(float(line[2]))
+        params["theta"].append(float(line[3]))
+        params["d"].append(float(line[4]))
+        params["types"].append(JOINT_TYPES[line[5].lower()])
+        params["offsets"].append(float(line[7]) if len(line) > 7 else 0)
+        params["q_min"].append(float(line[8]) if len(line) > 8 else -np.inf)
+        params["q_max"].append(float(line[9]) if len(line) > 9 else np.inf)
+
+    return Manipulator(**params)
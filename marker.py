@@ -2,6 +2,7 @@ import sys
 import numpy as np
 import rospy
 from sensor_msgs.msg import PointCloud
+from ring_buffer import StateRingBuffer
 
 class Marker:
 
@@ -12,6 +13,8 @@ class Marker:
         self.bad_callback = False
         self.n_bad_callbacks = 0
         self.total_points = []
+        # Timestamped positions of the good callbacks
+        self.positions = StateRingBuffer(3)
 
     def callback(self, data):
         self.total_points = data.points
@@ -27,6 +30,8 @@ class Marker:
                 [data.points[0].x, data.points[0].y, data.points[0].z],
                 dtype=np.float64
             )
+            stamp = data.header.stamp.to_sec() or rospy.get_time()
+            self.positions.append(stamp, self._coord)
 
     def get_current_position(self):
         if self.bad_callback:
@@ -0,0 +1,81 @@
+from __future__ import division, print_function
+import numpy as np
+from analyze import minimize_offset
+from plane_statistics import PlaneStatistics
+
+
+class OffsetEstimator(object):
+    """
+    Estimate of the offset of joint 2 that is updated as the contact points
+    of a plane are recorded, so that a recording can show whether it is
+    converging while it runs
+
+    Each contact point is added to running `PlaneStatistics`, so updating
+    the estimate doesn't depend on the number of points recorded so far
+    """
+
+    # A plane and the offset are 4 parameters,
+    # so at least one more point is needed to estimate the error
+    MIN_POINTS = 5
+
+    def __init__(self, rob, tolerance=0.01):
+        """
+        :param kinematics.Manipulator rob The kinematics of the arm
+        :param float tolerance Tolerance of the offset in tenths of a
+            millimeter
+        """
+        self.rob = rob
+        self.tolerance = tolerance
+        self.stats = PlaneStatistics()
+
+    @property
+    def npoints(self):
+        return self.stats.npoints
+
+    def add(self, joints):
+        """
+        Adds contact points to the estimate
+        :param numpy.ndarray joints Joint positions of shape (6,) or (N, 6)
+        """
+        positions, axes = self.rob.position_and_axis(np.atleast_2d(joints), 2)
+        self.stats.add(positions, axes)
+
+    def error_fn(self, offsets):
+        """Gets the error of the plane at each offset in tenths of a
+        millimeter"""
+        return self.stats.fit(np.atleast_1d(offsets) / 10000)[1]
+
+    def sum_of_squares(self, offsets):
+        """Gets the sum of the squared distances to the plane at each
+        offset in tenths of a millimeter"""
+        return self.npoints * self.error_fn(offsets) ** 2
+
+    def estimate(self):
+        """
+        Finds the offset with the minimum error along with its standard
+        deviation, from the curvature of the sum of squares S at the minimum:
+            variance = 2 * S_min / (npoints - 4) / S''
+        :returns tuple of (offset, error, standard deviation) with the offset
+            and standard deviation in tenths of a millimeter, or None if
+            fewer than MIN_POINTS points were added
+        """
+        if self.npoints < self.MIN_POINTS:
+            return None
+
+        offset, error = minimize_offset(self.error_fn,
+                                        tolerance=self.tolerance)
+
+        # Second derivative of the sum of squares by central differences
+        step = 1
+        s_prev, s_min, s_next = self.sum_of_squares(
+            [offset - step, offset, offset + step]
+        )
+        curvature = (s_prev - 2 * s_min + s_next) / step ** 2
+        variance = 2 * s_min / (self.npoints - 4)
+        if curvature > 0:
+            std = np.sqrt(variance / curvature)
+        else:
+            # The error doesn't change with the offset yet
+            std = np.inf
+
+        return offset, error, std
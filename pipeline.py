@@ -0,0 +1,344 @@
+from __future__ import division, print_function
+import os
+import os.path
+import glob
+import json
+import time
+import hashlib
+import numpy as np
+import analyze
+from analyze import (analyze_palpations, get_linear_error_fn,
+                     get_offset_errors, get_min_value, minimize_offset,
+                     sweep_offsets, write_offset_v_error)
+from kinematics import load_rob
+from profiler import profiled, PROFILER
+from session import (load_session, JOINT_COLUMNS, POSITION_COLUMNS,
+                     TRACKER_COLUMNS)
+
+
+# Cached outputs of the stages are stored in this folder
+# inside the session folder
+CACHE_FOLDER = ".cache"
+
+# Number of outputs of each stage to keep in the cache
+CACHE_SIZE = 4
+
+# Bump the version of a stage after changing what it computes
+# so that its cached outputs are recomputed
+STAGE_VERSIONS = {
+    "contacts": 1,
+    "kinematics": 1,
+    "sweep": 1,
+}
+
+
+def hash_key(*parts):
+    """Hashes json-serializable `parts` into a cache key"""
+    text = json.dumps(parts, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 16), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Pipeline(object):
+    """
+    Analysis of a session as a chain of stages:
+        load -> contacts -> kinematics -> sweep -> report
+
+    load hashes the recorded files, contacts detects the contact points of
+    the palpations (or reads the tracker point cloud), kinematics runs
+    forward kinematics on the points, sweep finds the error at each offset
+    and report writes the results. The output of each stage is cached in
+    {folder}/.cache, keyed by a hash of its parameters and of the key of the
+    stage before it, so changing anything upstream recomputes everything
+    downstream, and unchanged stages are loaded instead of recomputed
+    """
+
+    def __init__(self, folder, linear=True, step=1, search=False,
+                 tolerance=0.01, jobs=1, reanalyze_palpations=True,
+                 write_offset_v_error=True, use_cache=True):
+        """
+        :param bool reanalyze_palpations Detect the contact points from the
+            palpations even if plane.csv already exists
+        :param bool write_offset_v_error Write the error at every offset
+            to {folder}/offset_v_error.csv
+        :param bool use_cache Load unchanged stages from the cache instead
+            of recomputing them
+        """
+        self.folder = folder
+        self.session = load_session(folder)
+        self.tracker = self.session.is_tracker
+        self.linear = linear
+        self.step = step
+        self.search = search
+        self.tolerance = tolerance
+        self.jobs = jobs
+        self.reanalyze_palpations = reanalyze_palpations
+        self.write_offset_v_error = write_offset_v_error
+        self.use_cache = use_cache
+        # Names of the stages loaded from the cache in the last run
+        self.cached_stages = []
+
+    def _cached(self, stage, key, compute):
+        """
+        Loads the output of `stage` with `key` from the cache,
+        or calls `compute` to get it and caches it
+        :param callable compute Returns a dict of numpy arrays
+        """
+        cache_folder = os.path.join(self.folder, CACHE_FOLDER)
+        filename = os.path.join(cache_folder, "{}-{}.npz".format(stage, key))
+
+        if self.use_cache and os.path.exists(filename):
+            self.cached_stages.append(stage)
+            PROFILER.count("cached stages")
+            cached = np.load(filename)
+            try:
+                return {name: cached[name] for name in cached.files}
+            finally:
+                cached.close()
+
+        with PROFILER.stage(stage):
+            outputs = compute()
+
+        if not os.path.isdir(cache_folder):
+            os.mkdir(cache_folder)
+        # Only keep the most recent outputs of the stage
+        old_files = sorted(
+            glob.glob(os.path.join(cache_folder, stage + "-*.npz")),
+            key=os.path.getmtime
+        )
+        stale = max(len(old_files) - CACHE_SIZE + 1, 0)
+        for old_file in old_files[:stale]:
+            os.remove(old_file)
+        np.savez(filename, **outputs)
+        return outputs
+
+    def _hash_table(self, name):
+        if os.path.exists(os.path.join(self.folder, name)):
+            return hash_file(os.path.join(self.folder, name))
+        # Only packed
+        data = np.ascontiguousarray(self.session.table(name).data)
+        return hashlib.sha1(data.tobytes()).hexdigest()
+
+    @property
+    def input_files(self):
+        """Recorded files that the analysis depends on"""
+        if self.tracker:
+            return [self.session.tracker_file]
+        if self.uses_palpations:
+            return self.session.palpation_files
+        return ["plane.csv"]
+
+    @property
+    def uses_palpations(self):
+        """Whether the contact points are detected from the palpations
+        instead of read from plane.csv"""
+        if self.tracker or not self.session.palpation_files:
+            return False
+        return (self.reanalyze_palpations
+                or not self.session.exists("plane.csv"))
+
+    @profiled("load")
+    def load(self):
+        """:returns the key of the recorded files"""
+        return hash_key("load", [
+            (name, self._hash_table(name))
+            for name in self.input_files
+        ])
+
+    def contacts(self, load_key):
+        """:returns tuple of (key, outputs) with the joints and positions
+        of the points, along with their tracker positions if tracked"""
+        key = hash_key("contacts", STAGE_VERSIONS["contacts"], load_key,
+                       self.tracker, self.uses_palpations,
+                       analyze.MIN_RESIDUAL_DIFF)
+
+        def compute():
+            if self.tracker:
+                table = self.session.tracker
+                return {
+                    "joints": table.get(*JOINT_COLUMNS),
+                    "positions": table.get(*POSITION_COLUMNS),
+                    "tracker": table.get(*TRACKER_COLUMNS),
+                }
+            if self.uses_palpations:
+                analyze_palpations(self.folder, jobs=self.jobs)
+            table = self.session.plane
+            return {
+                "joints": table.get(*JOINT_COLUMNS),
+                "positions": table.get(*POSITION_COLUMNS),
+            }
+
+        return key, self._cached("contacts", key, compute)
+
+    def kinematics(self, contacts_key, contacts):
+        """:returns tuple of (key, outputs) with the forward kinematics
+        positions of the points and the axes of joint 2"""
+        key = hash_key("kinematics", STAGE_VERSIONS["kinematics"],
+                       contacts_key, hash_file(analyze.ROB_FILE))
+
+        def compute():
+            rob = load_rob(analyze.ROB_FILE)
+            positions, axes = rob.position_and_axis(contacts["joints"], 2)
+            return {"positions": positions, "axes": axes}
+
+        return key, self._cached("kinematics", key, compute)
+
+    def error_fn(self, contacts, kinematics):
+        """
+        Gets a function that takes an array of offsets in tenths of a
+        millimeter and returns the error of the session at each offset
+        """
+        tracker_coord_set = [contacts["tracker"]] if self.tracker else []
+        if self.linear:
+            return get_linear_error_fn(
+                [(kinematics["positions"], kinematics["axes"])],
+                tracker_coord_set, self.tracker
+            )
+
+        rob = load_rob(analyze.ROB_FILE)
+
+        def error_fn(offsets):
+            return get_offset_errors(rob, [contacts["joints"]],
+                                     tracker_coord_set, offsets,
+                                     self.tracker, linear=False)
+
+        return error_fn
+
+    def sweep(self, kinematics_key, contacts, kinematics):
+        """:returns tuple of (key, outputs) with the offset with the minimum
+        error, along with the error at every offset unless searching"""
+        key = hash_key("sweep", STAGE_VERSIONS["sweep"], kinematics_key,
+                       self.linear, self.step, self.search, self.tolerance)
+
+        def compute():
+            error_fn = self.error_fn(contacts, kinematics)
+            if self.search:
+                offset, error = minimize_offset(error_fn,
+                                                tolerance=self.tolerance)
+                return {"offset": offset, "error": error}
+            offset_v_error = sweep_offsets(error_fn, self.step)
+            offset, error = get_min_value(offset_v_error)
+            return {"offset": offset, "error": error,
+                    "offset_v_error": offset_v_error}
+
+        return key, self._cached("sweep", key, compute)
+
+    def report(self, sweep, npoints, start_time):
+        """
+        Writes the error at every offset to {folder}/offset_v_error.csv
+        if it was swept and changed
+        :returns dict of the offset correction in millimeters, its error,
+            the number of points and the time taken in seconds
+        """
+        if self.write_offset_v_error and "offset_v_error" in sweep:
+            filename = os.path.join(self.folder, "offset_v_error.csv")
+            if ("sweep" not in self.cached_stages
+                    or not os.path.exists(filename)):
+                write_offset_v_error(filename, sweep["offset_v_error"])
+
+        return {
+            "folder": self.folder,
+            "tracker": self.tracker,
+            "points": npoints,
+            # Convert from tenths of a millimeter to millimeters
+            "offset": float(sweep["offset"]) / 10,
+            "error": float(sweep["error"]),
+            "time": time.time() - start_time,
+        }
+
+    def prepare(self):
+        """
+        Runs the stages before the sweep, skipping the ones that are cached
+        :returns tuple of (kinematics key, contacts outputs,
+            kinematics outputs)
+        """
+        self.cached_stages = []
+        load_key = self.load()
+        contacts_key, contacts = self.contacts(load_key)
+        kinematics_key, kinematics = self.kinematics(contacts_key, contacts)
+        return kinematics_key, contacts, kinematics
+
+    def run(self):
+        """
+        Runs every stage, skipping the ones that are cached
+        :returns tuple of (report, sweep outputs)
+        """
+        start_time = time.time()
+        kinematics_key, contacts, kinematics = self.prepare()
+        sweep_key, sweep = self.sweep(kinematics_key, contacts, kinematics)
+        report = self.report(sweep, len(contacts["joints"]), start_time)
+        return report, sweep
+
+
+def analyze_session(folder, **kwargs):
+    """
+    Finds the offset of a single session without any prompts or graphs,
+    reusing the cached stages of earlier runs. See `Pipeline` for the
+    keyword arguments `kwargs`
+    :returns dict of the offset correction in millimeters, its error,
+        the number of points and the time taken in seconds
+    """
+    return Pipeline(folder, **kwargs).run()[0]
+
+
+def analyze_sessions(folders, search=False, tolerance=0.01, **kwargs):
+    """
+    Finds the offset that minimizes the sum of the errors of every session
+    in `folders`. Each session's error curve is cached by its own pipeline,
+    so only the sessions that weren't analyzed before are computed
+    :param bool search Search for the minimum of the sum of the errors
+        instead of sweeping every offset
+    :param float tolerance Tolerance of the search in tenths of a millimeter
+    :param kwargs Keyword arguments of each session's `Pipeline`
+    :returns tuple of (report, sum of the errors at every offset or None
+        if searching)
+    """
+    start_time = time.time()
+    pipelines = [Pipeline(folder, **kwargs) for folder in folders]
+
+    if len(set(pipeline.tracker for pipeline in pipelines)) > 1:
+        raise ValueError("Can't combine tracker and palpation sessions")
+
+    computed = 0
+    offset_v_error = None
+    if search:
+        error_fns = []
+        for pipeline in pipelines:
+            _, contacts, kinematics = pipeline.prepare()
+            error_fns.append(pipeline.error_fn(contacts, kinematics))
+            if "kinematics" not in pipeline.cached_stages:
+                computed += 1
+
+        offset, error = minimize_offset(
+            lambda offsets: sum(error_fn(offsets) for error_fn in error_fns),
+            tolerance=tolerance
+        )
+    else:
+        for pipeline in pipelines:
+            sweep = pipeline.run()[1]
+            if "sweep" not in pipeline.cached_stages:
+                computed += 1
+            if offset_v_error is None:
+                offset_v_error = sweep["offset_v_error"].copy()
+            else:
+                # Curves with the same step are on the same offsets
+                offset_v_error[:, 1] += sweep["offset_v_error"][:, 1]
+        offset, error = get_min_value(offset_v_error)
+
+    report = {
+        "sessions": len(folders),
+        "computed": computed,
+        "tracker": pipelines[0].tracker,
+        # Convert from tenths of a millimeter to millimeters
+        "offset": float(offset) / 10,
+        "error": float(error),
+        "time": time.time() - start_time,
+    }
+    return report, offset_v_error
@@ -2,10 +2,16 @@ from __future__ import print_function, division
 import sys
 import os.path
 import csv
-import time
 import PyKDL
 import rospy
-from record import Recording
+import numpy as np
+import analyze
+from analyze import analyze_palpation
+from kinematics import load_rob
+from offset_estimator import OffsetEstimator
+from plane_statistics import PlaneStatistics
+from profiler import profiled
+from recording import Recording
 
 class PlaneRecording(Recording):
 
@@ -15,6 +21,41 @@ class PlaneRecording(Recording):
 
     SEARCH_THRESH = 1.4
 
+    # Speeds of the descents of a continuous palpation in m/s
+    CONTACT_SPEED = 0.005
+    PALPATE_SPEED = 0.001
+    # Rate at which the arm is commanded in Hz
+    PALPATE_RATE = 200
+    # Samples of a continuous palpation are averaged over every
+    # SAMPLE_SPACING of the descent, since the contact detection
+    # differentiates the wrench and is sensitive to its noise. The contact
+    # is told apart from free motion by a slope steeper than 300 N/m
+    # between neighbouring samples, so below about 0.05mm the wrench
+    # changes by less than its noise from one sample to the next
+    SAMPLE_SPACING = 0.00005
+
+    # The fine search of a palpation starts this far above the height
+    # predicted from the plane of the earlier contact points. Recorded
+    # contact points are within 1mm of the plane fitted to the points
+    # before them
+    PREDICTION_MARGIN = 0.001
+    # Or this far above the last contact point while they don't span a
+    # plane, since the height along the first row changes with the tilt
+    # of the surface
+    ROW_PREDICTION_MARGIN = 0.002
+
+    def __init__(self, robot_name, sample_spacing=None, **kwargs):
+        """
+        :param float sample_spacing Distance in meters of the descent of a
+            continuous palpation that its samples are averaged over, or None
+            for SAMPLE_SPACING
+        :param kwargs Keyword arguments of `Recording`
+        """
+        super(PlaneRecording, self).__init__(robot_name, **kwargs)
+        if sample_spacing is not None:
+            self.SAMPLE_SPACING = sample_spacing
+
+    @profiled("waiting for input")
     def get_corners(self):
         "Gets input from user to get three corners of the plane"
         pts = []
@@ -29,14 +70,29 @@ class PlaneRecording(Recording):
         pts.append(self.arm.get_current_position())
         return pts
 
-    def record_points(self, pts, nsamples, verbose=False):
+    def record_points(self, pts, nsamples, verbose=False, live=False,
+                      continuous=False, predict=True):
         """Moves in a zig-zag pattern in a grid and records the points
-        at which the arm reaches the surface"""
+        at which the arm reaches the surface
+        :param bool live Find the contact point of each palpation as soon as
+            it is recorded and print the estimate of the offset so far
+        :param bool continuous Palpate by moving down at a constant speed
+            instead of in steps
+        :param bool predict Start each palpation just above the height
+            predicted from the contact points found so far, instead of
+            searching for the surface from above"""
         if not len(pts) == 3:
             return False
 
         self.info["points"] = [pt.p for pt in pts]
 
+        if live:
+            estimator = OffsetEstimator(load_rob(analyze.ROB_FILE))
+
+        # Plane of the contact points found so far
+        self.contacts = PlaneStatistics()
+        self.contact_rows = set()
+        self.last_contact = None
 
         goal = PyKDL.Frame(self.ROT_MATRIX)
 
@@ -72,52 +128,162 @@ class PlaneRecording(Recording):
                     "palpation_{}_{}.csv".format(row, col)
                 )
 
+                if predict:
+                    expected_z = self.expected_height(goal.p[0], goal.p[1])
+                else:
+                    expected_z = None
+
                 # Returns a numpy array containing
                 # the position,joint angles vs the wrench
-                pos_v_wrench = self.palpate(palpate_file)
+                with self.telemetry.span("palpation"):
+                    if continuous:
+                        pos_v_wrench = self.palpate_continuous(palpate_file,
+                                                               expected_z)
+                    else:
+                        pos_v_wrench = self.palpate(palpate_file, expected_z)
 
                 if not pos_v_wrench:
                     rospy.logerr("Didn't reach surface. Closing program")
                     sys.exit(1)
 
+                pos, joints = self.find_contact(pos_v_wrench)
+                if pos is not None:
+                    self.contacts.add(pos)
+                    self.contact_rows.add(row)
+                    self.last_contact = pos
+                    if live:
+                        self.update_estimate(estimator, joints)
+
                 # Move back up after palpation
                 # to prevent dragging against the surface
                 goal = self.arm.get_desired_position()
                 goal.p[2] += 0.02
                 self.arm.move(goal)
 
-                time.sleep(0.5)
+                self.sleep(0.5)
+
+        if live and estimator.npoints >= estimator.MIN_POINTS:
+            offset, _, std = estimator.estimate()
+            # Convert from tenths of a millimeter to millimeters
+            self.info["Live Offset"] = "{:.2f} +/- {:.2f} mm".format(
+                offset / 10, std / 10
+            )
 
         print(rospy.get_caller_id(), '<- recording complete')
 
-    def palpate(self, output_file):
+    def find_contact(self, pos_v_wrench):
+        """Finds the contact point of a palpation
+        :returns tuple of (position, joints), or (None, None) if not found"""
+        pos, joints = analyze_palpation(pos_v_wrench)
+        # Joints are left at zero if the contact is outside the palpation
+        if (pos is None or not np.all(np.isfinite(pos))
+                or not np.any(joints)):
+            rospy.logwarn("Didn't find the contact point of the palpation")
+            return None, None
+        return pos, joints
+
+    def contact_plane(self):
+        """
+        Gets the plane z = a*x + b*y + c of the contact points found so far
+        :returns tuple of (a, b, c), or None while the points don't span a
+            plane
+        """
+        if len(self.contact_rows) < 2 or self.contacts.npoints < 3:
+            # The points of a single row don't define a plane
+            return None
+        try:
+            (a, b, c), = self.contacts.fit()[0]
+        except np.linalg.LinAlgError:
+            # The points are on a line
+            return None
+        return a, b, c
+
+    def expected_height(self, x, y):
+        """
+        Predicts the height of the surface at (x, y) from the plane of the
+        contact points found so far, or from the last contact point while
+        they don't span a plane
+        :returns the height, or None if there are no contact points yet
+        """
+        if self.last_contact is None:
+            return None
+        plane = self.contact_plane()
+        if plane is None:
+            return self.last_contact[2]
+        a, b, c = plane
+        return a * x + b * y + c
+
+    def prediction_margin(self):
+        """Gets how far above the height from `expected_height` the fine
+        search starts"""
+        if self.contact_plane() is None:
+            return self.ROW_PREDICTION_MARGIN
+        return self.PREDICTION_MARGIN
+
+    def update_estimate(self, estimator, joints):
+        """Adds the joints of a contact point to `estimator`
+        and prints the current estimate of the offset"""
+        estimator.add(joints)
+
+        estimate = estimator.estimate()
+        if estimate is None:
+            print("\t{} contact points, need {} for an estimate"
+                  .format(estimator.npoints, estimator.MIN_POINTS))
+            return
+        offset, error, std = estimate
+        # Convert from tenths of a millimeter to millimeters
+        print("\toffset: {:.2f}mm +/- {:.2f}mm, error: {:.6f} ({} points)"
+              .format(offset / 10, std / 10, error, estimator.npoints))
+
+    def start_near(self, goal, expected_z):
+        """Moves `goal` to `prediction_margin` above `expected_z`
+        :returns whether the arm is still above the surface there"""
+        goal.p[2] = min(goal.p[2], expected_z + self.prediction_margin())
+        self.arm.move(goal)
+        self.sleep(0.5)
+        if self.state.snapshot().wrench[2] < self.CONTACT_THRESH:
+            return True
+        print("surface is above the expected height")
+        return False
+
+    @profiled("palpate")
+    def palpate(self, output_file, expected_z=None):
         """Move down until wrenchs act on the motor in the z direction,
-        then record position, joints, and wrench body of the robot"""
+        then record position, joints, and wrench body of the robot
+        :param float expected_z Expected height of the surface. If given,
+            the fine search starts just above it, and the surface is only
+            searched for from above if it isn't found there"""
 
-        time.sleep(0.2)
+        self.sleep(0.2)
         initial = self.arm.get_desired_position()
         goal = self.arm.get_desired_position()
 
-        # Store z-position and wrench in pos_v_wrench
-        pos_v_wrench = []
         MM = 0.001
-        TENTH_MM = 0.0001
 
         # Calculate number of steps required
         # to move 2 cm with an increment of 1 mm
         STEPS_MM = int(0.06/MM)
 
-        # Calculate number of steps required
-        # to move 4 mm with an increment of 0.1 mm
-        STEPS_TENTH_MM = int(0.010/TENTH_MM)
+        if expected_z is not None:
+            if self.start_near(goal, expected_z):
+                pos_v_wrench = self.search_steps(goal)
+                if pos_v_wrench:
+                    self.write_palpation(output_file, pos_v_wrench)
+                    self.arm.move(initial)
+                    return pos_v_wrench
+                print("surface wasn't found near the expected height")
+            # Search for the surface from above instead
+            self.arm.move(initial)
+            goal = self.arm.get_desired_position()
 
         for i in range(STEPS_MM):
             goal.p[2] -= MM
             self.arm.move(goal)
-            time.sleep(0.1)
-            if self.arm.get_current_wrench_body()[2] > self.CONTACT_THRESH:
+            self.sleep(0.1)
+            state = self.state.snapshot()
+            if state.wrench[2] > self.CONTACT_THRESH:
                 # Record initial contact
-                goal.p = self.arm.get_current_position().p
+                goal.p = PyKDL.Vector(*state.position)
                 break
             elif i == STEPS_MM - 1:
                 return False
@@ -125,16 +291,46 @@ class PlaneRecording(Recording):
         # move arm 3mm up
         goal.p[2] += 0.003
 
-        time.sleep(0.5)
+        self.sleep(0.5)
         self.arm.move(goal)
 
+        pos_v_wrench = self.search_steps(goal)
+        if not pos_v_wrench:
+            print("wasn't able to recheck")
+            return False
+
+        self.write_palpation(output_file, pos_v_wrench)
+
+        self.arm.move(initial)
+
+        return pos_v_wrench
+
+    @profiled("search steps")
+    def search_steps(self, goal):
+        """
+        Moves down from `goal` in steps of 0.1mm until the wrench reaches
+        PALPATE_THRESH
+        :returns list of the samples in the format
+            [x, y, z, wrench, joint_0, ..., joint_5], or False if the wrench
+            never reached PALPATE_THRESH
+        """
+        # Store z-position and wrench in pos_v_wrench
+        pos_v_wrench = []
+        TENTH_MM = 0.0001
+
+        # Calculate number of steps required
+        # to move 4 mm with an increment of 0.1 mm
+        STEPS_TENTH_MM = int(0.010/TENTH_MM)
+
         for i in range(STEPS_TENTH_MM): # in tenths of millimeters
             goal.p[2] -= TENTH_MM
             self.arm.move(goal)
-            time.sleep(0.4)
-            wrench = self.arm.get_current_wrench_body()[2]
-            pos = self.arm.get_current_position().p
-            joints = self.arm.get_current_joint_position()
+            self.sleep(0.4)
+            # Position, wrench and joints at the same time
+            state = self.state.snapshot()
+            wrench = state.wrench[2]
+            pos = state.position
+            joints = state.joints
             # Add position, wrench
             pos_v_wrench.append([
                 pos[0], pos[1], pos[2],
@@ -144,10 +340,107 @@ class PlaneRecording(Recording):
             if abs(wrench) >= self.PALPATE_THRESH:
                 break
             elif i == STEPS_TENTH_MM - 1:
-                print("wasn't able to recheck")
                 return False
 
-        outfile = open(output_file, 'w')
+        return pos_v_wrench
+
+    @profiled("palpate")
+    def palpate_continuous(self, output_file, expected_z=None):
+        """Same as `palpate`, but moves down at a constant speed while
+        recording every sample of the position, joints and wrench body of
+        the robot instead of stopping after every step"""
+
+        self.sleep(0.2)
+        initial = self.arm.get_desired_position()
+        goal = self.arm.get_desired_position()
+
+        if expected_z is not None:
+            if self.start_near(goal, expected_z):
+                pos_v_wrench = self.descend(goal, self.PALPATE_SPEED, 0.010,
+                                            self.PALPATE_THRESH,
+                                            absolute=True)
+                if pos_v_wrench is not None:
+                    self.write_palpation(output_file, pos_v_wrench)
+                    self.arm.move(initial)
+                    return pos_v_wrench
+                print("surface wasn't found near the expected height")
+            # Search for the surface from above instead
+            self.arm.move(initial)
+            goal = self.arm.get_desired_position()
+
+        # Find the surface quickly
+        if self.descend(goal, self.CONTACT_SPEED, 0.06,
+                        self.CONTACT_THRESH) is None:
+            return False
+
+        # Move arm 3mm above the initial contact
+        goal.p = PyKDL.Vector(*self.state.snapshot().position)
+        goal.p[2] += 0.003
+        self.arm.move(goal)
+        self.sleep(0.5)
+
+        pos_v_wrench = self.descend(goal, self.PALPATE_SPEED, 0.010,
+                                    self.PALPATE_THRESH, absolute=True)
+        if pos_v_wrench is None:
+            print("wasn't able to recheck")
+            return False
+
+        self.write_palpation(output_file, pos_v_wrench)
+
+        self.arm.move(initial)
+
+        return pos_v_wrench
+
+    @profiled("descend")
+    def descend(self, goal, speed, distance, thresh, absolute=False):
+        """
+        Moves down from `goal` at `speed` until the wrench reaches `thresh`.
+        The arm is commanded at PALPATE_RATE, and the samples are taken from
+        every state message received during the descent
+        :param float speed Speed in m/s
+        :param float distance Maximum distance to move down in meters
+        :param bool absolute Compare the magnitude of the wrench to `thresh`
+            like the steps of `search_steps`, instead of only the wrench
+            pushing up like the search for the surface in `palpate`
+        :returns list of the samples in the same format as `palpate`,
+            or None if the wrench never reached `thresh`
+        """
+        start_z = goal.p[2]
+        period = 1 / self.PALPATE_RATE
+        start_time = self.now()
+        next_time = start_time
+        while not rospy.is_shutdown():
+            goal.p[2] = start_z - speed * (self.now() - start_time)
+            if goal.p[2] < start_z - distance:
+                return None
+            self.arm.move(goal, interpolate=False)
+
+            state = self.state.snapshot()
+            wrench = state.wrench[2]
+            if absolute:
+                wrench = abs(wrench)
+            if wrench >= thresh:
+                # Stop where the arm is
+                goal.p = PyKDL.Vector(*state.position)
+                self.arm.move(goal, interpolate=False)
+                break
+            next_time += period
+            self.sleep(max(next_time - self.now(), 0))
+        else:
+            return None
+
+        samples = self.state.window(start_time, state.time)
+        values = np.c_[samples.position, samples.wrench[:, 2], samples.joints]
+        z = samples.position[:, 2]
+        bins = np.floor((z.max() - z) / self.SAMPLE_SPACING).astype(int)
+        counts = np.bincount(bins)
+        sums = np.array([np.bincount(bins, weights=column)
+                         for column in values.T]).T
+        filled = counts > 0
+        return (sums[filled] / counts[filled, np.newaxis]).tolist()
+
+    def write_palpation(self, output_file, pos_v_wrench):
+        """Writes the samples of a palpation to `output_file`"""
         fieldnames = [
             "joint_{}_position".format(i)
             for i in range(6)
@@ -158,7 +451,6 @@ class PlaneRecording(Recording):
             "arm_position_z",
             "wrench"
         ]
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
         csv_dict = []
         for i, items in enumerate(pos_v_wrench):
             x, y, z, f = items[:4]
@@ -175,9 +467,8 @@ class PlaneRecording(Recording):
                 "arm_position_z": z,
                 "wrench": f
             })
-        writer.writeheader()
-        writer.writerows(csv_dict)
+        with self.telemetry.span("write"), open(output_file, 'w') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(csv_dict)
 
-        self.arm.move(initial)
-
-        return pos_v_wrench
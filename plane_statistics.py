@@ -0,0 +1,76 @@
+from __future__ import division, print_function
+import numpy as np
+
+
+class PlaneStatistics(object):
+    """
+    Running sums for fitting z = a*x + b*y + c to points that move along a
+    line as the offset of joint 2 changes
+
+    Every point is `position + offset * axis`, so the sums of the normal
+    equations are quadratic in the offset:
+        M(offset) = M0 + offset * (M1 + M1.T) + offset ** 2 * M2
+    where M is the sum of the outer products of (x, y, 1, z). Adding points
+    is O(1) per point, and fitting the plane at any offset is O(1)
+    """
+
+    def __init__(self):
+        self.npoints = 0
+        # Points are shifted by the first position to keep the sums small
+        self.origin = None
+        self.M0 = np.zeros((4, 4))
+        self.M1 = np.zeros((4, 4))
+        self.M2 = np.zeros((4, 4))
+
+    def add(self, positions, axes=None):
+        """
+        Adds points to the running sums
+        :param numpy.ndarray positions Positions of shape (N, 3)
+        :param numpy.ndarray axes Axes of joint 2 at each position of shape
+            (N, 3), or None if the points don't depend on the offset
+        """
+        positions = np.atleast_2d(positions)
+        if axes is None:
+            axes = np.zeros(positions.shape)
+        axes = np.atleast_2d(axes)
+        if self.origin is None:
+            self.origin = positions[0].copy()
+        positions = positions - self.origin
+
+        u = np.c_[positions[:, :2], np.ones(len(positions)), positions[:, 2]]
+        v = np.c_[axes[:, :2], np.zeros(len(axes)), axes[:, 2]]
+        self.M0 += u.T.dot(u)
+        self.M1 += u.T.dot(v)
+        self.M2 += v.T.dot(v)
+        self.npoints += len(positions)
+
+    def moments(self, offsets):
+        """
+        Gets the sums of the normal equations at each offset
+        :param numpy.ndarray offsets Offsets of joint 2 in meters
+        :returns Sums of shape (offsets, 4, 4)
+        """
+        offsets = np.atleast_1d(offsets)[:, np.newaxis, np.newaxis]
+        return (self.M0 + offsets * (self.M1 + self.M1.T)
+                + offsets ** 2 * self.M2)
+
+    def fit(self, offsets=0):
+        """
+        Gets the planes of best fit at each offset along with their errors
+        :param numpy.ndarray offsets Offsets of joint 2 in meters
+        :returns tuple of (coefficients, errors) of shapes (offsets, 3)
+            and (offsets,), with the same meaning as `get_best_fit_plane`
+        """
+        M = self.moments(offsets)
+        coefs = np.linalg.solve(M[:, :3, :3], M[:, :3, 3:])[..., 0]
+        # Sum of squared residuals of z
+        ssr = M[:, 3, 3] - np.einsum("ki,ki->k", coefs, M[:, :3, 3])
+        ssr = np.maximum(ssr, 0)
+        norms = np.sqrt(coefs[:, 0] ** 2 + coefs[:, 1] ** 2 + 1)
+        errors = np.sqrt(ssr / self.npoints) / norms
+
+        # Move intercept back from the shifted points
+        coefs[:, 2] += (self.origin[2] - coefs[:, 0] * self.origin[0]
+                        - coefs[:, 1] * self.origin[1])
+        return coefs, errors
+
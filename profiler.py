@@ -0,0 +1,226 @@
+from __future__ import division, print_function
+import os.path
+import json
+import time
+import timeit
+import functools
+import contextlib
+import collections
+
+
+class Profiler(object):
+    """
+    Times nested stages of a run and counts events, e. g. the number of
+    offsets evaluated. Stages are keyed by their stack of enclosing stages,
+    so the profile can be written as collapsed stacks for flamegraph.pl or
+    speedscope. Nothing is recorded until `start` is called
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._stack = []
+        # Stack of stage names -> [calls, total time, time in child stages]
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.start_time = None
+        self.duration = None
+
+    def reset(self):
+        self._stack = []
+        self.stages = {}
+        self.counters = collections.Counter()
+
+    def start(self):
+        self.enabled = True
+        self.start_time = timeit.default_timer()
+
+    def stop(self):
+        self.enabled = False
+        self.duration = timeit.default_timer() - self.start_time
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the body of the `with` statement as the stage `name`"""
+        if not self.enabled:
+            yield
+            return
+        self._stack.append(name)
+        key = tuple(self._stack)
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            elapsed = timeit.default_timer() - start
+            self._stack.pop()
+            entry = self.stages.setdefault(key, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            if self._stack:
+                parent = self.stages.setdefault(tuple(self._stack),
+                                                [0, 0.0, 0.0])
+                parent[2] += elapsed
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def merge(self, profile):
+        """
+        Adds the stages and counters of a profile taken in another process,
+        as returned by `profile_task`, under the current stage. The stages
+        of parallel processes add up, so they can take longer than the
+        stage that waited for them
+        """
+        if not self.enabled or profile is None:
+            return
+        prefix = tuple(self._stack)
+        for key, (calls, total, children) in profile["stages"].items():
+            entry = self.stages.setdefault(prefix + key, [0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += total
+            entry[2] += children
+        self.counters.update(profile["counters"])
+
+    def summary(self):
+        """
+        Gets the calls and times of every stage name, adding up its stacks
+        :returns list of tuples of (name, calls, total time, self time)
+            from the most to the least self time
+        """
+        totals = collections.OrderedDict()
+        for key, (calls, total, children) in sorted(self.stages.items()):
+            name = key[-1]
+            row = totals.setdefault(name, [0, 0.0, 0.0])
+            row[0] += calls
+            # A stage inside itself is only counted once
+            if name not in key[:-1]:
+                row[1] += total
+            row[2] += total - children
+        return sorted(
+            ((name, calls, total, self_time)
+             for name, (calls, total, self_time) in totals.items()),
+            key=lambda row: -row[3]
+        )
+
+    def print_summary(self):
+        print("{:<28} {:>8} {:>10} {:>10} {:>6}".format(
+            "stage", "calls", "total", "self", "%"
+        ))
+        for name, calls, total, self_time in self.summary():
+            print("{:<28} {:>8} {:>9.3f}s {:>9.3f}s {:>5.1f}%".format(
+                name, calls, total, self_time,
+                100 * self_time / self.duration if self.duration else 0
+            ))
+        # Time outside of every stage
+        untimed = self.duration - sum(
+            total
+            for key, (_, total, _) in self.stages.items()
+            if len(key) == 1
+        )
+        print("{:<28} {:>8} {:>10} {:>9.3f}s".format("(other)", "", "",
+                                                     untimed))
+        print("{:<28} {:>8} {:>10} {:>9.3f}s".format("(total)", "", "",
+                                                     self.duration))
+        for name, count in sorted(self.counters.items()):
+            print("{}: {}".format(name, count))
+
+    def write(self, folder, command=None):
+        """
+        Writes the profile to {folder}/profile_{DATE}_{TIME}.json and the
+        self time of every stack in microseconds to
+        {folder}/profile_{DATE}_{TIME}.folded
+        :returns the name of the json file
+        """
+        basename = os.path.join(
+            folder, "profile_{}".format(time.strftime("%Y-%m-%d_%H-%M-%S"))
+        )
+        profile = {
+            "command": command,
+            "duration": self.duration,
+            "stages": [
+                {"stack": list(key), "calls": calls, "time": total,
+                 "self_time": total - children}
+                for key, (calls, total, children)
+                in sorted(self.stages.items())
+            ],
+            "counters": dict(self.counters),
+        }
+        with open(basename + ".json", 'w') as outfile:
+            json.dump(profile, outfile, indent=2, sort_keys=True)
+        with open(basename + ".folded", 'w') as outfile:
+            for key, (_, total, children) in sorted(self.stages.items()):
+                outfile.write("{} {}\n".format(
+                    ";".join(key), int(round((total - children) * 1e6))
+                ))
+        return basename + ".json"
+
+
+# Profiler of the whole program, started by `calibrate.py --profile`
+PROFILER = Profiler()
+
+
+def profile_tasks(fn, args):
+    """
+    Gets the tasks to run `fn` on every argument in `args` with
+    `profile_task` in a `multiprocessing.Pool`, profiling them in the
+    workers if the profiler is running
+    """
+    return [(fn, arg, PROFILER.enabled) for arg in args]
+
+
+def profile_task(task):
+    """
+    Runs a task of `profile_tasks` in a pool worker
+    :returns tuple of (the result of the task, its profile or None), to be
+        passed to `merge_task`
+    """
+    fn, arg, enabled = task
+    if not enabled:
+        return fn(arg), None
+    # A forked worker starts with a copy of the profile of the main process
+    PROFILER.reset()
+    PROFILER.start()
+    try:
+        result = fn(arg)
+    finally:
+        PROFILER.stop()
+    return result, {"stages": PROFILER.stages,
+                    "counters": dict(PROFILER.counters)}
+
+
+def merge_task(output):
+    """Merges the profile of a task run by `profile_task` into PROFILER
+    :returns the result of the task"""
+    result, profile = output
+    PROFILER.merge(profile)
+    return result
+
+
+def profiled(name):
+    """Decorator that times every call of the function as the stage `name`
+    while the profiler is running"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with PROFILER.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfiledObject(object):
+    """Proxy that times the calls to the methods `names` of `obj` as the
+    stages {prefix}.{method}"""
+
+    def __init__(self, obj, prefix, names):
+        self._obj = obj
+        self._prefix = prefix
+        self._names = set(names)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name in self._names:
+            return profiled("{}.{}".format(self._prefix, name))(attr)
+        return attr
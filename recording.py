@@ -2,20 +2,53 @@ from __future__ import print_function, division
 import sys
 import time
 import os.path
-import numpy
+import xml.etree.ElementTree as ET
+import numpy as np
 import PyKDL
 import rospy
 import dvrk
+from arm_state import ArmStateRecorder
+from profiler import profiled, ProfiledObject, PROFILER
+from telemetry import TelemetryLog, TelemetryObject, TELEMETRY_FILE
+
+
+class RosClock(object):
+    """Time of the recordings, from ROS"""
+
+    def now(self):
+        return rospy.get_time()
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
 
 class Recording(object):
 
+    # Methods of the arm that are logged to the telemetry of the session,
+    # and timed when profiling
+    ARM_METHODS = [
+        "move", "move_joint", "home", "get_current_position",
+        "get_desired_position", "get_current_joint_position",
+        "get_desired_joint_position", "get_current_wrench_body",
+    ]
+
     ROT_MATRIX = PyKDL.Rotation(
         1,    0,    0,
         0,   -1,    0,
         0,    0,   -1
     )
 
-    def __init__(self, robot_name, config_file):
+    def __init__(self, robot_name, config_file=None, arm=None, state=None,
+                 clock=None):
+        """
+        :param str config_file Config file of the arm, or None to not record
+            its current offset
+        :param arm Arm to record from, or None for the dVRK arm `robot_name`
+        :param arm_state.ArmStateRecorder state Samples of the state of
+            `arm`, or None to subscribe to the topics of the dVRK arm
+        :param clock Object with `now` and `sleep` methods that the recording
+            keeps time with, or None for ROS time
+        """
         print("initializing recording for", robot_name)
         print("have a flat surface below the robot")
         self.data = []
@@ -27,9 +60,33 @@ class Recording(object):
         os.mkdir(self.folder)
         print("Created folder at {}".format(os.path.abspath(self.folder)))
 
-        self.arm = dvrk.psm(robot_name)
+        if arm is None:
+            arm = dvrk.psm(robot_name)
+        if state is None:
+            state = ArmStateRecorder(robot_name)
+        if clock is None:
+            clock = RosClock()
+        # Every command and read of the arm is timestamped in
+        # {folder}/telemetry.bin
+        self.telemetry = TelemetryLog(
+            os.path.join(self.folder, TELEMETRY_FILE), clock
+        )
+        arm = TelemetryObject(arm, self.telemetry,
+                              {name: name for name in self.ARM_METHODS})
+        state = TelemetryObject(state, self.telemetry,
+                                {"snapshot": "snapshot", "window": "window"})
+        if PROFILER.enabled:
+            arm = ProfiledObject(arm, "arm", self.ARM_METHODS)
+            state = ProfiledObject(state, "state", ["snapshot", "window"])
+        self.arm = arm
+        # Timestamped samples of the state of the arm
+        self.state = state
+        self.clock = clock
         self.home()
 
+        if config_file is None:
+            return
+
         tree = ET.parse(config_file)
         root = tree.getroot()
         xpath_search_results = root.findall("./Robot/Actuator[@ActuatorID='2']"
@@ -44,6 +101,16 @@ class Recording(object):
         self.info["Config File"] = config_file
         self.info["Current Offset"] = current_offset
 
+    def now(self):
+        """Gets the current time in seconds"""
+        return self.clock.now()
+
+    @profiled("sleep")
+    def sleep(self, duration):
+        """Waits for `duration` seconds"""
+        with self.telemetry.span("sleep"):
+            self.clock.sleep(duration)
+
     def home(self):
         """
         Goes to x = 0, y = 0, extends joint 2 past the cannula, and sets home
@@ -72,6 +139,8 @@ class Recording(object):
         """Output info to {folder}/info.txt"""
         self.info["Tracker"] = self.tracker
 
-        with open(os.path.join(self.folder, "info.txt"), 'w') as infofile:
-            for key, val in self.info.iteritems():
-                infofile.write("{}: {}\n".format(key, val))
+        with self.telemetry.span("write"):
+            with open(os.path.join(self.folder, "info.txt"), 'w') as infofile:
+                for key, val in self.info.items():
+                    infofile.write("{}: {}\n".format(key, val))
+        self.telemetry.flush()
@@ -0,0 +1,78 @@
+from __future__ import division, print_function
+import numpy as np
+from profiler import profiled
+from ring_buffer import interpolate_samples
+
+
+@profiled("registration")
+def register_rigid(data, model):
+    """
+    Finds the rigid transforms that best map `data` onto `model`
+    (the Kabsch/Horn method), for one point cloud or a stack of them,
+    in the same sense as `cisstNumericalPython.nmrRegistrationRigid`
+    :param numpy.ndarray data Point clouds of shape (..., N, 3)
+    :param numpy.ndarray model Corresponding point clouds of shape (..., N, 3)
+    :returns tuple of ((rotations, translations), errors) such that
+        `model ~= rotation.dot(data) + translation`, where rotations are of
+        shape (..., 3, 3), translations of shape (..., 3) and errors are the
+        root mean square distances between the transformed data and the model
+    """
+    data = np.asarray(data, dtype=np.float64)
+    model = np.asarray(model, dtype=np.float64)
+    data, model = np.broadcast_arrays(data, model)
+
+    data_centroid = data.mean(axis=-2)
+    model_centroid = model.mean(axis=-2)
+    data_centered = data - data_centroid[..., np.newaxis, :]
+    model_centered = model - model_centroid[..., np.newaxis, :]
+
+    # Cross-covariance matrix
+    H = np.matmul(np.swapaxes(data_centered, -1, -2), model_centered)
+    U, _, Vt = np.linalg.svd(H)
+    V = np.swapaxes(Vt, -1, -2)
+    Ut = np.swapaxes(U, -1, -2)
+
+    # Flip the last axis if the result would be a reflection
+    sign = np.sign(np.linalg.det(np.matmul(V, Ut)))
+    V[..., :, 2] *= sign[..., np.newaxis]
+
+    rotations = np.matmul(V, Ut)
+    translations = (model_centroid
+                    - np.matmul(rotations,
+                                data_centroid[..., np.newaxis])[..., 0])
+
+    transformed = (np.matmul(data, np.swapaxes(rotations, -1, -2))
+                   + translations[..., np.newaxis, :])
+    errors = np.sqrt(np.mean(np.sum((transformed - model) ** 2, axis=-1),
+                             axis=-1))
+
+    return (rotations, translations), errors
+
+
+def find_latency(data_times, data, model_times, model, lags):
+    """
+    Finds the latency of the `model` stream relative to the `data` stream
+    that registers them best, where a model sample stamped at time t was
+    taken when the data was at time t - latency
+    :param numpy.ndarray data_times Increasing times of the data of shape (N,)
+    :param numpy.ndarray data Points of shape (N, 3)
+    :param numpy.ndarray model_times Times of the model of shape (M,)
+    :param numpy.ndarray model Points of shape (M, 3)
+    :param numpy.ndarray lags Latencies to try in seconds of shape (K,)
+    :returns tuple of (latency, errors) where errors are the registration
+        errors at each lag, of shape (K,)
+    """
+    lags = np.asarray(lags, dtype=np.float64)
+    # Only use the model samples that are inside the data at every lag
+    inside = ((model_times - lags.max() >= data_times[0])
+              & (model_times - lags.min() <= data_times[-1]))
+    if np.count_nonzero(inside) < 3:
+        raise ValueError("Not enough samples overlap in time")
+    model_times = model_times[inside]
+    model = model[inside]
+
+    # Data at the time of each model sample, of shape (K, M, 3)
+    data_at = interpolate_samples(data_times, data,
+                                  model_times - lags[:, np.newaxis])
+    errors = register_rigid(data_at, model)[1]
+    return lags[np.argmin(errors)], errors
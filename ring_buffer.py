@@ -0,0 +1,113 @@
+from __future__ import division, print_function
+import threading
+import numpy as np
+
+
+class StateRingBuffer(object):
+    """
+    Fixed-size buffer of timestamped samples, where each sample is a row of
+    `width` floats. Once full, new samples overwrite the oldest ones
+
+    Samples can be appended from a ROS callback thread
+    while they are read from another
+    """
+
+    def __init__(self, width, size=10000):
+        """
+        :param int width Number of values in each sample
+        :param int size Maximum number of samples kept
+        """
+        self.width = width
+        self.size = size
+        self._times = np.zeros(size)
+        self._values = np.zeros((size, width))
+        # Total number of samples appended
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+    def append(self, time, values):
+        """Adds a sample taken at `time` in seconds"""
+        with self._lock:
+            idx = self._count % self.size
+            self._times[idx] = time
+            self._values[idx] = values
+            self._count += 1
+
+    def samples(self):
+        """
+        Gets every sample in the buffer from oldest to newest
+        :returns tuple of (times, values) of shapes (N,) and (N, width)
+        """
+        with self._lock:
+            if self._count <= self.size:
+                return (self._times[:self._count].copy(),
+                        self._values[:self._count].copy())
+            # The oldest sample is the one that will be overwritten next
+            order = np.roll(np.arange(self.size), -(self._count % self.size))
+            return self._times[order], self._values[order]
+
+    def latest(self):
+        """
+        Gets the newest sample
+        :returns tuple of (time, values), or None if the buffer is empty
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            idx = (self._count - 1) % self.size
+            return self._times[idx], self._values[idx].copy()
+
+    def window(self, start, end=None):
+        """
+        Gets the samples taken between `start` and `end`
+        :param float end End of the window, or None for the newest sample
+        :returns tuple of (times, values) from oldest to newest
+        """
+        times, values = self.samples()
+        if end is None:
+            end = np.inf
+        mask = (times >= start) & (times <= end)
+        return times[mask], values[mask]
+
+    def interpolate(self, times):
+        """
+        Linearly interpolates the samples at `times`. Times outside of the
+        buffer take the value of the closest sample
+        :param numpy.ndarray times Times of shape (M,) or a single time
+        :returns values of shape (M, width), or (width,) for a single time
+        """
+        sample_times, values = self.samples()
+        return interpolate_samples(sample_times, values, times)
+
+
+def interpolate_samples(sample_times, values, times):
+    """
+    Linearly interpolates samples taken at increasing `sample_times` at
+    `times`. Times outside of the samples take the value of the closest
+    sample
+    :param numpy.ndarray sample_times Times of shape (N,)
+    :param numpy.ndarray values Values of shape (N, width)
+    :param numpy.ndarray times Times of shape (...) or a single time
+    :returns values of shape (..., width), or (width,) for a single time
+    """
+    if len(sample_times) == 0:
+        raise ValueError("No samples to interpolate")
+    times = np.asarray(times, dtype=np.float64)
+
+    # Index of the sample after each time
+    after = np.searchsorted(sample_times, times)
+    after = np.clip(after, 1, max(len(sample_times) - 1, 1))
+    before = after - 1
+    if len(sample_times) == 1:
+        after = before
+    span = sample_times[after] - sample_times[before]
+    weights = np.where(
+        span > 0,
+        (times - sample_times[before]) / np.where(span > 0, span, 1),
+        0
+    )
+    weights = np.clip(weights, 0, 1)[..., np.newaxis]
+    return values[before] * (1 - weights) + values[after] * weights
@@ -0,0 +1,118 @@
+from __future__ import division, print_function
+import numpy as np
+
+
+# Joints of the wrist that orient the tool
+WRIST_JOINTS = [3, 4, 5]
+
+
+def rotation_errors(rotations, target):
+    """
+    Gets the rotation vectors that take `target` to `rotations`
+    :param numpy.ndarray rotations Rotation matrices of shape (..., 3, 3)
+    :param numpy.ndarray target Rotation matrix of shape (3, 3)
+    :returns rotation vectors of shape (..., 3), whose norms are the angles
+        between the rotations in radians
+    """
+    diff = np.matmul(np.swapaxes(target, -1, -2), rotations)
+    skew = np.stack([diff[..., 2, 1] - diff[..., 1, 2],
+                     diff[..., 0, 2] - diff[..., 2, 0],
+                     diff[..., 1, 0] - diff[..., 0, 1]], axis=-1) / 2
+    sin_angle = np.linalg.norm(skew, axis=-1)
+    cos_angle = (np.trace(diff, axis1=-2, axis2=-1) - 1) / 2
+    angle = np.arctan2(sin_angle, cos_angle)
+    scale = np.where(sin_angle > 1e-12,
+                     angle / np.maximum(sin_angle, 1e-12), 1)
+    return skew * scale[..., np.newaxis]
+
+
+def joints_within_limits(rob, joint_set):
+    """Whether each pose of shape (N, njoints) is within the joint limits
+    of `rob`"""
+    joint_set = np.asarray(joint_set, dtype=np.float64)
+    n = joint_set.shape[1]
+    return np.all((joint_set >= rob.q_min[:n])
+                  & (joint_set <= rob.q_max[:n]), axis=1)
+
+
+def solve_orientation(rob, joint_set, rotation, joints=WRIST_JOINTS,
+                      iterations=30):
+    """
+    Finds the positions of the wrist `joints` within their limits that best
+    orient the tool to `rotation` at every pose, with damped Gauss-Newton
+    from several starting points solved all at once
+    :param kinematics.Manipulator rob The kinematics of the arm
+    :param numpy.ndarray joint_set Poses of shape (N, njoints)
+    :param numpy.ndarray rotation Rotation matrix of shape (3, 3)
+    :returns tuple of (poses with the wrist joints solved, orientation errors
+        in degrees)
+    """
+    joint_set = np.array(joint_set, dtype=np.float64)
+    npoints = len(joint_set)
+    q_min = rob.q_min[joints]
+    q_max = rob.q_max[joints]
+
+    # Start from every quarter turn of the first wrist joint
+    starts = np.zeros((4, len(joints)))
+    starts[:, 0] = np.array([0, 0.5, -0.5, 1]) * np.pi
+    q = np.repeat(joint_set[np.newaxis], len(starts), axis=0)
+    q[..., joints] = np.clip(starts[:, np.newaxis], q_min, q_max)
+
+    step = 1e-6
+    damping = 1e-6
+    eye = np.eye(len(joints))
+    for _ in range(iterations):
+        # Residual and finite difference Jacobian in one batch
+        perturbed = np.repeat(q[..., np.newaxis, :], len(joints) + 1,
+                              axis=-2)
+        for k, joint in enumerate(joints):
+            perturbed[..., k + 1, joint] += step
+        frames = rob.forward_kinematics(perturbed)[..., :3, :3]
+        residuals = rotation_errors(frames, rotation)
+        r = residuals[..., 0, :]
+        J = np.swapaxes(residuals[..., 1:, :] - r[..., np.newaxis, :],
+                        -1, -2) / step
+        Jt = np.swapaxes(J, -1, -2)
+        delta = np.linalg.solve(np.matmul(Jt, J) + damping * eye,
+                                -np.matmul(Jt, r[..., np.newaxis]))[..., 0]
+        q[..., joints] = np.clip(q[..., joints] + delta, q_min, q_max)
+
+    errors = np.linalg.norm(
+        rotation_errors(rob.forward_kinematics(q)[..., :3, :3], rotation),
+        axis=-1
+    )
+    best = np.argmin(errors, axis=0)
+    idx = np.arange(npoints)
+    return q[best, idx], np.rad2deg(errors[best, idx])
+
+
+def screen_joint_set(rob, joint_set, rotation, max_rot_diff=2,
+                     tracker_transform=None, tracker_bounds=None):
+    """
+    Finds the poses that can't give good tracker data before moving to them
+    :param kinematics.Manipulator rob The kinematics of the arm
+    :param numpy.ndarray joint_set Poses of shape (N, njoints)
+    :param numpy.ndarray rotation Orientation of the tool at every pose
+    :param float max_rot_diff Maximum difference from `rotation` that the
+        wrist may be left with in degrees
+    :param tuple tracker_transform Tuple of (rotation, translation) from arm
+        to tracker coordinates, as returned by `register_rigid`
+    :param tuple tracker_bounds Tuple of (minimum, maximum) corners of the
+        measurement volume of the tracker in tracker coordinates. The volume
+        is only checked if `tracker_transform` is also given
+    :returns dict of the reason to reject a pose to a boolean array of the
+        poses rejected for it
+    """
+    joint_set = np.asarray(joint_set, dtype=np.float64)
+    rejected = {"joint limits": ~joints_within_limits(rob, joint_set)}
+
+    solved, errors = solve_orientation(rob, joint_set, rotation)
+    rejected["orientation"] = errors > max_rot_diff
+
+    if tracker_transform is not None and tracker_bounds is not None:
+        R, t = tracker_transform
+        markers = rob.positions(solved).dot(np.transpose(R)) + t
+        low, high = tracker_bounds
+        rejected["tracker volume"] = ~np.all((markers >= low)
+                                             & (markers <= high), axis=1)
+    return rejected
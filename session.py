@@ -0,0 +1,300 @@
+from __future__ import division, print_function
+import os
+import os.path
+import json
+import warnings
+import numpy as np
+from profiler import profiled
+
+
+JOINT_COLUMNS = ["joint_{}_position".format(i) for i in range(6)]
+POSITION_COLUMNS = ["arm_position_x", "arm_position_y", "arm_position_z"]
+TRACKER_COLUMNS = ["tracker_position_x", "tracker_position_y",
+                   "tracker_position_z"]
+
+# Older sessions were recorded with a Polaris and use its name as the prefix
+COLUMN_ALIASES = {
+    "polaris_position_x": "tracker_position_x",
+    "polaris_position_y": "tracker_position_y",
+    "polaris_position_z": "tracker_position_z",
+}
+
+TRACKER_FILES = ["tracker_point_cloud.csv", "polaris_point_cloud.csv"]
+
+# Packed sessions are stored in this folder inside the session folder
+PACK_FOLDER = "packed"
+PACK_INDEX = "index.json"
+
+
+class Table(object):
+    """
+    Columns of a csv file stored as one float array of shape (rows, columns)
+    """
+
+    def __init__(self, columns, data):
+        self.columns = [COLUMN_ALIASES.get(column, column)
+                        for column in columns]
+        self.data = data
+        self._indices = {
+            column: idx
+            for idx, column in enumerate(self.columns)
+        }
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, column):
+        return column in self._indices
+
+    def __getitem__(self, column):
+        return self.data[:, self._index(column)]
+
+    def _index(self, column):
+        try:
+            return self._indices[column]
+        except KeyError:
+            raise KeyError("Column {} not found in {}"
+                           .format(column, self.columns))
+
+    def get(self, *columns):
+        """
+        Gets the columns in the order given
+        :returns numpy.ndarray of shape (rows, len(columns))
+        """
+        return self.data[:, [self._index(column) for column in columns]]
+
+    def has(self, *columns):
+        return all(column in self for column in columns)
+
+
+@profiled("read csv")
+def read_table(filename):
+    """
+    Reads a csv file with a header in a single pass
+    :rtype Table
+    """
+    with open(filename) as infile:
+        columns = infile.readline().strip().split(",")
+        with warnings.catch_warnings():
+            # Files with only a header are read as empty tables
+            warnings.simplefilter("ignore")
+            data = np.loadtxt(infile, delimiter=",", ndmin=2)
+    if data.size == 0:
+        data = np.zeros((0, len(columns)))
+    return Table(columns, data)
+
+
+class Session(object):
+    """
+    Lazily loads the csv files of a session folder
+
+    Every file is read at most once for as long as it isn't modified, so
+    the analysis stages can share a session instead of reparsing its files.
+    If the session was packed with `pack_session`, tables are memory-mapped
+    from the pack instead, unless their csv file changed since packing
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._tables = {}
+        self._pack = None
+
+    @property
+    def pack(self):
+        """Index of the packed tables, or an empty dict if not packed"""
+        index_file = os.path.join(self.folder, PACK_FOLDER, PACK_INDEX)
+        if not os.path.exists(index_file):
+            return {}
+        stat = os.stat(index_file)
+        key = (stat.st_mtime, stat.st_size)
+        if self._pack is None or self._pack[0] != key:
+            with open(index_file) as infile:
+                self._pack = (key, json.load(infile))
+        return self._pack[1]
+
+    def table(self, name):
+        """Gets the contents of the csv file `name` in the folder"""
+        filename = os.path.join(self.folder, name)
+        packed = self.pack.get(name)
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            key = (stat.st_mtime, stat.st_size)
+            if packed is not None and packed["source"] != list(key):
+                # csv file changed after packing
+                packed = None
+        elif packed is not None:
+            key = "packed"
+        else:
+            raise IOError(2, "No such file or directory", filename)
+
+        if name not in self._tables or self._tables[name][0] != key:
+            if packed is not None:
+                self._tables[name] = (key, self._read_packed(packed))
+            else:
+                self._tables[name] = (key, read_table(filename))
+        return self._tables[name][1]
+
+    @profiled("read packed")
+    def _read_packed(self, packed):
+        # Slicing a memory-mapped array doesn't copy it
+        data = np.load(
+            os.path.join(self.folder, PACK_FOLDER, packed["file"]),
+            mmap_mode='r'
+        )
+        return Table(packed["columns"], data[packed["start"]:packed["stop"]])
+
+    def exists(self, name):
+        return (os.path.exists(os.path.join(self.folder, name))
+                or name in self.pack)
+
+    @property
+    def plane(self):
+        """Contact points of the palpations, from plane.csv"""
+        return self.table("plane.csv")
+
+    @property
+    def tracker_file(self):
+        for name in TRACKER_FILES:
+            if self.exists(name):
+                return name
+        raise IOError(2, "No tracker point cloud in folder", self.folder)
+
+    @property
+    def tracker(self):
+        """Arm and tracker positions, from tracker_point_cloud.csv
+        or polaris_point_cloud.csv"""
+        return self.table(self.tracker_file)
+
+    @property
+    def is_tracker(self):
+        """Whether the session was recorded with an external tracker"""
+        return any(self.exists(name) for name in TRACKER_FILES)
+
+    @property
+    def palpation_files(self):
+        """Names of the palpation_{row}_{column}.csv files in grid order"""
+        names = set(os.listdir(self.folder)) | set(self.pack)
+        names = [
+            name
+            for name in names
+            if name.startswith("palpation_") and name.endswith(".csv")
+        ]
+        return sorted(names, key=palpation_index)
+
+
+def is_session(folder):
+    """Whether `folder` contains data that can be analyzed"""
+    session = Session(folder)
+    return (session.is_tracker or session.exists("plane.csv")
+            or len(session.palpation_files) > 0)
+
+
+def has_current_format(folder):
+    """
+    Whether the file of `folder` that the analysis reads from, the tracker
+    point cloud, plane.csv or else the palpations, can be read and has the
+    position and joint columns of the current format. Sessions recorded by
+    early versions only have the heights and wrenches of the palpations,
+    or a plane.csv of arrays
+    """
+    session = load_session(folder)
+    if session.is_tracker:
+        name = session.tracker_file
+        columns = JOINT_COLUMNS + POSITION_COLUMNS + TRACKER_COLUMNS
+    elif session.exists("plane.csv"):
+        name = "plane.csv"
+        columns = JOINT_COLUMNS + POSITION_COLUMNS
+    elif session.palpation_files:
+        name = session.palpation_files[0]
+        columns = JOINT_COLUMNS + POSITION_COLUMNS + ["wrench"]
+    else:
+        return False
+    try:
+        return session.table(name).has(*columns)
+    except ValueError:
+        return False
+
+
+def find_sessions(root):
+    """Finds every session folder under `root` in sorted order"""
+    sessions = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Don't descend into the packed arrays of a session
+        if PACK_FOLDER in dirnames:
+            dirnames.remove(PACK_FOLDER)
+        if is_session(dirpath):
+            sessions.append(dirpath)
+    return sorted(sessions)
+
+
+def palpation_index(name):
+    """Gets (row, column) from the name palpation_{row}_{column}.csv"""
+    row, col = os.path.splitext(name)[0].split("_")[1:3]
+    return int(row), int(col)
+
+
+_sessions = {}
+
+
+def load_session(folder):
+    """
+    Gets the session of `folder`, reusing it if it was loaded before
+    :rtype Session
+    """
+    folder = os.path.abspath(folder)
+    if folder not in _sessions:
+        _sessions[folder] = Session(folder)
+    return _sessions[folder]
+
+
+def pack_session(folder):
+    """
+    Converts the csv files of a session into .npy files in
+    {folder}/packed, which `Session` memory-maps instead of parsing the csv
+    files. Tables with the same columns, e. g. the palpations, are stored
+    in one array and indexed by their rows in {folder}/packed/index.json
+    :returns the index of the packed tables
+    """
+    pack_folder = os.path.join(folder, PACK_FOLDER)
+    if not os.path.isdir(pack_folder):
+        os.mkdir(pack_folder)
+
+    session = Session(folder)
+    names = session.palpation_files
+    names += [name for name in ["plane.csv"] + TRACKER_FILES
+              if os.path.exists(os.path.join(folder, name))]
+
+    # Group tables by their columns
+    groups = []
+    for name in names:
+        filename = os.path.join(folder, name)
+        stat = os.stat(filename)
+        with open(filename) as infile:
+            columns = infile.readline().strip().split(",")
+        for group_columns, group in groups:
+            if group_columns == columns:
+                group.append((name, stat, read_table(filename)))
+                break
+        else:
+            groups.append((columns, [(name, stat, read_table(filename))]))
+
+    index = {}
+    for num, (columns, group) in enumerate(groups):
+        array_file = "tables_{}.npy".format(num)
+        np.save(os.path.join(pack_folder, array_file),
+                np.concatenate([table.data for _, _, table in group]))
+        start = 0
+        for name, stat, table in group:
+            index[name] = {
+                "file": array_file,
+                "columns": columns,
+                "start": start,
+                "stop": start + len(table),
+                "source": [stat.st_mtime, stat.st_size],
+            }
+            start += len(table)
+
+    with open(os.path.join(pack_folder, PACK_INDEX), 'w') as outfile:
+        json.dump(index, outfile, indent=1, sort_keys=True)
+
+    return index
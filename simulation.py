@@ -0,0 +1,499 @@
+from __future__ import division, print_function
+import time
+import collections
+import numpy as np
+import PyKDL
+from analyze import analyze_palpation
+from arm_state import ArmStateRecorder
+from plane_statistics import PlaneStatistics
+from registration import register_rigid
+from ring_buffer import StateRingBuffer
+from screening import rotation_errors
+from session import (load_session, JOINT_COLUMNS, POSITION_COLUMNS,
+                     TRACKER_COLUMNS)
+from trajectory import JOINT_SPEEDS
+
+
+def ticks(start, end, rate):
+    """Gets the times of a stream published at `rate` in (start, end]"""
+    first = np.floor(start * rate) + 1
+    last = np.floor(end * rate)
+    return np.arange(first, last + 1) / rate
+
+
+class SimulatedClock(object):
+    """
+    Simulated time, which only passes when a recording waits or moves,
+    so recordings run as fast as they can be computed
+
+    Streams register a listener, which is called with the start and end
+    of every period of time that passes to publish their samples
+    """
+
+    def __init__(self):
+        self.time = 0.0
+        self.listeners = []
+        self.wall_start = time.time()
+
+    def now(self):
+        return self.time
+
+    def sleep(self, duration):
+        if duration <= 0:
+            return
+        end = self.time + duration
+        for listener in self.listeners:
+            listener(self.time, end)
+        self.time = end
+
+    @property
+    def wall_time(self):
+        """Wall-clock time since the clock was created in seconds"""
+        return time.time() - self.wall_start
+
+
+class SimulatedArmState(ArmStateRecorder):
+    """Arm state recorder that is filled by a `SimulatedArm`
+    instead of ROS topics"""
+
+    def __init__(self, clock, size=10000):
+        self.clock = clock
+        self.pose = StateRingBuffer(7, size)
+        self.wrench = StateRingBuffer(6, size)
+        self.joints = StateRingBuffer(self.NJOINTS, size)
+        self.subscribers = []
+
+    def snapshot(self, after=None, timeout=1.0):
+        # Let simulated time pass instead of waiting for messages
+        deadline = self.clock.now() + timeout
+        while True:
+            latest = self.latest_time()
+            if latest is not None and (after is None or latest > after):
+                return self.state_at(latest)
+            if self.clock.now() > deadline:
+                raise RuntimeError("No arm state received in {}s"
+                                   .format(timeout))
+            self.clock.sleep(0.001)
+
+
+class WrenchProfile(object):
+    """
+    Wrench against the depth of the tool tip below the surface,
+    replayed from a recorded palpation
+    """
+
+    def __init__(self, depths, wrenches, contact=None):
+        """
+        :param numpy.ndarray depths Depths below the surface in meters
+        :param numpy.ndarray wrenches Wrench at each depth
+        :param numpy.ndarray contact Position where the palpation touched
+            the surface
+        """
+        self.contact = contact
+        order = np.argsort(depths)
+        self.depths = np.asarray(depths)[order]
+        self.wrenches = np.asarray(wrenches)[order]
+        free = self.wrenches[self.depths < 0]
+        self.baseline = free.mean() if len(free) else 0
+        # Keep pressing harder past the deepest sample
+        last = max(len(self.depths) - 5, 0)
+        span = self.depths[-1] - self.depths[last]
+        if span > 0:
+            self.stiffness = (self.wrenches[-1] - self.wrenches[last]) / span
+        else:
+            self.stiffness = 0
+
+    @classmethod
+    def from_palpation(cls, table):
+        """
+        Gets the profile of a palpation, with depths from its contact point
+        :param session.Table table Samples of the palpation
+        :raises ValueError if the contact point isn't found
+        """
+        pos_v_wrench = np.c_[table.get(*POSITION_COLUMNS), table["wrench"],
+                             table.get(*JOINT_COLUMNS)]
+        pos, _ = analyze_palpation(pos_v_wrench)
+        if pos is None or not np.isfinite(pos[2]):
+            raise ValueError("Contact point of the palpation not found")
+        return cls(pos[2] - pos_v_wrench[:, 2], pos_v_wrench[:, 3],
+                   np.asarray(pos[:3]))
+
+    def wrench(self, depths):
+        depths = np.asarray(depths)
+        wrenches = np.interp(depths, self.depths, self.wrenches,
+                             left=self.baseline)
+        deeper = depths > self.depths[-1]
+        wrenches[deeper] = (self.wrenches[-1] + self.stiffness
+                            * (depths[deeper] - self.depths[-1]))
+        return wrenches
+
+
+class SimulatedSurface(object):
+    """
+    Plane z = a*x + b*y + c that the simulated arm palpates, where the
+    wrench at each point is replayed from the nearest recorded palpation
+    """
+
+    # Standard deviation of the noise of each wrench sample in N, about the
+    # sample-to-sample noise of the wrench of the recorded palpations. The
+    # replayed profiles are interpolated between their samples, so they only
+    # keep the noise at the spacing of the recorded steps
+    NOISE = 0.07
+
+    def __init__(self, coefs, profiles, locations, noise=None, seed=0):
+        """
+        :param numpy.ndarray coefs Coefficients (a, b, c) of the plane
+        :param list profiles `WrenchProfile` of each recorded palpation
+        :param numpy.ndarray locations (x, y) of each palpation
+        :param float noise Standard deviation of the noise of each wrench
+            sample in N, or None for NOISE
+        """
+        if noise is None:
+            noise = self.NOISE
+        self.coefs = np.asarray(coefs)
+        self.profiles = profiles
+        self.locations = np.asarray(locations)
+        self.noise = noise
+        self.rng = np.random.RandomState(seed)
+
+    # Distance in meters around a single replayed palpation that is
+    # palpated, on each side
+    SINGLE_MARGIN = 0.01
+
+    @classmethod
+    def from_session(cls, folder, **kwargs):
+        """
+        Gets the surface palpated in a recorded plane session, or the level
+        surface at the contact point of a single palpation session
+        :param kwargs Keyword arguments of `SimulatedSurface`
+        :raises ValueError if the session has no palpations that can be
+            replayed
+        """
+        session = load_session(folder)
+        names = session.palpation_files
+        if not names and session.exists("single_palpation.csv"):
+            names = ["single_palpation.csv"]
+        stats = PlaneStatistics()
+        profiles = []
+        locations = []
+        for name in names:
+            table = session.table(name)
+            if not table.has("wrench", *POSITION_COLUMNS + JOINT_COLUMNS):
+                raise ValueError(
+                    "{} in {} has no position and joint columns, it was "
+                    "recorded in an old format".format(name, folder)
+                )
+            try:
+                profile = WrenchProfile.from_palpation(table)
+            except ValueError:
+                continue
+            stats.add(profile.contact)
+            profiles.append(profile)
+            locations.append(profile.contact[:2])
+        if names == ["single_palpation.csv"] and stats.npoints == 1:
+            coefs = [0, 0, profiles[0].contact[2]]
+        elif stats.npoints < 3:
+            raise ValueError("Not enough palpations in {}".format(folder))
+        else:
+            coefs = stats.fit()[0][0]
+        return cls(coefs, profiles, locations, **kwargs)
+
+    def bounds(self):
+        """
+        Gets the corners of the area of the replayed palpations, or of the
+        area SINGLE_MARGIN around a single palpation
+        :returns tuple of (low, high) (x, y)
+        """
+        low = self.locations.min(axis=0)
+        high = self.locations.max(axis=0)
+        if len(self.locations) == 1:
+            low = low - self.SINGLE_MARGIN
+            high = high + self.SINGLE_MARGIN
+        return low, high
+
+    def height(self, x, y):
+        a, b, c = self.coefs
+        return a * x + b * y + c
+
+    def wrench(self, positions):
+        """Gets the wrench in z at positions of shape (N, 3)"""
+        positions = np.atleast_2d(positions)
+        depths = (self.height(positions[:, 0], positions[:, 1])
+                  - positions[:, 2])
+        distances = np.linalg.norm(
+            positions[:, np.newaxis, :2] - self.locations[np.newaxis], axis=-1
+        )
+        nearest = np.argmin(distances, axis=1)
+        wrenches = np.empty(len(positions))
+        for idx in np.unique(nearest):
+            mask = nearest == idx
+            wrenches[mask] = self.profiles[idx].wrench(depths[mask])
+        return wrenches + self.rng.normal(0, self.noise, len(wrenches))
+
+
+def to_frame(transform):
+    """Converts a homogeneous transform to a PyKDL.Frame"""
+    rotation = PyKDL.Rotation(*transform[:3, :3].flatten())
+    return PyKDL.Frame(rotation, PyKDL.Vector(*transform[:3, 3]))
+
+
+class SimulatedArm(object):
+    """
+    Drop-in replacement for `dvrk.psm` that moves a simulated arm in
+    simulated time and publishes its state to a `SimulatedArmState`
+
+    Interpolated moves take as long as the slowest joint at JOINT_SPEEDS,
+    and every command starts after LATENCY. The tool tip touches `surface`
+    at its physical position, which is off by `offset` along joint 2 from
+    the position the arm reports, like an arm that needs calibration
+    """
+
+    LATENCY = 0.005
+    # Rate at which the state is published in Hz
+    PUBLISH_RATE = 100
+    # Number of past motions kept, so that the arm can be looked up in the
+    # recent past, e. g. by a marker with latency, while it is streamed
+    # set-points
+    HISTORY = 100
+
+    def __init__(self, rob, clock, state=None, surface=None, offset=0,
+                 name="PSM1", q=None):
+        """
+        :param kinematics.Manipulator rob Kinematics of the arm
+        :param SimulatedClock clock
+        :param SimulatedArmState state State to publish to
+        :param SimulatedSurface surface Surface that the arm can touch,
+            or None
+        :param float offset Error of the offset of joint 2 in meters
+        """
+        self.rob = rob
+        self.clock = clock
+        self.state = state
+        self.surface = surface
+        self.offset = np.zeros(len(rob))
+        self.offset[2] = offset
+        self._name = name
+        if q is None:
+            q = np.zeros(len(rob))
+            q[2] = 0.12
+        q = np.asarray(q, dtype=np.float64)
+        # Motions from q_start at t_start to q_goal at t_goal,
+        # the last one being the current motion
+        self._segments = collections.deque(
+            [(clock.now(), clock.now(), q, q)], maxlen=self.HISTORY
+        )
+        self.nmoves = 0
+        clock.listeners.append(self.publish)
+
+    def name(self):
+        return self._name
+
+    def home(self):
+        pass
+
+    def close_jaw(self):
+        pass
+
+    def joints_at(self, times):
+        """Gets the joint positions at `times` of shape (N,)"""
+        times = np.atleast_1d(times)
+        # Motion that each time is in
+        starts = np.array([segment[0] for segment in self._segments])
+        indices = np.maximum(np.searchsorted(starts, times, side="right") - 1,
+                             0)
+        joints = np.zeros((len(times), len(self._segment[3])))
+        for idx in np.unique(indices):
+            t_start, t_goal, q_start, q_goal = self._segments[idx]
+            mask = indices == idx
+            if t_goal > t_start:
+                weights = np.clip((times[mask] - t_start)
+                                  / (t_goal - t_start), 0, 1)
+            else:
+                weights = (times[mask] >= t_start).astype(np.float64)
+            joints[mask] = (q_start
+                            + weights[:, np.newaxis] * (q_goal - q_start))
+        return joints
+
+    @property
+    def _segment(self):
+        """The current motion"""
+        return self._segments[-1]
+
+    def tip_positions(self, times):
+        """Gets the physical positions of the tool tip at `times`"""
+        return self.rob.positions(self.joints_at(times) + self.offset)
+
+    def wrenches(self, times):
+        if self.surface is None:
+            return np.zeros(len(np.atleast_1d(times)))
+        return self.surface.wrench(self.tip_positions(times))
+
+    def publish(self, start, end):
+        """Publishes the state of the arm in (start, end]"""
+        if self.state is None:
+            return
+        times = ticks(start, end, self.PUBLISH_RATE)
+        if len(times) == 0:
+            return
+        joints = self.joints_at(times)
+        frames = self.rob.forward_kinematics(joints)
+        wrenches = self.wrenches(times)
+        for t, q, frame, wrench in zip(times, joints, frames, wrenches):
+            quaternion = to_frame(frame).M.GetQuaternion()
+            self.state.pose.append(t, list(frame[:3, 3]) + list(quaternion))
+            self.state.wrench.append(t, [0, 0, wrench, 0, 0, 0])
+            self.state.joints.append(t, q[:self.state.NJOINTS])
+
+    def get_current_joint_position(self):
+        return self.joints_at(self.clock.now())[0]
+
+    def get_desired_joint_position(self):
+        return self._segment[3].copy()
+
+    def get_current_position(self):
+        return to_frame(self.rob.forward_kinematics(
+            self.get_current_joint_position()
+        ))
+
+    def get_desired_position(self):
+        return to_frame(self.rob.forward_kinematics(self._segment[3]))
+
+    def get_current_wrench_body(self):
+        return [0, 0, self.wrenches(self.clock.now())[0], 0, 0, 0]
+
+    def inverse_kinematics(self, position, rotation, q, iterations=50):
+        """Finds the joints that reach `position` and `rotation` with damped
+        least squares, starting from `q` and then from every quarter turn of
+        the wrist if that gets stuck at a joint limit"""
+        starts = [np.array(q, dtype=np.float64)]
+        for angle in np.array([0, 0.5, -0.5, 1]) * np.pi:
+            start = starts[0].copy()
+            start[3:] = 0
+            start[3] = angle
+            starts.append(start)
+        best = None
+        for start in starts:
+            q, error = self._solve(position, rotation, start, iterations)
+            if best is None or error < best[1]:
+                best = (q, error)
+            if error < 1e-9:
+                break
+        return best[0]
+
+    def _solve(self, position, rotation, q, iterations):
+        step = 1e-7
+        q = np.clip(q, self.rob.q_min, self.rob.q_max)
+        for _ in range(iterations):
+            perturbed = q + np.r_[np.zeros((1, len(q))), step * np.eye(len(q))]
+            frames = self.rob.forward_kinematics(perturbed)
+            residuals = np.c_[frames[:, :3, 3] - position,
+                              rotation_errors(frames[:, :3, :3], rotation)]
+            r = residuals[0]
+            if np.linalg.norm(r) < 1e-10:
+                break
+            J = (residuals[1:] - r).T / step
+            delta = np.linalg.solve(J.T.dot(J) + 1e-9 * np.eye(len(q)),
+                                    -J.T.dot(r))
+            q = np.clip(q + delta, self.rob.q_min, self.rob.q_max)
+        return q, np.linalg.norm(r)
+
+    def move_joint(self, q, interpolate=True, blocking=True):
+        goal = self.get_desired_joint_position()
+        goal[:len(q)] = q
+        self._command(goal, interpolate, blocking)
+
+    def move(self, goal, interpolate=True, blocking=True):
+        """Moves to a PyKDL.Frame, or to a PyKDL.Vector or PyKDL.Rotation
+        keeping the rest of the desired pose"""
+        desired = self.rob.forward_kinematics(self._segment[3])
+        position = desired[:3, 3]
+        rotation = desired[:3, :3]
+        if isinstance(goal, PyKDL.Frame):
+            position, rotation = goal.p, goal.M
+        elif isinstance(goal, PyKDL.Vector):
+            position = goal
+        else:
+            rotation = goal
+        position = np.array([position[i] for i in range(3)])
+        rotation = np.array([[rotation[i, j] for j in range(3)]
+                             for i in range(3)])
+        self._command(
+            self.inverse_kinematics(position, rotation, self._segment[3]),
+            interpolate, blocking
+        )
+
+    def _command(self, goal, interpolate, blocking):
+        self.nmoves += 1
+        now = self.clock.now()
+        start = self.get_current_joint_position()
+        duration = 0
+        if interpolate:
+            duration = np.max(np.abs(goal - start)
+                              / JOINT_SPEEDS[:len(goal)])
+        t_start = now + self.LATENCY
+        self._segments.append((t_start, t_start + duration, start, goal))
+        if interpolate and blocking:
+            self.clock.sleep(self.LATENCY + duration)
+
+
+class SimulatedMarker(object):
+    """
+    Drop-in replacement for `Marker` that follows the physical tool tip of
+    a `SimulatedArm` in tracker coordinates, with noise and latency
+    """
+
+    # Rate at which the tracker publishes in Hz
+    RATE = 30
+    # Standard deviation of the noise on each axis in meters: 0.25mm RMS,
+    # the accuracy of an NDI Polaris, split between the axes
+    NOISE = 0.00025 / np.sqrt(3)
+
+    def __init__(self, arm, clock, transform=None, noise=None,
+                 latency=0.03, seed=0):
+        """
+        :param tuple transform Tuple of (rotation, translation) from arm to
+            tracker coordinates, or None for the identity
+        :param float noise Standard deviation of the noise on each axis in
+            meters, or None for NOISE
+        :param float latency Latency of the tracker in seconds
+        """
+        if transform is None:
+            transform = (np.eye(3), np.zeros(3))
+        if noise is None:
+            noise = self.NOISE
+        self.arm = arm
+        self.transform = transform
+        self.noise = noise
+        self.latency = latency
+        self.rng = np.random.RandomState(seed)
+        self.positions = StateRingBuffer(3)
+        self.n_bad_callbacks = 0
+        clock.listeners.append(self.publish)
+
+    @classmethod
+    def from_session(cls, folder, arm, clock, **kwargs):
+        """
+        Gets a marker in the tracker coordinates of a recorded tracker
+        session. The sessions only have one sample per pose, so the noise
+        can't be told apart from the error of the kinematics, which makes
+        up most of the registration error, and defaults to NOISE
+        """
+        table = load_session(folder).tracker
+        transform, _ = register_rigid(table.get(*POSITION_COLUMNS),
+                                      table.get(*TRACKER_COLUMNS))
+        return cls(arm, clock, transform, **kwargs)
+
+    def publish(self, start, end):
+        times = ticks(start, end, self.RATE)
+        if len(times) == 0:
+            return
+        R, t = self.transform
+        positions = (self.arm.tip_positions(times - self.latency).dot(R.T)
+                     + t + self.rng.normal(0, self.noise, (len(times), 3)))
+        for stamp, position in zip(times, positions):
+            self.positions.append(stamp, position)
+
+    def get_current_position(self):
+        latest = self.positions.latest()
+        if latest is not None:
+            return latest[1]
@@ -0,0 +1,224 @@
+from __future__ import division, print_function
+import json
+import struct
+import contextlib
+import numpy as np
+
+
+TELEMETRY_FILE = "telemetry.bin"
+
+MAGIC = b"DVRKTEL1"
+
+# Events that can be logged. Their names are stored in the header of every
+# file, so files stay readable when events are added
+EVENTS = [
+    "move", "move_joint", "home",
+    "get_current_position", "get_desired_position",
+    "get_current_joint_position", "get_desired_joint_position",
+    "get_current_wrench_body", "snapshot", "window", "marker",
+    "sleep", "write", "palpation", "pose",
+]
+
+# Category of the time spent in each event. Palpations and poses contain
+# the other events, so they aren't in a category
+CATEGORIES = {
+    "move": "motion",
+    "move_joint": "motion",
+    "home": "motion",
+    "get_current_position": "sensor reads",
+    "get_desired_position": "sensor reads",
+    "get_current_joint_position": "sensor reads",
+    "get_desired_joint_position": "sensor reads",
+    "get_current_wrench_body": "sensor reads",
+    "snapshot": "sensor reads",
+    "window": "sensor reads",
+    "marker": "sensor reads",
+    "sleep": "sleep",
+    "write": "file I/O",
+}
+
+# Event code, start time and duration in seconds
+RECORD_DTYPE = np.dtype([("event", "<u2"), ("start", "<f8"),
+                         ("duration", "<f8")])
+
+# Edges of the bins of the latency histograms in seconds
+HISTOGRAM_BINS = np.r_[0, np.logspace(-5, 2, 15)]
+
+# Palpations or poses beyond which only the slowest are listed
+MAX_LISTED = 10
+
+
+class TelemetryLog(object):
+    """
+    Appends timestamped events to a binary file: a header with the event
+    names, followed by one RECORD_DTYPE record per event
+    """
+
+    def __init__(self, filename, clock):
+        """
+        :param clock Object with a `now` method that the events are
+            timed with
+        """
+        self.filename = filename
+        self.clock = clock
+        self.codes = {name: code for code, name in enumerate(EVENTS)}
+        self._file = open(filename, 'wb')
+        header = json.dumps({"events": EVENTS}).encode("utf-8")
+        self._file.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def record(self, event, start, end):
+        self._file.write(np.array(
+            [(self.codes[event], start, end - start)], dtype=RECORD_DTYPE
+        ).tobytes())
+
+    @contextlib.contextmanager
+    def span(self, event):
+        """Logs the time taken by the body of the `with` statement"""
+        start = self.clock.now()
+        try:
+            yield
+        finally:
+            self.record(event, start, self.clock.now())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TelemetryObject(object):
+    """Proxy that logs the calls to the methods `names` of `obj`,
+    e. g. the commands and reads of an arm"""
+
+    def __init__(self, obj, log, names):
+        """
+        :param dict names Event of each method to log
+        """
+        self._obj = obj
+        self._log = log
+        self._names = names
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name not in self._names:
+            return attr
+        event = self._names[name]
+        log = self._log
+
+        def logged(*args, **kwargs):
+            with log.span(event):
+                return attr(*args, **kwargs)
+        return logged
+
+
+def read_telemetry(filename):
+    """
+    Reads a file written by `TelemetryLog`
+    :returns tuple of (event names, records of RECORD_DTYPE)
+    :raises ValueError if the file isn't a telemetry file
+    """
+    with open(filename, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a telemetry file".format(filename))
+        length, = struct.unpack("<I", infile.read(4))
+        names = json.loads(infile.read(length).decode("utf-8"))["events"]
+        data = infile.read()
+    # A session that was interrupted can end with a partial record
+    nrecords = len(data) // RECORD_DTYPE.itemsize
+    records = np.frombuffer(data[:nrecords * RECORD_DTYPE.itemsize],
+                            dtype=RECORD_DTYPE)
+    return names, records
+
+
+def summarize(names, records):
+    """
+    Summarizes the events of a session
+    :returns dict with the "duration" of the session, the total time in
+        each of the "categories", the durations of each event in "events",
+        and the durations of the "palpations" and "poses" in order
+    """
+    if len(records) == 0:
+        return {"duration": 0, "categories": {}, "events": {},
+                "palpations": np.zeros(0), "poses": np.zeros(0)}
+    events = {}
+    for code, name in enumerate(names):
+        durations = records["duration"][records["event"] == code]
+        if len(durations):
+            events[name] = durations
+    categories = {}
+    for name, durations in events.items():
+        category = CATEGORIES.get(name)
+        if category is not None:
+            categories[category] = (categories.get(category, 0)
+                                    + durations.sum())
+    return {
+        "duration": (np.max(records["start"] + records["duration"])
+                     - np.min(records["start"])),
+        "categories": categories,
+        "events": events,
+        "palpations": events.get("palpation", np.zeros(0)),
+        "poses": events.get("pose", np.zeros(0)),
+    }
+
+
+def format_histogram(durations, width=40):
+    """Formats a histogram of `durations` over HISTOGRAM_BINS as lines of
+    text, leaving out the empty bins at the ends"""
+    counts, edges = np.histogram(durations, HISTOGRAM_BINS)
+    filled = np.nonzero(counts)[0]
+    lines = []
+    for idx in range(filled[0], filled[-1] + 1):
+        bar = "#" * int(np.ceil(width * counts[idx] / counts.max()))
+        bounds = "{:.3g} - {:.3g}ms".format(edges[idx] * 1000,
+                                             edges[idx + 1] * 1000)
+        lines.append("{:>20} {:>6} {}".format(bounds, counts[idx], bar))
+    return lines
+
+
+def print_summary(summary, histograms=True):
+    duration = summary["duration"]
+    print("Session duration: {:.1f}s".format(duration))
+    if duration == 0:
+        return
+    for category, total in sorted(summary["categories"].items(),
+                                  key=lambda item: -item[1]):
+        print("    {:<14} {:>9.1f}s {:>5.1f}%".format(
+            category, total, 100 * total / duration
+        ))
+    print("    {:<14} {:>9.1f}s {:>5.1f}%".format(
+        "other", duration - sum(summary["categories"].values()),
+        100 * (1 - sum(summary["categories"].values()) / duration)
+    ))
+
+    print("{:<28} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "event", "count", "mean", "p50", "p90", "max"
+    ))
+    for name, durations in sorted(summary["events"].items()):
+        p50, p90 = np.percentile(durations, [50, 90])
+        print("{:<28} {:>7} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms"
+              .format(name, len(durations), 1000 * durations.mean(),
+                      1000 * p50, 1000 * p90, 1000 * durations.max()))
+
+    if histograms:
+        for name, durations in sorted(summary["events"].items()):
+            if CATEGORIES.get(name) in ["motion", "sensor reads"]:
+                print("{} latency:".format(name))
+                for line in format_histogram(durations):
+                    print("    " + line)
+
+    for name in ["palpations", "poses"]:
+        durations = summary[name]
+        if len(durations):
+            print("{} {}: {:.2f}s on average, {:.2f}s to {:.2f}s".format(
+                len(durations), name, durations.mean(), durations.min(),
+                durations.max()
+            ))
+            if len(durations) <= MAX_LISTED:
+                print("    " + " ".join("{:.1f}".format(d) for d in durations))
+            else:
+                slowest = np.argsort(durations)[::-1][:MAX_LISTED]
+                print("    slowest: " + ", ".join(
+                    "#{} {:.1f}s".format(idx + 1, durations[idx])
+                    for idx in slowest
+                ))
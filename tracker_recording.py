@@ -1,19 +1,78 @@
 from __future__ import print_function, division
 import sys
 import os.path
-import time
+import csv
 import numpy as np
 import PyKDL
 import rospy
+import analyze
 from recording import Recording
 from marker import Marker
+from arm_state import ArmState
+from kinematics import load_rob
+from profiler import profiled, ProfiledObject, PROFILER
+from registration import find_latency, register_rigid
+from ring_buffer import interpolate_samples
+from screening import screen_joint_set, solve_orientation
+from session import load_session, POSITION_COLUMNS, TRACKER_COLUMNS
+from telemetry import TelemetryObject
+from trajectory import interpolate_joint_set, JOINT_SPEEDS
 from copy import copy
 
 class TrackerRecording(Recording):
 
-    def __init__(self, robot_name, marker_namespace):
-        super(TrackerRecording, self).__init__(robot_name)
-        self.marker = Marker(marker_namespace)
+    # The arm is settled when its joints move slower than
+    # SETTLE_JOINT_VELOCITY (in rad/s or m/s) over the last SETTLE_WINDOW
+    # seconds, and the mean marker positions of the two halves of the last
+    # SETTLE_MARKER_WINDOW seconds are within the settle tolerance (in m).
+    # Averaging keeps the tracker noise (about 0.25mm) from holding it back
+    SETTLE_JOINT_VELOCITY = 0.002
+    SETTLE_WINDOW = 0.1
+    SETTLE_MARKER_WINDOW = 0.3
+    SETTLE_MARKER_SAMPLES = 4
+    SETTLE_TOLERANCE = 0.0005
+    # Once the joints are settled, poses are recorded after this many
+    # seconds even if the marker isn't, as they were before settling was
+    # detected
+    SETTLE_DWELL = 0.5
+    # Poses whose joints don't settle are recorded after this many seconds
+    SETTLE_TIMEOUT = 2.0
+
+    # Continuous recordings stream set-points at SETPOINT_RATE (in Hz),
+    # moving at CONTINUOUS_SPEED times the joint speeds of the estimates,
+    # and take the samples out of the buffers every WINDOW_PERIOD seconds
+    SETPOINT_RATE = 100
+    CONTINUOUS_SPEED = 1.0
+    WINDOW_PERIOD = 0.5
+
+    # Latencies of the tracker relative to the arm to try in seconds
+    # when pairing samples recorded during motion
+    LATENCIES = np.arange(-0.1, 0.1001, 0.002)
+    # Maximum difference from ROT_MATRIX of the orientation of a sample
+    # in degrees
+    MAX_ROT_DIFF = 2
+
+    def __init__(self, robot_name, marker_namespace, marker=None,
+                 settle_tolerance=None, **kwargs):
+        """
+        :param marker Marker to record from, or None to subscribe to
+            `marker_namespace`
+        :param float settle_tolerance Distance in meters that the mean
+            marker position may move by once settled, or None for
+            SETTLE_TOLERANCE
+        :param kwargs Keyword arguments of `Recording`
+        """
+        super(TrackerRecording, self).__init__(robot_name, **kwargs)
+        if settle_tolerance is not None:
+            self.SETTLE_TOLERANCE = settle_tolerance
+        if marker is None:
+            marker = Marker(marker_namespace)
+        marker = TelemetryObject(marker, self.telemetry,
+                                 {"get_current_position": "marker"})
+        if PROFILER.enabled:
+            marker = ProfiledObject(marker, "marker",
+                                    ["get_current_position"])
+        self.marker = marker
         self.tracker = True
 
     def gen_wide_joint_positions(self, nsamples=6):
@@ -32,29 +91,77 @@ class TrackerRecording(Recording):
                         q[2] = .220 - (sample3) / (nsamples - 1) * .150
                     yield copy(q)
 
+    def prescreen(self, joint_set, tracker_reference=None,
+                  tracker_bounds=None):
+        """
+        Drops the poses that would be disregarded after moving to them:
+        poses outside the joint limits in ROB_FILE, poses where the wrist
+        can't reach ROT_MATRIX within MAX_ROT_DIFF degrees and, if
+        `tracker_reference` and `tracker_bounds` are given, poses where the
+        marker would be outside the measurement volume of the tracker
+        :param str tracker_reference Folder of an earlier tracker session,
+            used to find where the marker will be in tracker coordinates
+        :param tuple tracker_bounds Tuple of (minimum, maximum) corners of
+            the measurement volume in tracker coordinates
+        :returns list of the poses kept
+        """
+        rob = load_rob(analyze.ROB_FILE)
+        rotation = np.array([[self.ROT_MATRIX[i, j] for j in range(3)]
+                             for i in range(3)])
+
+        tracker_transform = None
+        if tracker_reference is not None:
+            table = load_session(tracker_reference).tracker
+            tracker_transform, error = register_rigid(
+                table.get(*POSITION_COLUMNS), table.get(*TRACKER_COLUMNS)
+            )
+            print("Registered to the tracker with {} (error {:.6f})"
+                  .format(tracker_reference, error))
+
+        rejected = screen_joint_set(rob, joint_set, rotation,
+                                    self.MAX_ROT_DIFF, tracker_transform,
+                                    tracker_bounds)
+        for reason, mask in sorted(rejected.items()):
+            print("Dropped {} poses for their {}".format(np.sum(mask),
+                                                         reason))
+        keep = ~np.any(list(rejected.values()), axis=0)
+        return [q for q, kept in zip(joint_set, keep) if kept]
+
     def record_joints(self, joint_set, verbose=False):
         """Record points using tracker by controlling the joints
         of the dVRK"""
         # Get number of columns of terminal and subtract it by 2 to get
         # the toolbar width
-        toolbar_width = int(os.popen('stty size', 'r').read().split()[1]) - 2
+        try:
+            columns = os.popen('stty size', 'r').read().split()[1]
+            toolbar_width = int(columns) - 2
+        except IndexError:
+            # Not in a terminal
+            toolbar_width = 78
         npoints = len(joint_set)
         sys.stdout.write("[%s]\r" % (" " * toolbar_width))
         sys.stdout.flush()
-        start_time = time.time()
+        start_time = self.now()
         bad_rots = 0
+        unsettled = 0
+        settle_times = []
 
         for i, q in enumerate(joint_set):
+            pose_start = self.now()
             q[3:6] = self.arm.get_desired_joint_position()[3:6]
             self.arm.move_joint(q)
             self.arm.move(self.ROT_MATRIX)
-            time.sleep(0.5)
-            rot_matrix = self.arm.get_current_position().M
+            settle_time, settled = self.wait_for_settle()
+            if not settled:
+                unsettled += 1
+            # Position, orientation and joints at the same time
+            state = self.state.snapshot()
+            rot_matrix = PyKDL.Rotation.Quaternion(*state.orientation)
             marker_pos = self.marker.get_current_position()
             # check difference in angle
             rot_diff = self.ROT_MATRIX * rot_matrix.Inverse()
             # if difference in angle is > 2 degrees
-            if np.rad2deg(rot_diff.GetRotAngle()[0]) > 2:
+            if np.rad2deg(rot_diff.GetRotAngle()[0]) > self.MAX_ROT_DIFF:
                 rospy.logwarn("Disregarding bad orientation:\n{}"
                               .format(rot_matrix))
                 bad_rots += 1
@@ -62,7 +169,7 @@ class TrackerRecording(Recording):
                 rospy.logwarn("Disregarding bad data received from Tracker")
             else:
                 # Add current position (from tracker and arm) to data
-                arm_coord = self.arm.get_current_position().p
+                arm_coord = state.position
                 data_dict = {
                     "arm_position_x": arm_coord[0],
                     "arm_position_y": arm_coord[1],
@@ -70,20 +177,24 @@ class TrackerRecording(Recording):
                     "tracker_position_x": marker_pos[0],
                     "tracker_position_y": marker_pos[1],
                     "tracker_position_z": marker_pos[2],
+                    "settle_time": settle_time,
                 }
-                joints = self.arm.get_current_joint_position()
+                joints = state.joints
                 for joint_num, joint_pos in enumerate(joints):
                     data_dict.update({
                         "joint_{}_position".format(joint_num): joint_pos
                     })
                 self.data.append(data_dict)
+                if settled:
+                    settle_times.append(settle_time)
             block = int(toolbar_width * i/(npoints - 1))
             arrows = '-' * block if block < 1 else (('-' * block)[:-1] + '>')
             sys.stdout.write("\r[{}{}]".format(arrows,
                                                ' ' * (toolbar_width - block)))
             sys.stdout.flush()
+            self.telemetry.record("pose", pose_start, self.now())
 
-        end_time = time.time()
+        end_time = self.now()
         duration = end_time - start_time
         duration_min = int(duration) // 60
         duration_sec = int(duration % 60)
@@ -91,12 +202,203 @@ class TrackerRecording(Recording):
         print(rospy.get_caller_id(), '<- recording complete')
         print("Number of bad points: {}"
               .format(self.marker.n_bad_callbacks + bad_rots))
+        if unsettled:
+            rospy.logwarn("{} poses didn't settle and were recorded after "
+                          "{}s".format(unsettled, self.SETTLE_DWELL))
+        if settle_times:
+            print("Settled in {:.3f}s on average, {:.3f}s at most"
+                  .format(np.mean(settle_times), np.max(settle_times)))
+
+    def record_continuous(self, joint_set, verbose=False):
+        """Record points using tracker while moving through `joint_set`
+        without stopping at each pose. The arm is streamed set-points along
+        straight lines in joint space between the poses, with the wrist
+        keeping the tool at ROT_MATRIX. Every sample of the arm and the
+        tracker is recorded, and they are paired by time afterwards,
+        compensating for the latency of the tracker"""
+        npoints = len(joint_set)
+        rob = load_rob(analyze.ROB_FILE)
+        rotation = np.array([[self.ROT_MATRIX[i, j] for j in range(3)]
+                             for i in range(3)])
+        # Plan the path of the first three joints, solve the wrist along it
+        # and interpolate it to the rate of the set-points
+        knot_times, knots, arrivals = interpolate_joint_set(
+            [q[:3] for q in joint_set],
+            self.arm.get_current_joint_position()[:3],
+            JOINT_SPEEDS[:3] * self.CONTINUOUS_SPEED
+        )
+        knots, _ = solve_orientation(
+            rob, np.c_[knots, np.zeros((len(knots), 3))], rotation
+        )
+        times = np.union1d(
+            np.arange(0, knot_times[-1], 1 / self.SETPOINT_RATE), knot_times
+        )
+        setpoints = interpolate_samples(knot_times, knots, times)
+        print("Moving through the poses in {:.0f}s".format(times[-1]))
+
+        arm_windows = []
+        marker_windows = []
+        start_time = self.now()
+        window_start = start_time
+        pose_start = start_time
+        reached = 0
+        for setpoint_time, q in zip(times, setpoints):
+            delay = start_time + setpoint_time - self.now()
+            if delay > 0:
+                self.sleep(delay)
+            self.arm.move_joint(q, interpolate=False, blocking=False)
+            now = self.now()
+            if now - window_start >= self.WINDOW_PERIOD:
+                # Take the samples out of the buffers before they're
+                # overwritten
+                arm_windows.append(self.state.window(window_start, now))
+                marker_windows.append(
+                    self.marker.positions.window(window_start, now)
+                )
+                window_start = now
+            while (reached < npoints
+                   and setpoint_time >= arrivals[reached]):
+                reached += 1
+                self.telemetry.record("pose", pose_start, now)
+                pose_start = now
+                sys.stdout.write("\rMoved through {}/{} poses"
+                                 .format(reached, npoints))
+                sys.stdout.flush()
+        print()
+        # Record the arm coming to a stop at the last pose
+        self.sleep(self.WINDOW_PERIOD)
+        arm_windows.append(self.state.window(window_start, self.now()))
+        marker_windows.append(
+            self.marker.positions.window(window_start, self.now())
+        )
+
+        # Samples on the edges of the windows are in two windows
+        arm = ArmState(*[
+            np.concatenate([getattr(window, field)
+                            for window in arm_windows])
+            for field in ArmState._fields
+        ])
+        arm_times, unique = np.unique(arm.time, return_index=True)
+        arm = ArmState(*[field[unique] for field in arm])
+        marker_times, unique = np.unique(
+            np.concatenate([times for times, _ in marker_windows]),
+            return_index=True
+        )
+        markers = np.concatenate([pos for _, pos in marker_windows])[unique]
+
+        # Only keep samples with the arm in the same orientation as
+        # with the stop-and-go recording
+        target = np.array(self.ROT_MATRIX.GetQuaternion())
+
+        def orientation_ok(times):
+            orientations = interpolate_samples(arm_times, arm.orientation,
+                                               times)
+            orientations /= np.linalg.norm(orientations,
+                                           axis=-1)[:, np.newaxis]
+            cos_half_angles = np.clip(np.abs(orientations.dot(target)), 0, 1)
+            angles = np.rad2deg(2 * np.arccos(cos_half_angles))
+            return angles < self.MAX_ROT_DIFF
+
+        good = orientation_ok(marker_times)
+        latency, errors = find_latency(arm_times, arm.position,
+                                       marker_times[good], markers[good],
+                                       self.LATENCIES)
+        if latency in (self.LATENCIES[0], self.LATENCIES[-1]):
+            rospy.logwarn("Tracker latency is at the edge of the latencies "
+                          "tried: {}s".format(latency))
+
+        # State of the arm when each tracker sample was taken
+        times = marker_times - latency
+        good = (orientation_ok(times)
+                & (times >= arm_times[0]) & (times <= arm_times[-1]))
+        positions = interpolate_samples(arm_times, arm.position, times[good])
+        joints = interpolate_samples(arm_times, arm.joints, times[good])
+        for arm_coord, marker_pos, joint_pos in zip(positions, markers[good],
+                                                    joints):
+            data_dict = {
+                "arm_position_x": arm_coord[0],
+                "arm_position_y": arm_coord[1],
+                "arm_position_z": arm_coord[2],
+                "tracker_position_x": marker_pos[0],
+                "tracker_position_y": marker_pos[1],
+                "tracker_position_z": marker_pos[2],
+            }
+            for joint_num, joint in enumerate(joint_pos):
+                data_dict.update({
+                    "joint_{}_position".format(joint_num): joint
+                })
+            self.data.append(data_dict)
+
+        self.info["Tracker Latency"] = float(latency)
+
+        duration = self.now() - start_time
+        duration_min = int(duration) // 60
+        duration_sec = int(duration % 60)
+        print("Finished in {}m {}s".format(duration_min, duration_sec))
+        print(rospy.get_caller_id(), '<- recording complete')
+        print("Paired {} of {} tracker samples with a latency of {:.1f}ms "
+              "(error {:.6f})".format(np.count_nonzero(good),
+                                      len(marker_times), latency * 1000,
+                                      errors.min()))
+
+    def is_settled(self, now):
+        """
+        Whether the joints and the marker were stable before `now`
+        :returns tuple of (whether the joints settled, whether the
+            marker settled)
+        """
+        start = now - self.SETTLE_WINDOW
+        times, joints = self.state.joints.window(start, now)
+        joints_settled = False
+        if len(times) >= 2:
+            velocities = (np.abs(joints[-1] - joints[0])
+                          / (times[-1] - times[0]))
+            joints_settled = np.all(velocities < self.SETTLE_JOINT_VELOCITY)
+
+        middle = now - self.SETTLE_MARKER_WINDOW / 2
+        marker_times, markers = self.marker.positions.window(
+            now - self.SETTLE_MARKER_WINDOW, now
+        )
+        first = marker_times < middle
+        marker_settled = False
+        if (len(marker_times) >= self.SETTLE_MARKER_SAMPLES
+                and 0 < np.sum(first) < len(marker_times)):
+            drift = markers[~first].mean(axis=0) - markers[first].mean(axis=0)
+            marker_settled = np.linalg.norm(drift) < self.SETTLE_TOLERANCE
+        return joints_settled, marker_settled
+
+    @profiled("settle")
+    def wait_for_settle(self):
+        """
+        Waits until the joints and the marker stop moving, or SETTLE_DWELL
+        after the joints stop if the marker doesn't settle or isn't seen
+        :returns tuple of (the time waited in seconds, whether the joints
+            and the marker settled)
+        """
+        start_time = self.now()
+        while not rospy.is_shutdown():
+            now = self.now()
+            waited = now - start_time
+            joints_settled, marker_settled = self.is_settled(now)
+            if (waited >= self.SETTLE_WINDOW and joints_settled
+                    and marker_settled):
+                return waited, True
+            if ((waited >= self.SETTLE_DWELL and joints_settled)
+                    or waited > self.SETTLE_TIMEOUT):
+                return waited, False
+            self.sleep(0.01)
+        return self.now() - start_time, False
 
     def output_to_csv(self):
         """Outputs contents of self.data to fpath"""
         filename = "tracker_point_cloud.csv"
+        if not self.data:
+            rospy.logerr("No poses were recorded; not writing {}"
+                         .format(filename))
+            return
 
-        with open(os.path.join(self.folder, filename), 'w') as csvfile:
+        with self.telemetry.span("write"), open(
+                os.path.join(self.folder, filename), 'w') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=self.data[0].keys())
             writer.writeheader()
             writer.writerows(self.data)
@@ -0,0 +1,146 @@
+from __future__ import division, print_function
+import numpy as np
+
+
+# Maximum speeds of the joints of the PSM in rad/s, or m/s for joint 2,
+# used to estimate how long moves take
+JOINT_SPEEDS = np.array([0.8, 0.8, 0.1, 2.0, 2.0, 2.0])
+
+
+def move_times(joint_set, speeds=JOINT_SPEEDS):
+    """
+    Estimates the time to move between every pair of poses, as the time the
+    slowest joint takes at its maximum speed
+    :param numpy.ndarray joint_set Poses of shape (N, njoints)
+    :param numpy.ndarray speeds Maximum speed of each joint
+    :returns times in seconds of shape (N, N)
+    """
+    joint_set = np.asarray(joint_set, dtype=np.float64)
+    speeds = np.asarray(speeds, dtype=np.float64)[:joint_set.shape[1]]
+    diffs = np.abs(joint_set[:, np.newaxis] - joint_set[np.newaxis])
+    return np.max(diffs / speeds, axis=-1)
+
+
+def path_time(order, times):
+    """Gets the time to visit the poses in `order`"""
+    order = np.asarray(order)
+    return times[order[:-1], order[1:]].sum()
+
+
+def _with_start(joint_set, start):
+    """Gets the poses as an array, after `start` if it isn't None"""
+    poses = np.asarray(joint_set, dtype=np.float64)
+    if start is None:
+        return poses
+    start = np.asarray(start, dtype=np.float64)[:poses.shape[1]]
+    return np.r_[start[np.newaxis], poses]
+
+
+def estimate_duration(joint_set, start=None, speeds=JOINT_SPEEDS):
+    """
+    Estimates the time to move through the poses in the order given
+    :param numpy.ndarray start Joint positions the arm starts from, or None
+        to start from the first pose
+    :returns the time in seconds
+    """
+    poses = _with_start(joint_set, start)
+    times = np.max(np.abs(np.diff(poses, axis=0))
+                   / np.asarray(speeds)[:poses.shape[1]], axis=-1)
+    return times.sum()
+
+
+def interpolate_joint_set(joint_set, start=None, speeds=JOINT_SPEEDS,
+                          rate=10):
+    """
+    Gets a path through the poses in order along straight lines in joint
+    space, with every move taking as long as its slowest joint at `speeds`,
+    as estimated by `estimate_duration`
+    :param numpy.ndarray start Joint positions the arm starts from, or None
+        to start from the first pose
+    :param float rate Rate of the points of the path in Hz, which also
+        has a point at each pose
+    :returns tuple of (times of the points in seconds from the start,
+        points of shape (M, njoints), times that each pose is reached)
+    """
+    poses = _with_start(joint_set, start)
+    durations = np.max(np.abs(np.diff(poses, axis=0))
+                       / np.asarray(speeds)[:poses.shape[1]], axis=-1)
+    arrivals = np.r_[0, np.cumsum(durations)]
+    times = np.union1d(np.arange(0, arrivals[-1], 1 / rate), arrivals)
+    points = np.stack([np.interp(times, arrivals, poses[:, joint])
+                       for joint in range(poses.shape[1])], axis=-1)
+    if start is not None:
+        arrivals = arrivals[1:]
+    return times, points, arrivals
+
+
+def nearest_neighbor_order(times):
+    """
+    Orders the poses by always moving to the closest pose not visited yet,
+    starting from the first pose
+    :param numpy.ndarray times Move times of shape (N, N)
+    :returns the order of the poses
+    """
+    npoints = len(times)
+    visited = np.zeros(npoints, dtype=bool)
+    order = [0]
+    visited[0] = True
+    for _ in range(npoints - 1):
+        remaining = np.where(visited, np.inf, times[order[-1]])
+        order.append(int(np.argmin(remaining)))
+        visited[order[-1]] = True
+    return np.array(order)
+
+
+def two_opt(order, times, max_passes=100):
+    """
+    Improves a path by reversing parts of it while that shortens it.
+    The first pose stays first, and the path doesn't return to it
+    :param numpy.ndarray order Initial order of the poses
+    :param numpy.ndarray times Move times of shape (N, N)
+    :returns the improved order
+    """
+    order = np.array(order)
+    npoints = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, npoints - 1):
+            # Reversing order[i:j + 1] replaces the moves
+            # order[i - 1] -> order[i] and order[j] -> order[j + 1] with
+            # order[i - 1] -> order[j] and order[i] -> order[j + 1]
+            j = np.arange(i + 1, npoints)
+            before = times[order[i - 1], order[i]]
+            after = np.zeros(len(j))
+            after_new = np.zeros(len(j))
+            has_next = j < npoints - 1
+            after[has_next] = times[order[j[has_next]],
+                                    order[j[has_next] + 1]]
+            after_new[has_next] = times[order[i], order[j[has_next] + 1]]
+            deltas = (times[order[i - 1], order[j]] + after_new
+                      - before - after)
+            best = np.argmin(deltas)
+            if deltas[best] < -1e-12:
+                order[i:j[best] + 1] = order[i:j[best] + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def order_joint_set(joint_set, start=None, speeds=JOINT_SPEEDS):
+    """
+    Reorders poses to minimize the estimated time to move through all of
+    them, with a nearest neighbor path improved by 2-opt
+    :param list joint_set Poses to visit
+    :param numpy.ndarray start Joint positions the arm starts from, or None
+        to start from the first pose
+    :param numpy.ndarray speeds Maximum speed of each joint
+    :returns tuple of (reordered poses, estimated time in seconds)
+    """
+    poses = _with_start(joint_set, start)
+    times = move_times(poses, speeds)
+    order = two_opt(nearest_neighbor_order(times), times)
+    duration = path_time(order, times)
+    if start is not None:
+        order = order[1:] - 1
+    return [joint_set[idx] for idx in order], duration